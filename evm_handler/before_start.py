@@ -1,13 +1,12 @@
 #! /usr/bin/python3
 # -*- coding: utf-8 -*-
 import asyncio
-import uuid
-from sqlalchemy import text, exc as sqlalchemy_exc
+from sqlalchemy import text
 
 from misc import startup_logger, SharedVariables
 from config import Config as Cfg, StatCode as St
 from db.database import DB, write_async_session, engine
-from db.models import Base, Coins
+from db.models import Base, Coins, queue_notify_ddl, coins_notify_ddl, lease_migration_ddl
 from web3_client import utils
 
 
@@ -17,28 +16,46 @@ async def create_models():
         # await conn.run_sync(Base.metadata.drop_all)
         await conn.execute(text("CREATE EXTENSION IF NOT EXISTS \"uuid-ossp\";"))
         await conn.run_sync(Base.metadata.create_all)
+        # deposits of one address and coin are swept by one transaction and share tx_hash_out
+        await conn.execute(text("ALTER TABLE deposits DROP CONSTRAINT IF EXISTS deposits_tx_hash_out_key;"))
+        await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_deposits_tx_hash_out ON deposits (tx_hash_out);"))
+        # withdrawals paid by one disperse transaction share tx_hash_out
+        await conn.execute(text("ALTER TABLE withdrawals DROP CONSTRAINT IF EXISTS withdrawals_tx_hash_out_key;"))
+        await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_withdrawals_tx_hash_out ON withdrawals (tx_hash_out);"))
+        # replica which claimed the row, for tx_handler running in several processes
+        for table in ("deposits", "withdrawals"):
+            await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS tx_handler_replica VARCHAR(64);"))
+            await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS callback_replica VARCHAR(64);"))
+            # claims are leases which expire if the replica dies
+            for lease in ("tx_handler_lease_expires_at", "callback_lease_expires_at"):
+                await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {lease} TIMESTAMPTZ;"))
+                await conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_{lease} ON {table} ({lease});"))
+        await conn.execute(lease_migration_ddl)
+        # wake queue workers on new deposits and withdrawals, idempotent for existing databases
+        for ddl in queue_notify_ddl:
+            await conn.execute(ddl)
+        for ddl in coins_notify_ddl:
+            await conn.execute(ddl)
 
 
-async def insert_users(mnemonic, count_users, role, offset):
+async def insert_users(mnemonic, indexes, role):
+    """
+    This function derives accounts with indexes from mnemonic and inserts missing ones in bulk.
+    """
+    keys = [utils.keys_from_mnemonic(mnemonic, 1, index)[0] for index in indexes]
+    for key in keys:
+        print(St(role), key.address, key.key.hex())
     async with write_async_session() as session:
         db = DB(session, None)
-        keys = utils.keys_from_mnemonic(mnemonic, count_users, offset)
-        ret = []
-        for i in range(count_users):
-            print(St(role), keys[i].address, keys[i].key.hex())
-            try:
-                user_id = uuid.uuid4().hex
-                await db.add_account(user_id, None, None, keys[i].address, keys[i].key.hex(), role)
-            except sqlalchemy_exc.IntegrityError as exc:
-                if "unique" in str(exc.orig):
-                    pass
-                else:
-                    raise exc
-            except Exception as exc:
-                raise exc
-            else:
-                ret.append(user_id)
-    return ret
+        return await db.add_accounts([(key.address, key.key.hex()) for key in keys], role)
+
+
+def hot_wallet_indexes():
+    """
+    The first hot wallet and approve wallets keep their derivation indexes,
+    so the rest of hot wallets are derived after approve wallets.
+    """
+    return [0] + list(range(1 + Cfg.approve_accounts, Cfg.admin_accounts + Cfg.approve_accounts))
 
 
 async def upsert_coins(coins):
@@ -78,8 +95,8 @@ async def startup():
         await create_models()
         coins = parse_coins(Cfg.config_coins)
         await upsert_coins(coins)
-        await insert_users(Cfg.ADMIN_SEED, Cfg.admin_accounts, St.SADMIN.v, 0)
-        await insert_users(Cfg.ADMIN_SEED, Cfg.approve_accounts, St.APPROVE.v, Cfg.admin_accounts)
+        await insert_users(Cfg.ADMIN_SEED, hot_wallet_indexes(), St.SADMIN.v)
+        await insert_users(Cfg.ADMIN_SEED, range(1, 1 + Cfg.approve_accounts), St.APPROVE.v)
     except Exception as exc:
         print(f"Error: {exc}")
         startup_logger.error(f"Error: {exc}")
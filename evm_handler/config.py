@@ -1,4 +1,5 @@
 import os
+import socket
 from enum import Enum
 import validators
 
@@ -57,12 +58,39 @@ class Config(object):
     DB_SECRET_KEY = os.environ.get("PROC_HANDLER_DB_SECRET_KEY").encode()
 
     grpc_server = os.environ.get("PROC_HANDLER_PROVIDER_URL")
+    ws_server = os.environ.get("PROC_HANDLER_PROVIDER_WS_URL")  # optional, enables newHeads subscription
     scanner_url = os.environ.get("PROC_HANDLER_SCANNER_URL")
     config_coins = os.environ.get("PROC_HANDLER_COINS")
 
     network_name = os.environ.get("PROC_HANDLER_NETWORK_NAME")
     network_id = int(os.environ.get("PROC_HANDLER_NETWORK_ID"))
     start_block = os.environ.get("PROC_HANDLER_START_BLOCK", "latest")
+    block_range = int(os.environ.get("PROC_HANDLER_BLOCK_RANGE", 10))  # max blocks per eth_getLogs in catch-up mode
+    # ask the node for Transfer logs to our user addresses only instead of every transfer of our coins
+    logs_filter_recipients = os.environ.get("PROC_HANDLER_LOGS_FILTER_RECIPIENTS", "false").lower() == "true"
+
+    # EIP-1559 tips are estimated at this percentile of tips paid in recent blocks
+    fee_tip_percentile = float(os.environ.get("PROC_HANDLER_FEE_TIP_PERCENTILE", 50))
+    min_priority_fee = int(os.environ.get("PROC_HANDLER_MIN_PRIORITY_FEE", 10 ** 9))  # wei
+
+    # Disperse contract pays many recipients in one transaction, plain sends are pipelined if it's not set
+    disperse_address = os.environ.get("PROC_HANDLER_DISPERSE_ADDRESS")
+    # seconds to collect withdrawals before paying them by coin with one disperse, 0 sends one by one
+    withdrawal_batch_window = int(os.environ.get("PROC_HANDLER_WITHDRAWAL_BATCH_WINDOW", 0))
+
+    # Multicall3 aggregates balance reads, balances are read with JSON-RPC batches if it isn't deployed
+    multicall_address = os.environ.get("PROC_HANDLER_MULTICALL_ADDRESS", "0xcA11bde05977b3631167028862bE2a173976CA11")
+
+    # sweeps which fee is above this share of their value wait for cheaper gas, 0 sweeps everything at once
+    sweep_max_fee_ratio = float(os.environ.get("PROC_HANDLER_SWEEP_MAX_FEE_RATIO", 0.05))
+    # log planned sweeps instead of sending them
+    sweep_dry_run = os.environ.get("PROC_HANDLER_SWEEP_DRY_RUN", "false").lower() == "true"
+
+    # several tx_handler processes per chain, each signs only for wallets of its own shard,
+    # the replica with index 0 also parses blocks
+    replica_id = os.environ.get("PROC_HANDLER_REPLICA_ID", socket.gethostname())  # recorded on claimed rows
+    replicas = int(os.environ.get("PROC_HANDLER_REPLICAS", 1))
+    replica_index = int(os.environ.get("PROC_HANDLER_REPLICA_INDEX", 0))
 
     PROC_HANDLER_API_KEY = os.environ.get("PROC_HANDLER_API_KEY")
     PROC_URL = os.environ.get("PROC_URL")
@@ -71,19 +99,69 @@ class Config(object):
     assert network_name is not None, "PROC_HANDLER_NETWORK_NAME must be set"
     assert validators.url(grpc_server), "PROC_HANDLER_PROVIDER_URL must be a valid URL"
     assert validators.url(scanner_url), "PROC_HANDLER_SCANNER_URL must be a valid URL"
+    assert not ws_server or ws_server.startswith(("ws://", "wss://")), \
+        "PROC_HANDLER_PROVIDER_WS_URL must be a ws:// or wss:// URL"
+
+    assert not disperse_address or len(disperse_address) == 42, "PROC_HANDLER_DISPERSE_ADDRESS must be an address"
+    assert not withdrawal_batch_window or disperse_address, \
+        "PROC_HANDLER_WITHDRAWAL_BATCH_WINDOW needs PROC_HANDLER_DISPERSE_ADDRESS"
+    assert 0 <= replica_index < replicas, "PROC_HANDLER_REPLICA_INDEX must be in [0, PROC_HANDLER_REPLICAS)"
+    assert 0 <= sweep_max_fee_ratio < 1, "PROC_HANDLER_SWEEP_MAX_FEE_RATIO must be in [0, 1)"
+    assert block_range > 0, "PROC_HANDLER_BLOCK_RANGE must be positive"
+    assert 0 <= fee_tip_percentile <= 100, "PROC_HANDLER_FEE_TIP_PERCENTILE must be between 0 and 100"
 
     if start_block != "latest":
         start_block = int(start_block)
 
     LOGGING_FORMATTER, TIME_FORMAT = '%(module)s#[LINE:%(lineno)d]# %(levelname)-3s [%(asctime)s] %(message)s', '%Y-%m-%d %H:%M:%S'
 
-    admin_accounts = 1
+    admin_accounts = int(os.environ.get("PROC_HANDLER_HOT_WALLETS", 1))  # SADMIN addresses paying withdrawals
+    assert admin_accounts > 0, "PROC_HANDLER_HOT_WALLETS must be positive"
     approve_accounts = 4
 
+    logs_recipients_chunk = 1000  # user addresses per eth_getLogs topics[2] filter
+
+    multicall_chunk = 500  # balance reads per aggregate3 eth_call
+
+    prefetch_window = 3  # block ranges downloaded ahead of the one being stored
+
+    confirmation_poll_interval = 1  # seconds, receipts of broadcast transactions are requested once per new block
+    fee_history_blocks = 20  # blocks of eth_feeHistory kept in memory for tip estimation
+    base_fee_multiplier = 2  # maxFeePerGas headroom, base fee can grow 12.5% per block
+
+    block_poll_interval = 3  # seconds, eth_blockNumber polling when no newHeads notification arrives
+    ws_reconnect_interval = 5  # seconds between newHeads resubscribe attempts
+
+    queue_poll_interval = 10  # seconds, queue workers poll this often when no NOTIFY arrives
+    listen_reconnect_interval = 5  # seconds between LISTEN reconnect attempts
+
+    lease_seconds = 300  # claimed rows return to the queue after this unless the claiming replica renews them
+    lease_renew_interval = 60  # seconds between renewals of leases held by running jobs
+    lease_reaper_interval = 60  # seconds between releases of expired leases
+    pool_stats_interval = 60  # seconds between reports of DB pool waits and hold times
+
+    accounts_refresh_interval = 10  # seconds, addresses inserted after the user_address.id watermark are loaded
+    accounts_refresh_overlap = 1000  # ids reread below the watermark, concurrent inserts may commit out of id order
+    accounts_resync_interval = 6 * 3600  # seconds between full reloads of addresses, SIGHUP forces one
+
+    disperse_gas = 50000  # gas of disperse call itself
+    disperse_ether_gas = 40000  # gas per recipient of disperseEther, includes creation of a new account
+    disperse_token_gas = 60000  # gas per recipient of disperseToken
+
+    wallet_lane_depth = 5  # withdrawals in flight per hot wallet, each wallet has its own nonce sequence
+
+    approve_amount = 9_999_999_999_999_999  # allowance given to approve address once per user address and coin
+
     allowed_slippage = 2
     block_offset = 2
     min_admin_address_native_balance = 50 * (10 ** 6)
 
+    # keep-alive connections to the RPC provider shared by all AsyncEth clients
+    http_pool_max_connections = 20
+    http_pool_max_keepalive_connections = 20
+    http_pool_keepalive_expiry = 60
+    http2 = True
+
     WRITE_POOL_SIZE = 10
     READ_POOL_SIZE = 10
 
@@ -1,14 +1,20 @@
 #! /bin/usr/python3
 # -*- coding: utf-8 -*-
-from sqlalchemy import Column, and_, func, select, update
+from sqlalchemy import Column, and_, func, select, update, delete, tuple_, values, column, true, cast, String
 from sqlalchemy.dialects import postgresql
-from datetime import datetime
+from datetime import datetime, timedelta
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy import event, exc as sa_exc
 from decimal import Decimal
-from typing import List, Tuple, Any, Union
+from typing import List, Tuple, Any, Union, Dict
 from sqlalchemy.orm import aliased
+import uuid
+import asyncio
+import asyncpg
+import time
 
-from .models import User, UserAddress, Deposits, Withdrawals, Blocks, Coins, Balances
+from .models import User, UserAddress, Deposits, Withdrawals, Blocks, Coins, Balances, Allowances
 from config import Config as Cfg, StatCode as St
 
 
@@ -17,15 +23,135 @@ def dsn2alchemy_conn_string(dsn_string):
     return f'postgresql+asyncpg://' + f"{r['user']}:{r['password']}@{r['host']}:{r['port']}/{r['dbname']}"
 
 
+
+class PoolStats:
+    """
+    Time spent waiting for a pool connection and holding it from checkout to checkin, since the last report.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_max = 0.0
+
+    def add_wait(self, seconds: float):
+        self.checkouts += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def add_hold(self, seconds: float):
+        self.hold_max = max(self.hold_max, seconds)
+
+    def report(self, pool) -> str:
+        wait_avg = self.wait_total / self.checkouts if self.checkouts else 0.0
+        report = (f"checkouts {self.checkouts}, wait avg {wait_avg:.3f}s max {self.wait_max:.3f}s, "
+                  f"timeouts {self.timeouts}, hold max {self.hold_max:.3f}s, {pool.status()}")
+        self.reset()
+        return report
+
+
+def timed_pool(stats: PoolStats):
+    """
+    This function returns a pool class which records waits for connections into stats,
+    hold times are recorded by pool events of the engine, see track_hold_time.
+    """
+
+    class TimedQueuePool(AsyncAdaptedQueuePool):
+        def connect(self):
+            started = time.monotonic()
+            try:
+                return super().connect()
+            except sa_exc.TimeoutError:
+                stats.timeouts += 1
+                raise
+            finally:
+                stats.add_wait(time.monotonic() - started)
+
+    return TimedQueuePool
+
+
+def track_hold_time(async_engine, stats: PoolStats):
+    @event.listens_for(async_engine.sync_engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.monotonic()
+
+    @event.listens_for(async_engine.sync_engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop("checked_out_at", None)
+        if checked_out_at is not None:
+            stats.add_hold(time.monotonic() - checked_out_at)
+
+
+write_pool_stats = PoolStats()
+read_pool_stats = PoolStats()
+
 engine = create_async_engine(dsn2alchemy_conn_string(Cfg.WRITE_DSN), pool_timeout=10, pool_recycle=3600,
-                             pool_size=Cfg.WRITE_POOL_SIZE, max_overflow=0, future=True)
+                             pool_size=Cfg.WRITE_POOL_SIZE, max_overflow=0, future=True,
+                             poolclass=timed_pool(write_pool_stats))
 read_engine = create_async_engine(dsn2alchemy_conn_string(Cfg.READ_DSN), pool_timeout=10, pool_recycle=3600,
-                                  pool_size=Cfg.WRITE_POOL_SIZE, max_overflow=0, future=True)
+                                  pool_size=Cfg.WRITE_POOL_SIZE, max_overflow=0, future=True,
+                                  poolclass=timed_pool(read_pool_stats))
+track_hold_time(engine, write_pool_stats)
+track_hold_time(read_engine, read_pool_stats)
 
 write_async_session = async_sessionmaker(engine, expire_on_commit=False, autoflush=False)
 read_async_session = async_sessionmaker(read_engine, expire_on_commit=False, autoflush=False)
 
 
+class QueueListener:
+    """
+    LISTENs queue channels on a dedicated connection, a LISTEN connection can't be shared through the pool.
+    Every NOTIFY sets the events subscribed to its channel, all of them are set after each (re)connect
+    because notifications sent while the connection was down are lost.
+    """
+
+    def __init__(self, dsn: str, reconnect_interval: float):
+        self.dsn = dsn
+        self.reconnect_interval = reconnect_interval
+        self.events: Dict[str, List[asyncio.Event]] = {}
+
+    def subscribe(self, channel: str) -> asyncio.Event:
+        waiter = asyncio.Event()
+        self.events.setdefault(channel, []).append(waiter)
+        return waiter
+
+    def _wake(self, channel: str) -> None:
+        for waiter in self.events.get(channel, []):
+            waiter.set()
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        self._wake(channel)
+
+    async def run(self, logger) -> None:
+        r = dict(s.split("=") for s in self.dsn.split())
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(user=r['user'], password=r['password'], host=r['host'],
+                                             port=int(r['port']), database=r['dbname'])
+                closed = asyncio.Event()
+                conn.add_termination_listener(lambda _: closed.set())
+                for channel in self.events:
+                    await conn.add_listener(channel, self._on_notify)
+                for channel in self.events:
+                    self._wake(channel)
+                await closed.wait()
+                logger.warning("queue listener connection closed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.error(f"queue listener failed: {exc}")
+            finally:
+                if conn is not None and not conn.is_closed():
+                    conn.terminate()
+            await asyncio.sleep(self.reconnect_interval)
+
+
 def array_prepare_to_json(columns, values):
     resp = {}
     for index, col in enumerate(columns):
@@ -52,6 +178,20 @@ def unpack_column_to_array(values):
     return [x[0] for x in values]
 
 
+def in_replica_shard(key):
+    """
+    Condition on a text key which keeps rows of one signer wallet in one replica,
+    so two replicas never send transactions from the same address.
+    """
+    if Cfg.replicas == 1:
+        return true()
+    return func.hashtext(key).op("&")(0x7FFFFFFF) % Cfg.replicas == Cfg.replica_index
+
+
+def lease_until():
+    return func.now() + timedelta(seconds=Cfg.lease_seconds)
+
+
 class DB(object):
     def __init__(self, session, logger=None):
         self.session = session
@@ -101,9 +241,16 @@ class DB(object):
         resp = await self.session.execute(stmt)
         return resp.fetchall()
 
-    async def all_accounts(self) -> List[Tuple[str, str]]:
+    async def all_accounts(self, after_id: Union[int, None] = None) -> List[Tuple[int, str, int]]:
+        """
+        :param after_id: only addresses with greater user_address.id, all of them if None
+        :return: [(address_id, public, role), ...] ordered by address_id
+        """
         stmt = select(UserAddress.id, UserAddress.public, User.role)
         stmt = stmt.join(User, User.id == UserAddress.user_id)
+        if after_id is not None:
+            stmt = stmt.where(UserAddress.id > after_id)
+        stmt = stmt.order_by(UserAddress.id)
         resp = await self.session.execute(stmt)
         return resp.fetchall()
 
@@ -177,6 +324,32 @@ class DB(object):
         else:
             return True
 
+    async def add_accounts(self, accounts: List[Tuple[str, str]], role: int) -> List[str]:
+        """
+        This function inserts accounts without admin and approve in bulk, already existing addresses are skipped.
+        :param accounts: [(public, private), ...]
+        :return: user ids of inserted accounts
+        """
+        stmt = select(UserAddress.public).where(UserAddress.public.in_([public for public, _ in accounts]))
+        existing = set((await self.session.execute(stmt)).scalars().all())
+        accounts = [(uuid.uuid4().hex, public, private) for public, private in accounts if public not in existing]
+        if not accounts:
+            return []
+        try:
+            await self.session.execute(postgresql.insert(User).values([{User.id.key: user_id, User.role.key: role}
+                                                                       for user_id, _, _ in accounts]))
+            await self.session.execute(postgresql.insert(UserAddress).values([{
+                UserAddress.user_id.key: user_id,
+                UserAddress.public.key: public,
+                UserAddress.private.key: private
+            } for user_id, public, private in accounts]))
+            await self.session.commit()
+        except Exception as exc:
+            await self.session.rollback()
+            raise exc
+        else:
+            return [user_id for user_id, _, _ in accounts]
+
     async def update_deposit_by_id(self, dep_id: str, data: dict, commit: bool = False):
         stmt = update(Deposits).where(Deposits.id == dep_id)
         stmt = stmt.values(data)
@@ -185,6 +358,14 @@ class DB(object):
             await self.session.commit()
         return resp
 
+    async def update_deposits_by_ids(self, dep_ids: List[str], data: dict, commit: bool = False):
+        stmt = update(Deposits).where(Deposits.id.in_(dep_ids))
+        stmt = stmt.values(data)
+        resp = await self.session.execute(stmt, execution_options={"synchronize_session": False})
+        if commit:
+            await self.session.commit()
+        return resp
+
     async def update_withdrawal_by_id(self, withdrawal_id: str, data: dict, commit: bool = False):
         stmt = update(Withdrawals).where(Withdrawals.id == withdrawal_id)
         stmt = stmt.values(data)
@@ -193,6 +374,14 @@ class DB(object):
             await self.session.commit()
         return resp
 
+    async def update_withdrawals_by_ids(self, withdrawal_ids: List[str], data: dict, commit: bool = False):
+        stmt = update(Withdrawals).where(Withdrawals.id.in_(withdrawal_ids))
+        stmt = stmt.values(data)
+        resp = await self.session.execute(stmt, execution_options={"synchronize_session": False})
+        if commit:
+            await self.session.commit()
+        return resp
+
     async def update_user_address_by_id(self, address_id: str, data: dict, commit: bool = False):
         stmt = update(UserAddress).where(UserAddress.id == address_id)
         stmt = stmt.values(data)
@@ -201,6 +390,49 @@ class DB(object):
             await self.session.commit()
         return resp
 
+    async def _bulk_update(self, model, rows: List[dict], commit: bool = False):
+        """
+        This function applies per-row updates of a whole batch with one UPDATE ... FROM (VALUES ...)
+        per set of updated columns, so a batch costs a few statements and one commit instead of one per row.
+        :param rows: [{"id": row_id, column_key: value, ...}, ...]
+        """
+        shapes: Dict[Tuple[str, ...], List[dict]] = {}
+        for row in rows:
+            shapes.setdefault(tuple(sorted(row)), []).append(row)
+        try:
+            for keys, shape_rows in shapes.items():
+                data = values(*[column(key, model.__table__.c[key].type) for key in keys], name="data").data(
+                    [tuple(row[key] for key in keys) for row in shape_rows])
+                stmt = (update(model)
+                        .where(model.id == data.c.id)
+                        .values({key: data.c[key] for key in keys if key != "id"}))
+                await self.session.execute(stmt, execution_options={"synchronize_session": False})
+            if commit:
+                await self.session.commit()
+        except Exception as exc:
+            await self.session.rollback()
+            raise exc
+
+    async def bulk_update_deposits(self, rows: List[dict], commit: bool = False):
+        """
+        :param rows: [{"id": deposit_id, column_key: value, ...}, ...], each row may update its own columns
+        """
+        await self._bulk_update(Deposits, rows, commit)
+
+    async def bulk_update_withdrawals(self, rows: List[dict], commit: bool = False):
+        """
+        :param rows: [{"id": withdrawal_id, column_key: value, ...}, ...], each row may update its own columns
+        """
+        await self._bulk_update(Withdrawals, rows, commit)
+
+    async def update_user_addresses_by_ids(self, address_ids: List[int], data: dict, commit: bool = False):
+        stmt = update(UserAddress).where(UserAddress.id.in_(address_ids))
+        stmt = stmt.values(data)
+        resp = await self.session.execute(stmt)
+        if commit:
+            await self.session.commit()
+        return resp
+
     async def upsert_balance(self, address_id: str, coin_id: str, balance: Decimal, commit: bool = False):
         stmt = postgresql.insert(Balances).values({
             Balances.address_id.key: address_id,
@@ -218,12 +450,78 @@ class DB(object):
             await self.session.rollback()
             raise exc
 
+    async def upsert_balances(self, rows: List[Tuple[str, str, Decimal]], commit: bool = False):
+        """
+        This function upserts balances of many addresses with one INSERT ... ON CONFLICT statement.
+        :param rows: [(address_id, coin_id, balance), ...] with unique (address_id, coin_id)
+        """
+        if not rows:
+            return
+        stmt = postgresql.insert(Balances).values([{
+            Balances.address_id.key: address_id,
+            Balances.coin_id.key: coin_id,
+            Balances.balance.key: balance
+        } for address_id, coin_id, balance in rows])
+        stmt = stmt.on_conflict_do_update(index_elements=[Balances.address_id.key, Balances.coin_id.key], set_={
+            Balances.balance.key: stmt.excluded.balance
+        })
+        try:
+            await self.session.execute(stmt)
+            if commit:
+                await self.session.commit()
+        except Exception as exc:
+            await self.session.rollback()
+            raise exc
+
+    async def get_allowances(self, keys: List[Tuple[int, str, str]]) -> dict:
+        """
+        :param keys: [(address_id, contract_address, spender), ...]
+        :return: {(address_id, contract_address, spender): allowance} for known allowances only
+        """
+        if not keys:
+            return {}
+        stmt = select(Allowances.address_id, Allowances.contract_address, Allowances.spender, Allowances.allowance) \
+            .where(tuple_(Allowances.address_id, Allowances.contract_address, Allowances.spender).in_(keys))
+        resp = await self.session.execute(stmt)
+        return {(address_id, contract_address, spender): allowance
+                for address_id, contract_address, spender, allowance in resp.fetchall()}
+
+    async def save_allowance(self, address_id: int, contract_address: str, spender: str, allowance: Union[int, None],
+                             commit: bool = False):
+        """
+        This function records allowance, None forgets it, so it's requested from the node next time.
+        """
+        if allowance is None:
+            stmt = delete(Allowances).where(and_(Allowances.address_id == address_id,
+                                                 Allowances.contract_address == contract_address,
+                                                 Allowances.spender == spender))
+        else:
+            stmt = postgresql.insert(Allowances).values({
+                Allowances.address_id.key: address_id,
+                Allowances.contract_address.key: contract_address,
+                Allowances.spender.key: spender,
+                Allowances.allowance.key: allowance
+            })
+            stmt = stmt.on_conflict_do_update(index_elements=[Allowances.address_id.key,
+                                                              Allowances.contract_address.key,
+                                                              Allowances.spender.key], set_={
+                Allowances.allowance.key: stmt.excluded.allowance,
+                Allowances.updated_at.key: func.now()
+            })
+        try:
+            await self.session.execute(stmt)
+            if commit:
+                await self.session.commit()
+        except Exception as exc:
+            await self.session.rollback()
+            raise exc
+
     async def get_and_lock_unnotified_deposits(self, limit):
         subquery = (
             select(Deposits.id, Deposits.address_id, User.id.label("user_id"), Deposits.contract_address,
                    Coins.name.label("coin_name"), Coins.current_rate, Coins.decimal)
             .where(and_(
-                Deposits.locked_by_callback == False,  # Assuming 'locked_by_callback' is a Boolean column
+                Deposits.callback_lease_expires_at.is_(None),
                 Deposits.is_notified == False,
                 Deposits.time_to_callback < func.NOW()
             ))
@@ -231,7 +529,7 @@ class DB(object):
             .join(User, User.id == UserAddress.user_id)
             .join(Coins, Coins.contract_address == Deposits.contract_address)
             .limit(limit)
-            .with_for_update()
+            .with_for_update(skip_locked=True, of=Deposits)
         )
 
         columns = [Deposits.id.label("deposit_id"),
@@ -249,7 +547,7 @@ class DB(object):
         # Define the main query
         stmt = (
             update(Deposits)
-            .values(locked_by_callback=True)
+            .values(callback_lease_expires_at=lease_until(), callback_replica=Cfg.replica_id)
             .where(Deposits.id == subquery.c.id)
             .returning(*columns)
         )
@@ -272,12 +570,12 @@ class DB(object):
             .join(Coins, Coins.contract_address == Withdrawals.contract_address)
             .where(and_(
                 Withdrawals.tx_hash_out != None,  # Assuming 'tx_hash_out' is not nullable
-                Withdrawals.locked_by_callback == False,  # Assuming 'locked_by_callback' is a Boolean column
+                Withdrawals.callback_lease_expires_at.is_(None),
                 Withdrawals.is_notified == False,
                 Withdrawals.time_to_callback < func.NOW()
             ))
             .limit(limit)
-            .with_for_update()
+            .with_for_update(skip_locked=True, of=Withdrawals)
         )
 
         columns = [Withdrawals.id.label("withdrawal_id"),
@@ -295,7 +593,7 @@ class DB(object):
 
         stmt = (
             update(Withdrawals)
-            .values(locked_by_callback=True)
+            .values(callback_lease_expires_at=lease_until(), callback_replica=Cfg.replica_id)
             .where(Withdrawals.id == subquery.c.id)
             .returning(*columns)
         )
@@ -309,7 +607,56 @@ class DB(object):
             await self.session.rollback()
             raise exc
 
-    async def get_and_lock_pending_deposits_native(self, limit):
+    @staticmethod
+    def _pending_sweeps_condition(native: bool):
+        return and_(
+            Deposits.contract_address == St.native.v if native else Deposits.contract_address != St.native.v,
+            Deposits.tx_hash_out.is_(None),
+            Deposits.tx_handler_lease_expires_at.is_(None),
+            Deposits.time_to_tx_handler < func.NOW()
+        )
+
+    def _sweep_groups(self, native: bool, min_quote_amount: Decimal, limit: int, *conditions):
+        """
+        (address_id, contract_address) of the limit most valuable groups of pending deposits which sum is worth
+        the sweep fee, limit counts groups so every pending deposit of a group is claimed and swept together
+        :param conditions: filters of the depositor UserAddress
+        """
+        return tuple_(Deposits.address_id, Deposits.contract_address).in_(
+            select(Deposits.address_id, Deposits.contract_address)
+            .join(UserAddress, UserAddress.id == Deposits.address_id)
+            .where(and_(self._pending_sweeps_condition(native), *conditions))
+            .group_by(Deposits.address_id, Deposits.contract_address)
+            .having(func.sum(Deposits.quote_amount) >= min_quote_amount)
+            .order_by(func.sum(Deposits.quote_amount).desc())
+            .limit(limit)
+            .correlate(None)
+        )
+
+    async def get_sweep_plan(self, native: bool, min_quote_amount: Decimal) -> List[dict]:
+        """
+        This function returns pending sweeps by value without locking them, for dry-run reports.
+        """
+        columns = [Deposits.address_id, Deposits.contract_address]
+        quote_amount = func.sum(Deposits.quote_amount).label("quote_amount")
+        amount = func.sum(Deposits.amount).label("amount")
+        deposits_count = func.count(Deposits.id).label("deposits_count")
+        stmt = (select(*columns, amount, quote_amount, deposits_count)
+                .where(self._pending_sweeps_condition(native))
+                .group_by(*columns)
+                .order_by(quote_amount.desc()))
+        resp = await self.session.execute(stmt)
+        return [{**array_to_dict(columns, row[:2]),
+                 "amount": row[2],
+                 "quote_amount": row[3],
+                 "deposits_count": row[4],
+                 "deferred": row[3] < min_quote_amount} for row in resp.fetchall()]
+
+    async def get_and_lock_pending_deposits_native(self, limit, min_quote_amount: Decimal = 0):
+        """
+        Claims all pending deposits of the limit most valuable (address_id, contract_address) groups,
+        deposits of addresses which sum is below min_quote_amount wait.
+        """
         user = aliased(UserAddress)
         admin = aliased(UserAddress)
 
@@ -317,18 +664,18 @@ class DB(object):
                            user.private.label('user_private'),
                            admin.public.label('admin_public'),
                            ).where(and_(
-            Deposits.contract_address == St.native.v,
-            Deposits.tx_hash_out.is_(None),
-            Deposits.locked_by_tx_handler == False,
-            Deposits.time_to_tx_handler < func.NOW()
+            self._pending_sweeps_condition(native=True),
+            self._sweep_groups(True, min_quote_amount, limit,
+                               in_replica_shard(func.coalesce(UserAddress.approve_id, UserAddress.user_id)))
         )
-        ).limit(limit).with_for_update()
+        ).with_for_update(skip_locked=True, of=Deposits)
                     .join(user, user.id == Deposits.address_id)
                     .join(admin, user.admin_id == admin.user_id)
                     )
 
         columns = [
             Deposits.id.label("deposit_id"),
+            Deposits.address_id,
             Deposits.amount,
             subquery.c.user_private,
             subquery.c.admin_public,
@@ -336,7 +683,7 @@ class DB(object):
         ]
         stmt = (
             update(Deposits)
-            .values(locked_by_tx_handler=True)
+            .values(tx_handler_lease_expires_at=lease_until(), tx_handler_replica=Cfg.replica_id)
             .where(and_(
                 Deposits.id == subquery.c.id
             ))
@@ -354,7 +701,12 @@ class DB(object):
             await self.session.rollback()
             raise exc
 
-    async def get_and_lock_pending_deposits_coin(self, limit, admin_balance_threshold:int):
+    async def get_and_lock_pending_deposits_coin(self, limit, admin_balance_threshold: int,
+                                                 min_quote_amount: Decimal = 0):
+        """
+        Claims all pending deposits of the limit most valuable (address_id, contract_address) groups,
+        deposits of addresses which sum is below min_quote_amount wait.
+        """
         user = aliased(UserAddress)
         admin = aliased(UserAddress)
 
@@ -378,18 +730,19 @@ class DB(object):
                            subquery_approve.c.approve_id,
                            subquery_approve.c.approve_public,
                            subquery_approve.c.approve_private).where(and_(
-            Deposits.contract_address != St.native.v,
-            Deposits.tx_hash_out.is_(None),
-            Deposits.locked_by_tx_handler == False,
-            Deposits.time_to_tx_handler < func.NOW(),
+            self._pending_sweeps_condition(native=False),
+            self._sweep_groups(False, min_quote_amount, limit,
+                               UserAddress.approve_id.in_(select(subquery_approve.c.approve_id)),
+                               in_replica_shard(UserAddress.approve_id)),
             user.approve_id == subquery_approve.c.approve_id
         )
-        ).limit(limit).with_for_update()
+        ).with_for_update(skip_locked=True, of=Deposits)
                     .join(user, user.id == Deposits.address_id)
                     .join(admin, user.admin_id == admin.user_id)
                     )
 
         columns = [
+            subquery.c.address_id,
             subquery.c.contract_address,
             subquery.c.user_public,
             subquery.c.user_private,
@@ -404,7 +757,7 @@ class DB(object):
 
         stmt = (
             update(Deposits)
-            .values(locked_by_tx_handler=True)
+            .values(tx_handler_lease_expires_at=lease_until(), tx_handler_replica=Cfg.replica_id)
             .where(and_(
                 Deposits.id == subquery.c.id
             ))
@@ -422,58 +775,114 @@ class DB(object):
             await self.session.rollback()
             raise exc
 
-    async def get_and_lock_pending_withdrawals(self, limit=10):
-        subquery = (
-            select(UserAddress.user_id, UserAddress.id.label("admin_addr_id"), UserAddress.private.label("admin_private"), Balances.balance, Balances.coin_id)
-            .join(User, User.id == UserAddress.user_id)
-            .where(and_(
-                UserAddress.locked_by_tx == False,  # Assuming 'locked_by_tx' is a Boolean column
-                User.role == St.SADMIN.v,
-            ))
-            .join(Balances, Balances.address_id == UserAddress.id)
-            .limit(limit)
-            .with_for_update()
-        )
+    async def get_hot_wallets(self) -> List[dict]:
+        """
+        This function returns SADMIN addresses of the replica shard with their balances and withdrawals in flight.
+        :return: [{"admin_addr_id": 1, "admin_public": "0x..", "admin_private": "0x..",
+                   "balances": {coin_id: balance}, "reserved": {coin_id: amount in flight}, "queue": 0}, ...]
+        """
+        stmt = (select(UserAddress.id, UserAddress.public, UserAddress.private, Balances.coin_id, Balances.balance)
+                .join(User, User.id == UserAddress.user_id)
+                .outerjoin(Balances, Balances.address_id == UserAddress.id)
+                .where(and_(User.role == St.SADMIN.v, in_replica_shard(cast(UserAddress.id, String)))))
+        resp = await self.session.execute(stmt)
+        wallets = {}
+        for addr_id, public, private, coin_id, balance in resp.fetchall():
+            wallet = wallets.setdefault(addr_id, {"admin_addr_id": addr_id, "admin_public": public,
+                                                  "admin_private": private, "balances": {}, "reserved": {},
+                                                  "queue": 0})
+            if coin_id is not None:
+                wallet["balances"][coin_id] = balance
+
+        stmt = (select(Withdrawals.admin_addr_id, Withdrawals.contract_address, func.sum(Withdrawals.amount),
+                       func.count(Withdrawals.id))
+                .where(and_(Withdrawals.admin_addr_id.is_not(None), Withdrawals.tx_hash_out.is_(None)))
+                .group_by(Withdrawals.admin_addr_id, Withdrawals.contract_address))
+        resp = await self.session.execute(stmt)
+        for addr_id, contract_address, amount, count in resp.fetchall():
+            if addr_id in wallets:
+                wallets[addr_id]["reserved"][contract_address] = amount
+                wallets[addr_id]["queue"] += count
+        return list(wallets.values())
 
+    async def get_and_lock_unassigned_withdrawals(self, limit: int) -> List[dict]:
+        """
+        This function locks pending withdrawals without hot wallet till the end of the transaction.
+        """
         columns = [
             Withdrawals.contract_address,
             Withdrawals.id.label("withdrawal_id"),
             Withdrawals.withdrawal_address,
             Withdrawals.amount,
-            Withdrawals.tx_handler_period,
-            subquery.c.admin_addr_id,
-            subquery.c.admin_private
+            Withdrawals.tx_handler_period
         ]
+        stmt = (select(*columns)
+                .where(and_(Withdrawals.tx_hash_out.is_(None),
+                            Withdrawals.admin_addr_id.is_(None),
+                            Withdrawals.time_to_tx_handler < func.NOW()))
+                .order_by(Withdrawals.created_at)
+                .limit(limit)
+                .with_for_update(skip_locked=True))
+        resp = await self.session.execute(stmt)
+        return [array_to_dict(columns, row) for row in resp.fetchall()]
 
-        # Define the main query
-        stmt = (
-            update(Withdrawals)
-            .values(admin_addr_id=subquery.c.admin_addr_id)
-            .where(and_(
-                Withdrawals.tx_hash_out.is_(None),
-                Withdrawals.admin_addr_id.is_(None),
-                Withdrawals.contract_address == subquery.c.coin_id,
-                Withdrawals.amount <= subquery.c.balance
-            ))
-            .returning(
-                *columns
-            )
-        )
+    async def assign_withdrawals(self, assignments: Dict[int, List[str]]):
+        """
+        :param assignments: {admin_addr_id: [withdrawal_id, ...]}
+        """
         try:
-            resp = await self.session.execute(stmt)
-            data = resp.fetchall()
+            for admin_addr_id, withdrawal_ids in assignments.items():
+                await self.update_withdrawals_by_ids(withdrawal_ids, {
+                    Withdrawals.admin_addr_id.key: admin_addr_id,
+                    Withdrawals.tx_handler_lease_expires_at.key: lease_until(),
+                    Withdrawals.tx_handler_replica.key: Cfg.replica_id})
             await self.session.commit()
-            return [array_to_dict(columns, row) for row in data]
         except Exception as exc:
             await self.session.rollback()
             raise exc
 
-    async def get_free_admin_acc(self):
-        stmt = select(UserAddress.id, UserAddress.public, UserAddress.private)
-        stmt = stmt.join(User, User.id == UserAddress.user_id)
-        stmt = stmt.where(and_(User.role == St.SADMIN.v, UserAddress.locked_by_tx == False))
-        resp = await self.session.execute(stmt)
-        return resp.scalar_one_or_none()
+    async def renew_leases(self, lease: Column, owner: Column, ids: List[str]):
+        """
+        This function extends leases of rows still held by this replica, rows taken over after expiry are skipped.
+        :param lease: tx_handler_lease_expires_at or callback_lease_expires_at of Deposits or Withdrawals
+        :param owner: replica column of the same claim
+        """
+        model = lease.class_
+        stmt = (update(model)
+                .where(and_(model.id.in_(ids), owner == Cfg.replica_id, lease.is_not(None)))
+                .values({lease.key: lease_until()}))
+        try:
+            await self.session.execute(stmt, execution_options={"synchronize_session": False})
+            await self.session.commit()
+        except Exception as exc:
+            await self.session.rollback()
+            raise exc
+
+    async def release_expired_leases(self) -> Dict[str, List[str]]:
+        """
+        This function returns rows of crashed replicas to their queues. Expired payments of withdrawals keep
+        their hot wallet, the transaction may be sent already, they only lose the lease and are reported once.
+        :return: {claim name: [row id, ...]}
+        """
+        claims = {"sweeps": Deposits.tx_handler_lease_expires_at,
+                  "deposit_callbacks": Deposits.callback_lease_expires_at,
+                  "withdrawal_callbacks": Withdrawals.callback_lease_expires_at,
+                  "withdrawal_payments": Withdrawals.tx_handler_lease_expires_at}
+        released = {}
+        try:
+            for name, lease in claims.items():
+                model = lease.class_
+                stmt = (update(model)
+                        .where(lease < func.now())
+                        .values({lease.key: None})
+                        .returning(model.id))
+                resp = await self.session.execute(stmt, execution_options={"synchronize_session": False})
+                released[name] = resp.scalars().all()
+            await self.session.commit()
+        except Exception as exc:
+            await self.session.rollback()
+            raise exc
+        return released
 
     async def upsert_coins(self, coins: List[dict]) -> None:
         """
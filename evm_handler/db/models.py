@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Identity, NUMERIC, BOOLEAN, func, event, DDL, \
+from sqlalchemy import Column, Integer, String, ForeignKey, Identity, NUMERIC, BOOLEAN, func, DDL, \
     text, LargeBinary, UniqueConstraint, BIGINT, DateTime
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
@@ -77,8 +77,6 @@ class UserAddress(Base):
     public = Column(String(42), nullable=False, unique=True)
     private = Column(EncryptedData(128), nullable=False, unique=True)
 
-    locked_by_tx = Column(BOOLEAN, default=False)
-
     user = relationship("User", backref='_user_address', foreign_keys=[user_id])
     admin = relationship("User", backref='_admin_address', foreign_keys=[admin_id])
     approve = relationship("User", backref='_approve_address', foreign_keys=[approve_id])
@@ -103,6 +101,21 @@ class Balances(Base):
     __table_args__ = (UniqueConstraint('address_id', 'coin_id'),)
 
 
+class Allowances(Base):
+    # last known ERC20 allowance of user address for spender (approve address), refreshed on demand
+    __tablename__ = 'allowances'
+    id = Column(Integer, primary_key=True)
+    address_id = Column(Integer, ForeignKey('user_address.id', ondelete='CASCADE'), nullable=False, unique=False)
+    contract_address = Column(String(42), ForeignKey('coins.contract_address', ondelete='CASCADE'), nullable=False,
+                              unique=False)
+    spender = Column(String(42), nullable=False)
+
+    allowance = Column(NUMERIC(36, 18), nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False, default=func.now(), onupdate=func.now())
+
+    __table_args__ = (UniqueConstraint('address_id', 'contract_address', 'spender'),)
+
+
 class Deposits(Base):
     __tablename__ = "deposits"
     id = Column(String(36), primary_key=True, server_default=text("uuid_generate_v4()"))
@@ -115,14 +128,17 @@ class Deposits(Base):
 
     time_to_callback = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.fromtimestamp(0))
     callback_period = Column(Integer, nullable=False, default=60)
-    locked_by_callback = Column(BOOLEAN, default=False)
+    # claimed by callback_replica until callback_lease_expires_at, free when it's null
+    callback_lease_expires_at = Column(DateTime(timezone=True), nullable=True, index=True)
+    callback_replica = Column(String(64), nullable=True)  # Config.replica_id of the last callback claim
     is_notified = Column(BOOLEAN, default=False)
 
     time_to_tx_handler = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.fromtimestamp(0))
     tx_handler_period = Column(Integer, nullable=False, default=60)
-    locked_by_tx_handler = Column(BOOLEAN,
-                                  default=False)  # показывает что этот депозит выполняется обработчиком транзакций
-    tx_hash_out = Column(String(66), nullable=True, unique=True)
+    # claimed by tx_handler_replica until tx_handler_lease_expires_at, free when it's null
+    tx_handler_lease_expires_at = Column(DateTime(timezone=True), nullable=True, index=True)
+    tx_handler_replica = Column(String(64), nullable=True)  # Config.replica_id of the last sweep claim
+    tx_hash_out = Column(String(66), nullable=True, index=True)  # shared by deposits swept together
 
     created_at = Column(DateTime(timezone=True), nullable=False, default=func.now())
     tx_hash_in = Column(String(66), nullable=False, unique=True)
@@ -142,17 +158,22 @@ class Withdrawals(Base):
 
     time_to_callback = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.fromtimestamp(0))
     callback_period = Column(Integer, nullable=False, default=60)
-    locked_by_callback = Column(BOOLEAN, default=False)
+    # claimed by callback_replica until callback_lease_expires_at, free when it's null
+    callback_lease_expires_at = Column(DateTime(timezone=True), nullable=True, index=True)
+    callback_replica = Column(String(64), nullable=True)  # Config.replica_id of the last callback claim
     is_notified = Column(BOOLEAN, default=False)
 
     time_to_tx_handler = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.fromtimestamp(0))
     tx_handler_period = Column(Integer, nullable=False, default=60)
+    # payment by admin_addr_id is leased to tx_handler_replica until tx_handler_lease_expires_at
+    tx_handler_lease_expires_at = Column(DateTime(timezone=True), nullable=True, index=True)
+    tx_handler_replica = Column(String(64), nullable=True)  # Config.replica_id of the last hot wallet assignment
 
     admin_addr_id = Column(Integer, ForeignKey('user_address.id', ondelete='CASCADE'), nullable=True,
                            unique=False)  # админский адрес на время обработки
     admin_addr = relationship("UserAddress", back_populates="_admin_withdrawal")
 
-    tx_hash_out = Column(String(66), nullable=True, unique=True)
+    tx_hash_out = Column(String(66), nullable=True, index=True)  # shared by withdrawals paid by one disperse
 
     created_at = Column(DateTime(timezone=True), nullable=False, default=func.now())
     withdrawal_address = Column(String(42), nullable=False)
@@ -161,25 +182,81 @@ class Withdrawals(Base):
     user_currency = Column(String(16), nullable=False)
 
 
-ddl_stmt1 = DDL("""
-create or replace function update_address_lock() RETURNS trigger AS $$
+# boolean locks stayed set forever after a crash, their state is moved to leases which the reaper releases
+lease_migration_ddl = DDL("""
+DO $$
 BEGIN
-  update user_address AS adm set locked_by_tx = NEW.locked_by_tx_handler from user_address AS uat where adm.user_id = uat.admin_id AND uat.id = NEW.address_id;
-  RETURN NEW;
-END;
-$$ LANGUAGE plpgsql; 
+  DROP TRIGGER IF EXISTS on_update_deposits ON deposits;
+  DROP FUNCTION IF EXISTS update_address_lock();
+  IF EXISTS (SELECT 1 FROM information_schema.columns
+             WHERE table_name = 'deposits' AND column_name = 'locked_by_tx_handler') THEN
+    UPDATE deposits SET tx_handler_lease_expires_at = now() WHERE locked_by_tx_handler AND tx_hash_out IS NULL;
+    UPDATE deposits SET callback_lease_expires_at = now() WHERE locked_by_callback;
+    UPDATE withdrawals SET callback_lease_expires_at = now() WHERE locked_by_callback;
+    UPDATE withdrawals SET tx_handler_lease_expires_at = now()
+      WHERE admin_addr_id IS NOT NULL AND tx_hash_out IS NULL;
+    ALTER TABLE deposits DROP COLUMN locked_by_tx_handler, DROP COLUMN locked_by_callback;
+    ALTER TABLE withdrawals DROP COLUMN locked_by_callback;
+  END IF;
+  -- set only by the dropped trigger, hot wallet selection counts withdrawals in flight instead
+  ALTER TABLE user_address DROP COLUMN IF EXISTS locked_by_tx;
+END $$;
 """)
 
-ddl_stmt2 = DDL("""     
-CREATE TRIGGER on_update_deposits
-  AFTER UPDATE of locked_by_tx_handler
-  ON deposits
-  FOR EACH ROW
-  EXECUTE PROCEDURE update_address_lock();
-""")
 
+DEPOSITS_CHANNEL = "deposits_queue"
+WITHDRAWALS_CHANNEL = "withdrawals_queue"
+COINS_CHANNEL = "coins_changed"
 
-@event.listens_for(Deposits.__table__, "after_create")
-def my_func1(target, connection, **kw):
-    connection.execute(ddl_stmt1)
-    connection.execute(ddl_stmt2)
+# queue workers LISTEN these channels instead of polling, duplicate notifications of one transaction are merged
+queue_notify_ddl = [
+    DDL("""
+CREATE OR REPLACE function notify_queue() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify(TG_ARGV[0], TG_OP);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""),
+    DDL(f"""
+CREATE OR REPLACE TRIGGER notify_deposits_insert
+  AFTER INSERT
+  ON deposits
+  FOR EACH ROW
+  EXECUTE PROCEDURE notify_queue('{DEPOSITS_CHANNEL}');
+"""),
+    DDL(f"""
+CREATE OR REPLACE TRIGGER notify_withdrawals_insert
+  AFTER INSERT
+  ON withdrawals
+  FOR EACH ROW
+  EXECUTE PROCEDURE notify_queue('{WITHDRAWALS_CHANNEL}');
+"""),
+    DDL(f"""
+CREATE OR REPLACE TRIGGER notify_withdrawals_sent
+  AFTER UPDATE of tx_hash_out
+  ON withdrawals
+  FOR EACH ROW
+  WHEN (OLD.tx_hash_out IS NULL AND NEW.tx_hash_out IS NOT NULL)
+  EXECUTE PROCEDURE notify_queue('{WITHDRAWALS_CHANNEL}');
+"""),
+]
+
+# processes holding CoinRegistry LISTEN it and reload coins, updates which change nothing don't notify
+coins_notify_ddl = [
+    DDL(f"""
+CREATE OR REPLACE TRIGGER notify_coins_insert
+  AFTER INSERT
+  ON coins
+  FOR EACH ROW
+  EXECUTE PROCEDURE notify_queue('{COINS_CHANNEL}');
+"""),
+    DDL(f"""
+CREATE OR REPLACE TRIGGER notify_coins_update
+  AFTER UPDATE
+  ON coins
+  FOR EACH ROW
+  WHEN (OLD.* IS DISTINCT FROM NEW.*)
+  EXECUTE PROCEDURE notify_queue('{COINS_CHANNEL}');
+"""),
+]
@@ -4,10 +4,12 @@ from logging.handlers import RotatingFileHandler
 from pathlib import Path
 import asyncio
 from decimal import Decimal
-from typing import Dict
+from typing import Dict, List, Union
 
-from config import Config as Cfg
+from config import Config as Cfg, StatCode as St
+from db.models import Coins
 import api
+from web3_client.fees import FeeEngine
 
 
 def get_round_for_rate(rate: Decimal, quote_asset_precision=Decimal(0.01)) -> Decimal:
@@ -59,6 +61,45 @@ class AsyncPool(asyncio.Queue):
             self.put_nowait(item)
 
 
+
+class CoinRegistry:
+    """
+    Coins table kept in memory, so block parsing and API requests don't query it.
+    It's reloaded only after coins change, by update_coin_rates in tx_handler and on NOTIFY of the coins triggers
+    in the API workers.
+    """
+    columns = [Coins.contract_address, Coins.name, Coins.decimal, Coins.min_amount, Coins.fee_amount,
+               Coins.current_rate, Coins.is_active]
+
+    def __init__(self):
+        self.coins: Dict[str, dict] = {}  # {contract_address: coin}
+        self.tokens_low_case: Dict[str, dict] = {}  # {contract_address.lower(): coin}, native coin excluded
+        self.native: Union[dict, None] = None
+
+    def load(self, coins: List[dict]):
+        """
+        :param coins: rows of db.get_coins(CoinRegistry.columns), each coin gets "scale" = 10 ** decimal
+        """
+        coins = {coin[Coins.contract_address.key]: {**coin, "scale": 10 ** coin[Coins.decimal.key]}
+                 for coin in coins}
+        self.tokens_low_case = {contract_address.lower(): coin for contract_address, coin in coins.items()
+                                if contract_address != St.native.v}
+        self.native = coins.get(St.native.v)
+        self.coins = coins
+
+    @staticmethod
+    def quote_amount(coin: dict, amount: int) -> Decimal:
+        return Decimal(amount / coin["scale"]) * coin[Coins.current_rate.key]
+
+    def to_json(self, columns: list) -> Dict[str, dict]:
+        """
+        :return: {contract_address: {column_key: value, ...}}, decimals as strings
+        """
+        return {contract_address: {col.key: str(coin[col.key]) if isinstance(coin[col.key], Decimal)
+                                   else coin[col.key] for col in columns}
+                for contract_address, coin in self.coins.items()}
+
+
 class SharedVariables:
     def __init__(self):
         self.last_handled_block = None
@@ -70,13 +111,23 @@ class SharedVariables:
         self.handler_accounts_low_case: Dict[str, str] = {}
 
         self.user_accounts_event = asyncio.Event()
+        self.accounts_lock = asyncio.Lock()  # incremental refresh and full resync don't interleave
+        self.accounts_watermark = 0  # the highest user_address.id loaded into the maps above
 
+        # limits concurrent RPC jobs, the http clients behind these creds are shared and kept alive
         self.api_keys_pool = AsyncPool()
         self.api_keys_pool.put_all([(Cfg.grpc_server, Cfg.network_id)] * 10)
         self.coins_abi: Dict[str, Dict] = {}
+        self.coins = CoinRegistry()  # loaded at startup, reloaded by update_coin_rates
+
+        # fed by update_fees once per block, senders call fees.quote() instead of asking the node
+        self.fees = FeeEngine(tip_percentile=Cfg.fee_tip_percentile,
+                              history_blocks=Cfg.fee_history_blocks,
+                              base_fee_multiplier=Cfg.base_fee_multiplier,
+                              min_priority_fee=Cfg.min_priority_fee)
 
-        self.gas_price_event = asyncio.Event()
-        self.gas_price = 0
+        self.new_head_event = asyncio.Event()  # set by newHeads subscription, wakes block_parser
+        self.latest_head: int = None
 
 
 startup_logger = get_logger("startup_logger")
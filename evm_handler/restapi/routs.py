@@ -6,16 +6,49 @@ from fastapi import Response, Request
 from decimal import Decimal
 from fastapi import FastAPI
 from typing import List, Dict, Union
+from contextlib import asynccontextmanager
+import asyncio
 
-from db.database import DB, write_async_session, read_async_session
-from db.models import Coins, User
+from db.database import DB, write_async_session, read_async_session, QueueListener
+from db.models import Coins, User, COINS_CHANNEL
 from config import Config as Cfg, StatCode as St
-from misc import get_logger, quote_amount_to_amount, get_round_for_rate, amount_to_display, amount_to_quote_amount
+from misc import get_logger, quote_amount_to_amount, get_round_for_rate, amount_to_display, amount_to_quote_amount, \
+    CoinRegistry
 from web3_client import utils
 
-app = FastAPI()
 bd_logger = get_logger("restapi_bd_logger")
 route_logger = get_logger("route_logger")
+coin_registry = CoinRegistry()  # per worker, reloaded on NOTIFY of the coins triggers
+
+
+async def load_coin_registry():
+    async with write_async_session() as session:  # not the replica, it may lag behind the notification
+        db = DB(session, bd_logger)
+        coin_registry.load(await db.get_coins(CoinRegistry.columns))
+
+
+async def coins_watcher(event: asyncio.Event):
+    while True:
+        await event.wait()
+        event.clear()
+        try:
+            await load_coin_registry()
+        except Exception as exc:
+            bd_logger.error(f"coins reload failed {exc}")
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    await load_coin_registry()
+    queue_listener = QueueListener(Cfg.WRITE_DSN, Cfg.listen_reconnect_interval)
+    background_tasks = [asyncio.create_task(coins_watcher(queue_listener.subscribe(COINS_CHANNEL))),
+                        asyncio.create_task(queue_listener.run(bd_logger))]
+    yield
+    for task in background_tasks:
+        task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 def json_success_response(data: Union[dict, list], status_code: int) -> Response:
@@ -50,20 +83,9 @@ async def get_handled_blocks(request: Request):
 @app.get("/get_handler_info")
 async def get_handler_info(request: Request):
     if request.headers.get("Api-Key") == Cfg.PROC_HANDLER_API_KEY:
-        async with read_async_session() as session:
-            db = DB(session, route_logger)
-            resp = await db.get_coins([Coins.contract_address,
-                                       Coins.name,
-                                       Coins.decimal,
-                                       Coins.min_amount,
-                                       Coins.is_active], for_json=True)
-            coins = {}
-            min_amount: Decimal
-            for coin in resp:
-                contract_address = coin.pop(Coins.contract_address.key)
-                coins[contract_address] = coin
-            output_data = {"name": Cfg.PROC_HANDLER_NAME, "display_name": Cfg.PROC_HANDLER_DISPLAY, "coins": coins}
-            return json_success_response(output_data, 200)
+        coins = coin_registry.to_json([Coins.name, Coins.decimal, Coins.min_amount, Coins.is_active])
+        output_data = {"name": Cfg.PROC_HANDLER_NAME, "display_name": Cfg.PROC_HANDLER_DISPLAY, "coins": coins}
+        return json_success_response(output_data, 200)
     else:
         return json_error_response("Wrong Api-Key", 401)
 
@@ -122,17 +144,9 @@ async def get_withdraw_info(request: Request):
                 db = DB(session, route_logger)
                 user = await db.get_user_by_id(user_id, [User.id])
                 if user:
-                    resp = await db.get_coins([Coins.contract_address,
-                                               Coins.name,
-                                               Coins.decimal,
-                                               Coins.current_rate,
-                                               Coins.min_amount,
-                                               Coins.fee_amount,
-                                               ])
                     coins = {"name": Cfg.PROC_HANDLER_NAME, "display_name": Cfg.PROC_HANDLER_DISPLAY, "coins": {}}
 
-                    for coin in resp:
-                        contract_address = coin.pop(Coins.contract_address.key)
+                    for contract_address, coin in coin_registry.coins.items():
                         rounding: Decimal = get_round_for_rate(coin[Coins.current_rate.key])
                         estimated_amount = quote_amount_to_amount(quote_amount,
                                                                   coin[Coins.current_rate.key],
@@ -174,16 +188,7 @@ async def get_deposit_info(request: Request):
                 db = DB(session, route_logger)
                 address = await db.get_user_deposit_info(user_id)
                 if address:
-                    resp = await db.get_coins([Coins.contract_address,
-                                               Coins.name,
-                                               Coins.decimal,
-                                               Coins.min_amount,
-                                               Coins.is_active], for_json=True)
-                    coins = {}
-                    min_amount: Decimal
-                    for coin in resp:
-                        contract_address = coin.pop(Coins.contract_address.key)
-                        coins[contract_address] = coin
+                    coins = coin_registry.to_json([Coins.name, Coins.decimal, Coins.min_amount, Coins.is_active])
                     output_data = {"address": address, "display_name": Cfg.PROC_HANDLER_DISPLAY, "coins": coins}
                     return json_success_response(output_data, 200)
                 else:
@@ -1,20 +1,26 @@
 # -*- coding: utf-8 -*-
 # Description: This module contains the main logic of the ERC20 parser and the native coin.
 
-from misc import get_logger, SharedVariables, amount_to_quote_amount, \
+from misc import get_logger, SharedVariables, CoinRegistry, \
     get_round_for_rate, amount_to_display, proc_api_client
 import asyncio
 import logging
+import signal
+from collections import deque
 from typing import List, Tuple, Dict, Any, Union
 from decimal import Decimal
 import eth_utils
 import eth_abi
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from datetime import datetime, timedelta, timezone
-
-from web3_client import async_client, utils as web3_utils
-from db.database import DB, write_async_session, read_async_session, UserAddress, Withdrawals
-from db.models import Deposits, Coins
+from contextlib import asynccontextmanager
+from sqlalchemy import Column
+
+from web3_client import async_client, providers, utils as web3_utils
+from web3_client.confirmation_tracker import confirmation_tracker
+from db.database import DB, write_async_session, read_async_session, Withdrawals, QueueListener, \
+    engine, read_engine, write_pool_stats, read_pool_stats
+from db.models import Deposits, Coins, DEPOSITS_CHANNEL, WITHDRAWALS_CHANNEL
 from config import Config as Cfg, StatCode as St
 import api
 
@@ -27,60 +33,124 @@ async def coin_transfer_to_admin(conn_creds,
                                  approve_id,
                                  approve_public,
                                  approve_private,
-                                 deposit_id,
+                                 deposit_ids,
                                  amount,
-                                 tx_handler_period) -> tuple[None, Exception, tuple[Any, Any, Any], Any] | tuple[
-    Any, None, tuple[Any, Any, Any], Any]:
+                                 tx_handler_period,
+                                 allowance=None,
+                                 error=None,
+                                 **_) -> tuple[None, Exception, tuple[Any, Any, Any, Any], Any] | tuple[
+    Any, None, tuple[Any, Any, Any, Any], Any]:
+    """
+    This function sweeps coins with transfer_from, approving approve_public first if needed.
+    Allowance and gas for approve are prepared by prepare_approvals.
+    :param error: prepare_approvals failure, the sweep is rescheduled
+    :return: req_ident with allowance left after the sweep or None if it's unknown
+    """
     amount = int(amount)
+    if error:
+        return None, error, (deposit_ids, tx_handler_period, approve_id, allowance), conn_creds
+
     async with async_client.AsyncEth(*conn_creds) as client:
         contract = async_client.ERC20(client, contract_address, abi_info=web3_utils.erc20_abi)
+        allowance = int(allowance)
+        if allowance < amount:
+            try:
+                fee = await variables.fees.quote()
+                await contract.approve(approve_public, Cfg.approve_amount, user_private,
+                                       fee=fee)
+            except Exception as exc:
+                return None, exc, (deposit_ids, tx_handler_period, approve_id, None), conn_creds
+            else:
+                allowance = Cfg.approve_amount
+
         try:
-            allowance = await contract.allowance(user_public, approve_public)
+            fee = await variables.fees.quote()
+            res = await contract.transfer_from(user_public,
+                                               admin_public,
+                                               amount,
+                                               approve_private,
+                                               fee=fee)
         except Exception as exc:
-            return None, exc, (deposit_id, tx_handler_period, approve_id), conn_creds
+            return None, exc, (deposit_ids, tx_handler_period, approve_id, None), conn_creds
         else:
-            if allowance < amount:
-                try:
-                    await variables.gas_price_event.wait()
-                    await client.send_ether(user_public,
-                                            int(100000 * variables.gas_price * 1.3),
-                                            approve_private,
-                                            gas_price=variables.gas_price,
-                                            gas=21000)
-
-                except Exception as exc:
-                    return None, exc, (deposit_id, tx_handler_period, approve_id), conn_creds
-                else:
-                    try:
-                        await variables.gas_price_event.wait()
-                        await contract.approve(approve_public, 9_999_999_999_999_999, user_private,
-                                               gas_price=variables.gas_price)
-                    except Exception as exc:
-                        return None, exc, (deposit_id, tx_handler_period, approve_id), conn_creds
-                    else:
-                        try:
-                            await variables.gas_price_event.wait()
-                            res = await contract.transfer_from(user_public,
-                                                               admin_public,
-                                                               amount,
-                                                               approve_private,
-                                                               gas_price=variables.gas_price)
-                        except Exception as exc:
-                            return None, exc, (deposit_id, tx_handler_period, approve_id), conn_creds
-                        else:
-                            return res, None, (deposit_id, tx_handler_period, approve_id), conn_creds
+            return res, None, (deposit_ids, tx_handler_period, approve_id, allowance - amount), conn_creds
+
+
+async def request_allowances(conn_creds, sweeps: List[Dict[str, Any]]):
+    try:
+        async with async_client.AsyncEth(*conn_creds) as client:
+            res = await client.call_contracts([(async_client.ERC20(client, sweep[Deposits.contract_address.key]),
+                                                "allowance",
+                                                (sweep["user_public"], sweep["approve_public"]))
+                                               for sweep in sweeps])
+    except Exception as exc:
+        return None, exc, conn_creds
+    else:
+        return res, None, conn_creds
+
+
+async def fund_gas(conn_creds, signer_private: str, recipients: List[str], amount: int):
+    """
+    This function sends amount of native coin to every recipient with one disperseEther transaction
+    or, if Cfg.disperse_address isn't set, with plain transfers pipelined by nonce.
+    :return: exception or None for every recipient
+    """
+    try:
+        async with async_client.AsyncEth(*conn_creds) as client:
+            fee = await variables.fees.quote()
+            if Cfg.disperse_address:
+                contract = async_client.Disperse(client, Cfg.disperse_address)
+                await contract.disperse_ether(recipients, [amount] * len(recipients), signer_private, fee,
+                                              gas=Cfg.disperse_gas + Cfg.disperse_ether_gas * len(recipients))
+                res = [None] * len(recipients)
             else:
-                try:
-                    await variables.gas_price_event.wait()
-                    res = await contract.transfer_from(user_public,
-                                                       admin_public,
-                                                       amount,
-                                                       approve_private,
-                                                       gas_price=variables.gas_price)
-                except Exception as exc:
-                    return None, exc, (deposit_id, tx_handler_period, approve_id), conn_creds
-                else:
-                    return res, None, (deposit_id, tx_handler_period, approve_id), conn_creds
+                results = await asyncio.gather(*[client.send_ether(recipient, amount, signer_private, fee=fee,
+                                                                   gas=21000)
+                                                 for recipient in recipients], return_exceptions=True)
+                res = [x if isinstance(x, Exception) else None for x in results]
+    except Exception as exc:
+        return None, exc, conn_creds
+    else:
+        return res, None, conn_creds
+
+
+async def prepare_approvals(sweeps: List[Dict[str, Any]]):
+    """
+    This function refreshes allowances which don't cover the sweep amount with one batch
+    and funds gas for approve of every user address that needs it, one funding transaction per approve address.
+    Sweeps that can't be approved get "error".
+    """
+    stale = [sweep for sweep in sweeps if sweep["allowance"] is None or sweep["allowance"] < int(sweep["amount"])]
+    if not stale:
+        return
+
+    conn_creds: List[Tuple[str, str]] = await variables.api_keys_pool.get()
+    try:
+        allowances, err, conn_creds = await request_allowances(conn_creds, stale)
+        for sweep, allowance in zip(stale, allowances or [err] * len(stale)):
+            if isinstance(allowance, Exception):
+                sweep["error"] = allowance
+            else:
+                sweep["allowance"] = allowance[0]
+
+        unapproved: Dict[str, List[Dict[str, Any]]] = {}  # {approve_private: sweeps}
+        for sweep in stale:
+            if not sweep.get("error") and sweep["allowance"] < int(sweep["amount"]):
+                unapproved.setdefault(sweep["approve_private"], []).append(sweep)
+        if not unapproved:
+            return
+
+        fee = await variables.fees.quote()
+        gas_amount = int(fee.max_cost(100000) * 1.3)
+        results = await asyncio.gather(*[fund_gas(conn_creds, approve_private,
+                                                  [sweep["user_public"] for sweep in group], gas_amount)
+                                         for approve_private, group in unapproved.items()])
+        for group, (res, err, _) in zip(unapproved.values(), results):
+            for sweep, recipient_err in zip(group, res or [err] * len(group)):
+                if recipient_err:
+                    sweep["error"] = recipient_err
+    finally:
+        await variables.api_keys_pool.put(conn_creds)
 
 
 async def withdraw_coin(conn_creds,
@@ -97,8 +167,8 @@ async def withdraw_coin(conn_creds,
     try:
         async with async_client.AsyncEth(*conn_creds) as client:
             contract = async_client.ERC20(client, contract_address, abi_info=web3_utils.erc20_abi)
-            await variables.gas_price_event.wait()
-            res = await contract.transfer(withdrawal_address, amount, admin_private, gas_price=variables.gas_price)
+            fee = await variables.fees.quote()
+            res = await contract.transfer(withdrawal_address, amount, admin_private, fee=fee)
     except Exception as exc:
         return None, exc, (withdrawal_id, tx_handler_period, admin_addr_id), conn_creds
     else:
@@ -117,11 +187,11 @@ async def withdraw_native(conn_creds,
     amount = int(amount)
     try:
         async with async_client.AsyncEth(*conn_creds) as client:
-            await variables.gas_price_event.wait()
+            fee = await variables.fees.quote()
             res = await client.send_ether(withdrawal_address,
                                           amount,
                                           admin_private,
-                                          gas_price=variables.gas_price,
+                                          fee=fee,
                                           gas=21000)
     except Exception as exc:
         return None, exc, (withdrawal_id, tx_handler_period, admin_addr_id), conn_creds
@@ -129,6 +199,68 @@ async def withdraw_native(conn_creds,
         return res, None, (withdrawal_id, tx_handler_period, admin_addr_id), conn_creds
 
 
+async def withdraw_batch(conn_creds,
+                         contract_address: str,
+                         admin_addr_id,
+                         admin_public: str,
+                         admin_private: str,
+                         withdrawals: List[Dict[str, Any]],
+                         allowance=None):
+    """
+    This function pays withdrawals of one coin from one admin address with a single disperse transaction.
+    Coins are dispersed with transferFrom, so the admin address approves the disperse contract when needed.
+    :param allowance: allowance of admin address for the disperse contract recorded in DB
+    :return: req_ident with allowance left after the batch or None if it's unknown
+    """
+    withdrawal_ids = [withdrawal["withdrawal_id"] for withdrawal in withdrawals]
+    tx_handler_period = max(withdrawal["tx_handler_period"] for withdrawal in withdrawals)
+    recipients = [withdrawal[Withdrawals.withdrawal_address.key] for withdrawal in withdrawals]
+    amounts = [int(withdrawal[Withdrawals.amount.key]) for withdrawal in withdrawals]
+    total = sum(amounts)
+    try:
+        async with async_client.AsyncEth(*conn_creds) as client:
+            contract = async_client.Disperse(client, Cfg.disperse_address)
+            if contract_address == St.native.v:
+                fee = await variables.fees.quote()
+                res = await contract.disperse_ether(recipients, amounts, admin_private, fee,
+                                                    gas=Cfg.disperse_gas + Cfg.disperse_ether_gas * len(recipients))
+            else:
+                coin = async_client.ERC20(client, contract_address)
+                if allowance is None or allowance < total:
+                    allowance = await coin.allowance(admin_public, contract.contract_address)
+                if allowance < total:
+                    fee = await variables.fees.quote()
+                    await coin.approve(contract.contract_address, Cfg.approve_amount, admin_private, fee=fee)
+                    allowance = Cfg.approve_amount
+                fee = await variables.fees.quote()
+                res = await contract.disperse_token(contract_address, recipients, amounts, admin_private, fee,
+                                                    gas=Cfg.disperse_gas + Cfg.disperse_token_gas * len(recipients))
+                allowance = int(allowance) - total
+    except Exception as exc:
+        return None, exc, (withdrawal_ids, tx_handler_period, admin_addr_id, None), conn_creds
+    else:
+        return res, None, (withdrawal_ids, tx_handler_period, admin_addr_id, allowance), conn_creds
+
+
+def group_withdrawals(withdrawals: List[Dict[str, Any]]) -> Tuple[List[List[Dict[str, Any]]], List[Dict[str, Any]]]:
+    """
+    This function groups claimed withdrawals by admin address and coin, while their sum is covered by admin balance.
+    :return: groups, withdrawals that don't fit the balance
+    """
+    groups: Dict[Tuple[int, str], List[Dict[str, Any]]] = {}
+    totals: Dict[Tuple[int, str], Decimal] = {}
+    leftovers = []
+    for withdrawal in withdrawals:
+        key = (withdrawal["admin_addr_id"], withdrawal[Withdrawals.contract_address.key])
+        total = totals.get(key, Decimal(0)) + withdrawal[Withdrawals.amount.key]
+        if total <= withdrawal["balance"]:
+            totals[key] = total
+            groups.setdefault(key, []).append(withdrawal)
+        else:
+            leftovers.append(withdrawal)
+    return list(groups.values()), leftovers
+
+
 async def notify_deposit(display_amount: str,
                          deposit_id,
                          callback_period: int,
@@ -184,80 +316,79 @@ async def notify_withdrawal(display_amount: str,
         return resp, None, (withdrawal_id, callback_period)
 
 
-async def native_balance(conn_creds, addr_id, address):
-    try:
-        async with async_client.AsyncEth(*conn_creds) as client:
-            res: int = await client.get_account_balance(address)
-    except Exception as exc:
-        return None, exc, (addr_id, address, conn_creds)
-    else:
-        return res, None, (addr_id, address, conn_creds)
-
-
-async def trc20_balance(conn_creds, addr_id, contract_address, address: str):
+async def read_balances(conn_creds, requests: List[Tuple[str, Union[str, None]]]):
+    """
+    This function reads all balances with Multicall3, one eth_call per Cfg.multicall_chunk reads.
+    :param requests: [(address, contract_address or None for the native coin), ...]
+    """
     try:
         async with async_client.AsyncEth(*conn_creds) as client:
-            contract = async_client.ERC20(client, contract_address, abi_info=web3_utils.erc20_abi)
-            res = await contract.balance_of(address)
+            res: List[Union[int, Exception]] = await client.get_balances(requests, Cfg.multicall_address,
+                                                                         Cfg.multicall_chunk)
     except Exception as exc:
-        return None, exc, (addr_id, contract_address, conn_creds)
+        return None, exc, conn_creds
     else:
-        return res, None, (addr_id, contract_address, conn_creds)
+        return res, None, conn_creds
 
 
 async def admin_approve_native_bal(logger):
-    reqs = []
-    async with write_async_session() as session:
-        db = DB(session, logger)
-        users: List[Tuple[str, str]] = await db.users_addresses([St.SADMIN.v, St.APPROVE.v])
+    async with write_async_session() as session:  # the connection isn't held during balance and fee requests
+        users: List[Tuple[str, str]] = await DB(session, logger).users_addresses([St.SADMIN.v, St.APPROVE.v])
+    if not users:
+        return
 
-        if users:
-            for addr_id, address in users:
-                conn_creds: List[Tuple[str, str]] = await variables.api_keys_pool.get()
-                reqs.append(asyncio.create_task(native_balance(conn_creds, addr_id, address)))
-
-            results = await asyncio.gather(*reqs)
-
-            for balance, err, req_ident in results:
-                addr_id, address, conn_creds = req_ident
-                await variables.api_keys_pool.put(conn_creds)
-                if not err:
-                    if balance <= (variables.gas_price * 100000) * Cfg.native_warning_threshold:
-                        logger.warning(
-                            f"{addr_id} {address}: has balance {amount_to_display(balance, 18, Decimal('0.00001'))} "
-                            f"and can handle less then {Cfg.native_warning_threshold} transactions")
-                    await db.upsert_balance(addr_id, St.native.v, balance, commit=True)
-                else:
-                    logger.error(f"{addr_id}: {err}")
+    conn_creds: List[Tuple[str, str]] = await variables.api_keys_pool.get()
+    balances, err, conn_creds = await read_balances(conn_creds, [(address, None) for _, address in users])
+    await variables.api_keys_pool.put(conn_creds)
+
+    if err:
+        logger.error(err)
+        return
+
+    fee = await variables.fees.quote()
+    rows = []
+    for (addr_id, address), balance in zip(users, balances):
+        if not isinstance(balance, Exception):
+            if balance <= fee.max_cost(100000) * Cfg.native_warning_threshold:
+                logger.warning(
+                    f"{addr_id} {address}: has balance {amount_to_display(balance, 18, Decimal('0.00001'))} "
+                    f"and can handle less then {Cfg.native_warning_threshold} transactions")
+            rows.append((addr_id, St.native.v, balance))
+        else:
+            logger.error(f"{addr_id}: {balance}")
+    async with write_async_session() as session:
+        await DB(session, logger).upsert_balances(rows, commit=True)
 
 
 async def admin_coins_bal(logger):
-    reqs = []
     async with write_async_session() as session:
         db = DB(session, logger)
         users: List[Tuple[str, str]] = await db.users_addresses([St.SADMIN.v])
 
         if users:
-            coins = await db.get_coins([Coins.contract_address, Coins.name])
-            for addr_id, address in users:
-                for coin in coins:
-                    contract_address: str = coin[Coins.contract_address.key]
-                    if contract_address != St.native.v:
-                        conn_creds: List[Tuple[str, str]] = await variables.api_keys_pool.get()
-                        reqs.append(asyncio.create_task(trc20_balance(conn_creds,
-                                                                      addr_id,
-                                                                      contract_address,
-                                                                      address)))
-
-            results = await asyncio.gather(*reqs)
-
-            for balance, err, req_ident in results:
-                addr_id, contract_address, conn_creds = req_ident
-                await variables.api_keys_pool.put(conn_creds)
-                if not err:
-                    await db.upsert_balance(addr_id, contract_address, balance, commit=True)
+            contract_addresses = [coin[Coins.contract_address.key]
+                                  for coin in variables.coins.tokens_low_case.values()]
+            if not contract_addresses:
+                return
+
+            conn_creds: List[Tuple[str, str]] = await variables.api_keys_pool.get()
+            results, err, conn_creds = await read_balances(conn_creds, [(address, contract_address)
+                                                                        for _, address in users
+                                                                        for contract_address in contract_addresses])
+            await variables.api_keys_pool.put(conn_creds)
+
+            if err:
+                logger.error(err)
+                return
+
+            req_idents = [(addr_id, contract_address) for addr_id, _ in users for contract_address in contract_addresses]
+            rows = []
+            for (addr_id, contract_address), res in zip(req_idents, results):
+                if not isinstance(res, Exception):
+                    rows.append((addr_id, contract_address, res))
                 else:
-                    logger.error(f"{addr_id}: {err}")
+                    logger.error(f"{addr_id}: {res}")
+            await db.upsert_balances(rows, commit=True)
 
 
 async def update_in_memory_last_handled_block(logger: logging.Logger):
@@ -283,67 +414,109 @@ async def update_in_memory_last_handled_block(logger: logging.Logger):
         variables.last_handled_block = block
 
 
+async def load_coin_registry(logger: logging.Logger):
+    async with read_async_session() as session:
+        db = DB(session, logger)
+        variables.coins.load(await db.get_coins(CoinRegistry.columns))
+
+
 async def update_coin_rates(logger: logging.Logger):
+    """
+    This function writes rates which differ from the coin registry and reloads it if anything was written.
+    """
     rates, exceptions = await api.coin_rate_client.get_coin_rates()
     if exceptions:
         for exc in exceptions:
             logger.error(exc)
 
+    changed = False
     async with write_async_session() as session:
         db = DB(session, logger)
-        coins = await db.get_coins([Coins.contract_address, Coins.name, Coins.current_rate])
-
-        for coin in coins:
+        for contract_address, coin in variables.coins.coins.items():
             if coin[Coins.name.key] != Cfg.quote_coin:
                 symbol = f"{coin[Coins.name.key]}{Cfg.quote_coin}"
-                if rates.get(symbol):
-                    await db.update_coin(coin[Coins.contract_address.key], {Coins.current_rate.key: rates[symbol]},
-                                         commit=True)
-                else:
+                if not rates.get(symbol):
                     logger.error(f"No rate for {symbol}")
+                    continue
+                rate = Decimal(str(rates[symbol]))
             else:
-                if coin[Coins.current_rate.key] != 1:
-                    await db.update_coin(coin[Coins.contract_address.key], {Coins.current_rate.key: 1}, commit=True)
+                rate = Decimal(1)
+            if rate != coin[Coins.current_rate.key]:
+                await db.update_coin(contract_address, {Coins.current_rate.key: rate}, commit=True)
+                changed = True
+    if changed:
+        await load_coin_registry(logger)
 
 
-async def update_gas_price(logger: logging.Logger):
+async def update_fees(logger: logging.Logger):
+    """
+    This function feeds the fee engine with eth_feeHistory of the blocks mined since the previous call,
+    senders take fee quotes from memory.
+    """
     conn_creds: List[Tuple[str, str]] = await variables.api_keys_pool.get()
     try:
         async with async_client.AsyncEth(*conn_creds) as client:
-            gas_price = int((await client.gas_price()) * 1.5)
+            await variables.fees.update(client)
     except Exception as exc:
         logger.error(exc)
-    else:
-        variables.gas_price_event.clear()
-        variables.gas_price = gas_price
     finally:
-        variables.gas_price_event.set()
         await variables.api_keys_pool.put(conn_creds)
 
 
-async def update_in_memory_accounts(logger: logging.Logger):
+async def track_confirmations(conn_creds, logger: logging.Logger):
+    """
+    This function resolves receipts of all transactions broadcast by the process with one batch per new block.
+    It uses reserved conn_creds, because senders keep theirs from api_keys_pool until the receipt arrives.
     """
-    This function updates the user_accounts dictionary in the variables module.
+    if confirmation_tracker.pending:
+        try:
+            async with async_client.AsyncEth(*conn_creds) as client:
+                await confirmation_tracker.poll(client)
+        except Exception as exc:
+            logger.error(exc)
+
+
+async def update_in_memory_accounts(logger: logging.Logger, full: bool = False):
+    """
+    This function adds addresses inserted after variables.accounts_watermark to the in-memory account maps.
+    With full it reloads all addresses and replaces the maps, which also drops stale entries and role changes.
     :param logger: logging.Logger
+    :param full: reload all addresses instead of the new ones
     :return:
     """
-    try:
-        async with write_async_session() as session:
-            db = DB(session, logger)
-            users = await db.all_accounts()
-    except Exception as exc:
-        logger.error(exc)
-        raise
-    else:
-        variables.user_accounts_event.clear()
+    async with variables.accounts_lock:
+        after_id = None if full else variables.accounts_watermark - Cfg.accounts_refresh_overlap
+        try:
+            async with write_async_session() as session:
+                db = DB(session, logger)
+                users = await db.all_accounts(after_id)
+        except Exception as exc:
+            logger.error(exc)
+            variables.user_accounts_event.set()
+            raise
+
+        if full:
+            user_accounts, user_accounts_low_case, handler_accounts, handler_accounts_low_case = {}, {}, {}, {}
+        else:
+            user_accounts, user_accounts_low_case = variables.user_accounts, variables.user_accounts_low_case
+            handler_accounts, handler_accounts_low_case = \
+                variables.handler_accounts, variables.handler_accounts_low_case
         for address_id, user_address, role in users:
             if role == St.USER.v:
-                variables.user_accounts[user_address] = address_id
-                variables.user_accounts_low_case[user_address.lower()] = address_id
+                user_accounts[user_address] = address_id
+                user_accounts_low_case[user_address.lower()] = address_id
             else:
-                variables.handler_accounts[user_address] = address_id
-                variables.handler_accounts_low_case[user_address.lower()] = address_id
-    finally:
+                handler_accounts[user_address] = address_id
+                handler_accounts_low_case[user_address.lower()] = address_id
+
+        if full:
+            variables.user_accounts, variables.user_accounts_low_case = user_accounts, user_accounts_low_case
+            variables.handler_accounts, variables.handler_accounts_low_case = \
+                handler_accounts, handler_accounts_low_case
+            variables.accounts_watermark = users[-1][0] if users else 0
+            logger.info(f"full resync loaded {len(users)} addresses")
+        elif users:
+            variables.accounts_watermark = max(variables.accounts_watermark, users[-1][0])
         variables.user_accounts_event.set()
 
 
@@ -368,9 +541,7 @@ async def coins_txs_parser(transactions: List[dict],
                 coin = coins[unit["address"]]
 
                 if amount >= coin[Coins.min_amount.key]:
-                    quote_amount: Decimal = amount_to_quote_amount(amount,
-                                                                   coin[Coins.current_rate.key],
-                                                                   coin[Coins.decimal.key])
+                    quote_amount: Decimal = CoinRegistry.quote_amount(coin, amount)
                     deposits.append({
                         Deposits.address_id.key: address_id,
                         Deposits.amount.key: amount,
@@ -385,206 +556,531 @@ async def coins_txs_parser(transactions: List[dict],
 
 async def native_txs_parser(block: Dict, native_coin: dict, client: async_client.AsyncEth, logger: logging.Logger):
     deposits = []
+    candidates = []
     for unit in block.get("transactions", []):
         if unit["input"] == "0x":
             sender = unit["from"]
             recipient = unit["to"]
-            amount = int(unit["value"], 16)
             await variables.user_accounts_event.wait()
 
             if recipient in variables.user_accounts_low_case and sender not in variables.handler_accounts_low_case:
+                candidates.append(unit)
 
-                receipt = await client.get_transaction_receipt(unit["hash"])
-
-                if receipt["status"] == "0x1":
-                    if amount >= native_coin[Coins.min_amount.key]:
-                        address_id = variables.user_accounts_low_case[recipient]
-                        quote_amount: Decimal = amount_to_quote_amount(amount,
-                                                                       native_coin[Coins.current_rate.key],
-                                                                       native_coin[Coins.decimal.key])
-                        deposits.append({
-                            Deposits.address_id.key: address_id,
-                            Deposits.amount.key: amount,
-                            Deposits.contract_address.key: St.native.v,
-                            Deposits.tx_hash_in.key: unit['hash'],
-                            Deposits.quote_amount.key: quote_amount
-                        })
-                    else:
-                        logger.info(f"deposit less then minimum amount {unit['hash']}")
-                await asyncio.sleep(0.5)  # to avoid rate limit, TODO: upgrade rps plan
+    if candidates:
+        receipts = await client.get_receipts_map(block["number"], [unit["hash"] for unit in candidates])
+
+        for unit in candidates:
+            receipt = receipts.get(unit["hash"])
+            if receipt is None:
+                raise async_client.TransactionNotFound(unit["hash"])
+
+            if receipt["status"] == "0x1":
+                amount = int(unit["value"], 16)
+                if amount >= native_coin[Coins.min_amount.key]:
+                    address_id = variables.user_accounts_low_case[unit["to"]]
+                    quote_amount: Decimal = CoinRegistry.quote_amount(native_coin, amount)
+                    deposits.append({
+                        Deposits.address_id.key: address_id,
+                        Deposits.amount.key: amount,
+                        Deposits.contract_address.key: St.native.v,
+                        Deposits.tx_hash_in.key: unit['hash'],
+                        Deposits.quote_amount.key: quote_amount
+                    })
+                else:
+                    logger.info(f"deposit less then minimum amount {unit['hash']}")
     return deposits
 
 
-async def block_parser(conn_creds_1, conn_creds_2, logger: logging.Logger):
+async def transfer_logs_filters(from_block: int, to_block: int, coins: Dict[str, dict]) -> List[dict]:
+    """
+    This function builds eth_getLogs filters so the node returns only Transfer events of our coins
+    and, if Cfg.logs_filter_recipients is set, only those sent to our user addresses.
+    :param coins: key - contract_address string low, value - coin dict
+    :return: List[dict]
+    """
+    data = {"fromBlock": eth_utils.to_hex(from_block),
+            "toBlock": eth_utils.to_hex(to_block),
+            "address": list(coins),
+            "topics": [web3_utils.transfer_topic]}
+
+    if not Cfg.logs_filter_recipients:
+        return [data]
+
+    await variables.user_accounts_event.wait()
+    recipients = [web3_utils.address_to_topic(address) for address in variables.user_accounts_low_case]
+    return [{**data, "topics": [web3_utils.transfer_topic, None, recipients[i:i + Cfg.logs_recipients_chunk]]}
+            for i in range(0, len(recipients), Cfg.logs_recipients_chunk)]
+
+
+async def fetch_block_range(client1: async_client.AsyncEth,
+                            client2: async_client.AsyncEth,
+                            from_block: int,
+                            to_block: int,
+                            logger: logging.Logger) -> List[dict]:
+    """
+    This function downloads and parses blocks from_block..to_block inclusive with one eth_getLogs request.
+    It doesn't touch the last handled block cursor, so it can run ahead of store_block_range.
+    :return: deposits of the range
+    """
+    coins = variables.coins.tokens_low_case
+    native_coin = variables.coins.native
+
+    filters = await transfer_logs_filters(from_block, to_block, coins) if coins else []
+
+    tasks = [asyncio.create_task(client1.get_logs_batch(filters)),
+             asyncio.create_task(client2.get_blocks_by_range(from_block, to_block))]
+
+    transactions, blocks = await asyncio.gather(*tasks)
+    coin_txs = await coins_txs_parser(transactions, coins, logger)
+
+    native_txs = []
+    for block in blocks:
+        native_txs += await native_txs_parser(block, native_coin, client1, logger)
+
+    return coin_txs + native_txs
+
+
+async def store_block_range(deposits: List[dict], from_block: int, to_block: int, logger: logging.Logger):
+    async with write_async_session() as session:
+        db = DB(session, logger)
+        if deposits:
+            await db.add_deposits(deposits)
+        await db.insert_last_handled_block(to_block, commit=True)
+        variables.last_handled_block = to_block
+        logger.info(f"handled blocks from {from_block} to {to_block}")
+
+
+async def block_parser(conn_creds_1, conn_creds_2, logger: logging.Logger, latest_head: int = None):
+    """
+    :param latest_head: number of the newest block pushed by newHeads, eth_blockNumber is polled when it's None
+    """
     async with async_client.AsyncEth(*conn_creds_1) as client1, async_client.AsyncEth(*conn_creds_2) as client2:
         try:
-            latest_trust_block = await client1.latest_block_number() - Cfg.block_offset
+            if latest_head is None:
+                latest_head = await client1.latest_block_number()
+            latest_trust_block = latest_head - Cfg.block_offset
         except Exception as exc:
             logger.error(exc)
             return
         else:
-            current_block = variables.last_handled_block + 1
+            next_block = variables.last_handled_block + 1
+
+            if latest_trust_block - next_block > Cfg.block_offset * Cfg.allowed_slippage:
+                logger.warning(
+                    f"Slippage for the block pasring more then {Cfg.block_offset} in {Cfg.allowed_slippage} times, "
+                    f"catching up by {Cfg.block_range} blocks")
+
+            # up to Cfg.prefetch_window ranges are downloaded ahead while the oldest one is being stored,
+            # ranges are stored strictly in order
+            pending = deque()
+            try:
+                while pending or latest_trust_block > next_block:
+                    while len(pending) < Cfg.prefetch_window and latest_trust_block > next_block:
+                        to_block = min(next_block + Cfg.block_range - 1, latest_trust_block - 1)
+                        task = asyncio.create_task(fetch_block_range(client1, client2, next_block, to_block, logger))
+                        pending.append((next_block, to_block, task))
+                        next_block = to_block + 1
+
+                    from_block, to_block, task = pending.popleft()
+                    try:
+                        deposits = await task
+                    except Exception as exc:
+                        logger.error(exc)
+                        break
+                    else:
+                        await store_block_range(deposits, from_block, to_block, logger)
+            finally:
+                for _, _, task in pending:
+                    task.cancel()
+                await asyncio.gather(*[task for _, _, task in pending], return_exceptions=True)
 
-            if latest_trust_block > current_block:
-                if latest_trust_block - current_block > Cfg.block_offset * Cfg.allowed_slippage:
-                    logger.warning(
-                        f"Slippage for the block pasring more then {Cfg.block_offset} in {Cfg.allowed_slippage} times")
 
-                data = {"fromBlock": eth_utils.to_hex(current_block),
-                        "toBlock": eth_utils.to_hex(current_block),
-                        "topics": ["0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"]}
+async def new_heads_listener(logger: logging.Logger):
+    """
+    This function keeps a newHeads subscription open and wakes block_parser_loop on every new block.
+    The subscription is reopened after Cfg.ws_reconnect_interval if the connection drops.
+    """
+    provider = providers.AsyncWebSocketProvider(Cfg.ws_server)
+    while True:
+        try:
+            async for head in provider.subscribe(["newHeads"]):
+                variables.latest_head = async_client.hex_to_int(head["number"])
+                variables.new_head_event.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.error(f"newHeads subscription failed: {exc}")
+        else:
+            logger.warning("newHeads subscription closed")
+        variables.latest_head = None  # block_parser_loop polls eth_blockNumber until the next head
+        await asyncio.sleep(Cfg.ws_reconnect_interval)
 
-                tasks = [asyncio.create_task(client1.get_logs(data)),
-                         asyncio.create_task(client2.get_block_by_number(eth_utils.to_hex(current_block)))]
 
-                try:
-                    transactions, block = await asyncio.gather(*tasks)
-                except Exception as exc:
-                    logger.error(exc)
-                else:
-                    async with write_async_session() as session:
-                        db = DB(session, logger)
-                        resp = await db.get_coins(
-                            [Coins.contract_address, Coins.name, Coins.current_rate, Coins.min_amount, Coins.decimal])
+async def block_parser_loop(conn_creds_1, conn_creds_2, logger: logging.Logger):
+    """
+    This function runs block_parser with the pushed head number as soon as a new head arrives,
+    or every Cfg.block_poll_interval seconds with eth_blockNumber polling while the subscription is down or silent.
+    """
+    while True:
+        try:
+            await asyncio.wait_for(variables.new_head_event.wait(), Cfg.block_poll_interval)
+        except asyncio.TimeoutError:
+            latest_head = None
+        else:
+            latest_head = variables.latest_head
+        variables.new_head_event.clear()
+        try:
+            await block_parser(conn_creds_1, conn_creds_2, logger, latest_head)
+        except Exception as exc:
+            logger.error(exc)
 
-                        coins = {coin[Coins.contract_address.key].lower(): coin for coin in resp if
-                                 coin[Coins.contract_address.key] != St.native.v}
 
-                        coin_txs = await coins_txs_parser(transactions, coins, logger)
+async def queue_worker(func, event: asyncio.Event, logger: logging.Logger, min_interval: float = 0):
+    """
+    This function runs func as soon as its queue is notified and right away again while func keeps claiming rows,
+    otherwise every Cfg.queue_poll_interval seconds to pick up postponed retries and lost notifications.
+    :param func: job returning count of rows it made progress on, rows postponed for a retry don't count
+    :param event: set by QueueListener on NOTIFY
+    :param min_interval: pause after every run, lets withdrawals collect for a batch
+    """
+    while True:
+        event.clear()
+        try:
+            claimed = await func(logger)
+        except Exception as exc:
+            logger.error(exc)
+            claimed = 0
+        if min_interval:
+            await asyncio.sleep(min_interval)
+        if claimed:
+            continue
+        try:
+            await asyncio.wait_for(event.wait(), Cfg.queue_poll_interval)
+        except asyncio.TimeoutError:
+            pass
 
-                        native_coin = [coin for coin in resp if coin[Coins.contract_address.key] == St.native.v][0]
-                        native_txs = await native_txs_parser(block, native_coin, client1, logger)
 
-                        deposits = coin_txs + native_txs
+def group_deposits(deposits: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    This function merges claimed deposits of the same address and coin into one sweep.
+    :param deposits: rows of get_and_lock_pending_deposits_native/coin
+    :return: rows with summed amount and deposit_ids instead of deposit_id
+    """
+    groups: Dict[Tuple[int, str], Dict[str, Any]] = {}
+    for deposit in deposits:
+        deposit = dict(deposit)
+        deposit_id = deposit.pop("deposit_id")
+        key = (deposit["address_id"], deposit.get(Deposits.contract_address.key, St.native.v))
+        group = groups.get(key)
+        if group is None:
+            groups[key] = {**deposit, "amount": Decimal(deposit["amount"]), "deposit_ids": [deposit_id]}
+        else:
+            group["amount"] += Decimal(deposit["amount"])
+            group["deposit_ids"].append(deposit_id)
+            group["tx_handler_period"] = max(group["tx_handler_period"], deposit["tx_handler_period"])
+    return list(groups.values())
 
-                        if deposits:
-                            await db.add_deposits(deposits)
-                        await db.insert_last_handled_block(current_block, commit=True)
-                        variables.last_handled_block = current_block
-                        logger.info(f"handled block number {current_block}")
+
+async def min_sweep_quote_amount(gas: int) -> Decimal:
+    """
+    This function converts the current fee of a sweep with gas to quote coin and divides it by
+    Cfg.sweep_max_fee_ratio, sweeps of smaller value are deferred until gas gets cheaper.
+    """
+    if not Cfg.sweep_max_fee_ratio:
+        return Decimal(0)
+    native_coin = variables.coins.native
+    if not native_coin or not native_coin[Coins.current_rate.key]:
+        return Decimal(0)
+    fee = await variables.fees.quote()
+    fee_quote_amount = CoinRegistry.quote_amount(native_coin, fee.max_cost(gas))
+    return fee_quote_amount / Decimal(str(Cfg.sweep_max_fee_ratio))
+
+
+async def report_sweep_plan(db: DB, native: bool, min_quote_amount: Decimal, logger: logging.Logger):
+    for sweep in await db.get_sweep_plan(native, min_quote_amount):
+        logger.info(f"dry run: {'defer' if sweep['deferred'] else 'sweep'} address_id {sweep['address_id']} "
+                    f"{sweep[Deposits.contract_address.key]} amount {sweep['amount']} "
+                    f"quote_amount {sweep['quote_amount']} deposits {sweep['deposits_count']} "
+                    f"min_quote_amount {min_quote_amount}")
 
 
 async def tx_conductor_native(logger: logging.Logger):
     reqs = []
-    async with write_async_session() as session:
+    # fees are quoted before the claim, row locks aren't held while the first fee update is awaited
+    min_quote_amount = await min_sweep_quote_amount(21000)
+    async with write_async_session() as session:  # claim, the connection is returned before transfers start
         db = DB(session, logger)
-        deposits = await db.get_and_lock_pending_deposits_native(7)
+        if Cfg.sweep_dry_run:
+            return await report_sweep_plan(db, True, min_quote_amount, logger)
+        deposits = await db.get_and_lock_pending_deposits_native(7, min_quote_amount)
+    if not deposits:
+        return 0
+
+    for sweep in group_deposits(deposits):
+        conn_creds: List[Tuple[str, str]] = await variables.api_keys_pool.get()
+        reqs.append(asyncio.create_task(native_transfer_to_admin(conn_creds=conn_creds, **sweep)))
+
+    async with leases_kept(Deposits.tx_handler_lease_expires_at, Deposits.tx_handler_replica,
+                           [deposit["deposit_id"] for deposit in deposits], logger):
+        results = await asyncio.gather(*reqs)
+
+    updates = []
+    for tx_hash, err, req_ident, conn_creds in results:
+        await variables.api_keys_pool.put(conn_creds)
+        deposit_ids, tx_handler_period = req_ident
+        if not err:
+            data = {Deposits.tx_hash_out.key: tx_hash, Deposits.tx_handler_lease_expires_at.key: None}
+        elif tx_hash:
+            logger.critical(f"{err} deposit_ids: {deposit_ids}, {tx_hash}")
+            data = {Deposits.tx_hash_out.key: tx_hash, Deposits.tx_handler_lease_expires_at.key: None}
+        else:
+            logger.error(f"{err} deposit_ids: {deposit_ids}")
+            time_to_tx_handler = datetime.now(timezone.utc) + timedelta(seconds=tx_handler_period)
+            data = {Deposits.tx_handler_lease_expires_at.key: None,
+                    Deposits.time_to_tx_handler.key: time_to_tx_handler,
+                    Deposits.tx_handler_period.key: tx_handler_period + 30}
+        updates += [{Deposits.id.key: deposit_id, **data} for deposit_id in deposit_ids]
 
-        if deposits:
-            for deposit in deposits:
-                conn_creds: List[Tuple[str, str]] = await variables.api_keys_pool.get()
-                reqs.append(asyncio.create_task(native_transfer_to_admin(conn_creds=conn_creds, **deposit)))
-
-            results = await asyncio.gather(*reqs)
-
-            for tx_hash, err, req_ident, conn_creds in results:
-                await variables.api_keys_pool.put(conn_creds)
-                deposit_id, tx_handler_period = req_ident
-                if not err:
-                    await db.update_deposit_by_id(deposit_id, {Deposits.tx_hash_out.key: tx_hash,
-                                                               Deposits.locked_by_tx_handler.key: False}, commit=True)
-                elif tx_hash:
-                    logger.critical(f"{err} deposit_id: {deposit_id}, {tx_hash}")
-                    await db.update_deposit_by_id(deposit_id, {Deposits.tx_hash_out.key: tx_hash}, commit=True)
-                else:
-                    logger.error(f"{err} deposit_id: {deposit_id}")
-                    time_to_tx_handler = datetime.now(timezone.utc) + timedelta(seconds=tx_handler_period)
-                    tx_handler_period += 30
-                    await db.update_deposit_by_id(deposit_id, {Deposits.locked_by_tx_handler.key: False,
-                                                               Deposits.time_to_tx_handler.key: time_to_tx_handler,
-                                                               Deposits.tx_handler_period.key: tx_handler_period},
-                                                  commit=True)
+    async with write_async_session() as session:  # record
+        await DB(session, logger).bulk_update_deposits(updates, commit=True)
+    return len(deposits)
 
 
 async def native_transfer_to_admin(conn_creds,
-                                   deposit_id,
+                                   deposit_ids,
                                    amount,
                                    user_private,
                                    admin_public,
-                                   tx_handler_period):
+                                   tx_handler_period,
+                                   **_):
     amount = int(amount)
     try:
         async with async_client.AsyncEth(*conn_creds) as client:
-            await variables.gas_price_event.wait()
-            amount_with_fee: int = int(amount - variables.gas_price * 21000)
-            res = await client.send_ether(admin_public, amount_with_fee, user_private, gas_price=variables.gas_price,
+            fee = await variables.fees.quote()
+            amount_with_fee: int = int(amount - fee.max_cost(21000))
+            res = await client.send_ether(admin_public, amount_with_fee, user_private, fee=fee,
                                           gas=21000)
     except Exception as exc:
-        return None, exc, (deposit_id, tx_handler_period), conn_creds
+        return None, exc, (deposit_ids, tx_handler_period), conn_creds
     else:
-        return res, None, (deposit_id, tx_handler_period), conn_creds
+        return res, None, (deposit_ids, tx_handler_period), conn_creds
 
 
 async def tx_conductor_coin(logger: logging.Logger):
     reqs = []
-    async with write_async_session() as session:
+    # fees are quoted before the claim, row locks aren't held while the first fee update is awaited
+    min_quote_amount = await min_sweep_quote_amount(100000)
+    fee = await variables.fees.quote()
+    async with write_async_session() as session:  # claim, the connection is returned before transfers start
         db = DB(session, logger)
-        await variables.gas_price_event.wait()
-        deposits = await db.get_and_lock_pending_deposits_coin(5, variables.gas_price * 21000)
+        if Cfg.sweep_dry_run:
+            return await report_sweep_plan(db, False, min_quote_amount, logger)
+        deposits = await db.get_and_lock_pending_deposits_coin(5, fee.max_cost(21000), min_quote_amount)
+        if not deposits:
+            return 0
+
+        sweeps = group_deposits(deposits)
+        allowance_keys = [(sweep["address_id"], sweep[Deposits.contract_address.key], sweep["approve_public"])
+                          for sweep in sweeps]
+        allowances = await db.get_allowances(allowance_keys)
+    for sweep, allowance_key in zip(sweeps, allowance_keys):
+        sweep["allowance"] = allowances.get(allowance_key)
+
+    async with leases_kept(Deposits.tx_handler_lease_expires_at, Deposits.tx_handler_replica,
+                           [deposit["deposit_id"] for deposit in deposits], logger):
+        await prepare_approvals(sweeps)
+
+        for sweep in sweeps:
+            conn_creds: List[Tuple[str, str]] = await variables.api_keys_pool.get()
+            reqs.append(asyncio.create_task(coin_transfer_to_admin(conn_creds=conn_creds, **sweep)))
+
+        results = await asyncio.gather(*reqs)
+
+    updates = []
+    allowance_updates = []
+    for allowance_key, (tx_hash, err, req_ident, conn_creds) in zip(allowance_keys, results):
+        await variables.api_keys_pool.put(conn_creds)
+        deposit_ids, tx_handler_period, approve_id, allowance = req_ident
+        allowance_updates.append((*allowance_key, allowance))
+        if not err:
+            data = {Deposits.tx_hash_out.key: tx_hash, Deposits.tx_handler_lease_expires_at.key: None}
+        elif tx_hash and err:
+            logger.critical(f"{err} deposit_ids: {deposit_ids}, {tx_hash}")
+            data = {Deposits.tx_hash_out.key: tx_hash, Deposits.tx_handler_lease_expires_at.key: None}
+        else:
+            logger.error(f"{err} deposit_ids: {deposit_ids}")
+            time_to_tx_handler = datetime.now(timezone.utc) + timedelta(seconds=tx_handler_period)
+            data = {Deposits.tx_handler_lease_expires_at.key: None,
+                    Deposits.time_to_tx_handler.key: time_to_tx_handler,
+                    Deposits.tx_handler_period.key: tx_handler_period + 30}
+        updates += [{Deposits.id.key: deposit_id, **data} for deposit_id in deposit_ids]
 
-        if deposits:
-            for deposit in deposits:
-                conn_creds: List[Tuple[str, str]] = await variables.api_keys_pool.get()
-                reqs.append(asyncio.create_task(coin_transfer_to_admin(conn_creds=conn_creds, **deposit)))
-
-            results = await asyncio.gather(*reqs)
-
-            for tx_hash, err, req_ident, conn_creds in results:
-                await variables.api_keys_pool.put(conn_creds)
-                deposit_id, tx_handler_period, approve_id = req_ident
-                if not err:
-                    await db.update_deposit_by_id(deposit_id, {Deposits.tx_hash_out.key: tx_hash,
-                                                               Deposits.locked_by_tx_handler.key: False}, commit=True)
-                elif tx_hash and err:
-                    logger.critical(f"{err} deposit_id: {deposit_id}, {tx_hash}")
-                    await db.update_deposit_by_id(deposit_id, {Deposits.tx_hash_out.key: tx_hash})
-                    await db.update_user_address_by_id(approve_id, {UserAddress.locked_by_tx.key: False},
-                                                       commit=True)
-                else:
-                    logger.error(f"{err} deposit_id: {deposit_id}")
-                    time_to_tx_handler = datetime.now(timezone.utc) + timedelta(seconds=tx_handler_period)
-                    tx_handler_period += 30
-                    await db.update_deposit_by_id(deposit_id, {Deposits.locked_by_tx_handler.key: False,
-                                                               Deposits.time_to_tx_handler.key: time_to_tx_handler,
-                                                               Deposits.tx_handler_period.key: tx_handler_period},
-                                                  commit=True)
+    async with write_async_session() as session:  # record
+        await DB(session, logger).bulk_update_deposits(updates, commit=True)
+    await save_allowances(allowance_updates, logger)
+    return len(deposits)
+
+
+def dispatch_withdrawals(withdrawals: List[Dict[str, Any]], wallets: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    This function assigns withdrawals to hot wallets. A wallet must have enough balance left after reservation
+    of its withdrawals in flight, among such wallets the one with the shortest queue is picked.
+    :param wallets: rows of get_hot_wallets, reservations and queues are updated in place
+    :return: assigned withdrawals with admin_addr_id, admin_public, admin_private and balance available for them
+    """
+    available = {wallet["admin_addr_id"]: {coin: balance - wallet["reserved"].get(coin, 0)
+                                           for coin, balance in wallet["balances"].items()} for wallet in wallets}
+    assigned = []
+    for withdrawal in withdrawals:
+        coin = withdrawal[Withdrawals.contract_address.key]
+        amount = withdrawal[Withdrawals.amount.key]
+        candidates = [wallet for wallet in wallets if wallet["queue"] < Cfg.wallet_lane_depth and
+                      wallet["balances"].get(coin, 0) - wallet["reserved"].get(coin, 0) >= amount]
+        if not candidates:
+            continue
+        wallet = min(candidates, key=lambda x: x["queue"])
+        wallet["reserved"][coin] = wallet["reserved"].get(coin, 0) + amount
+        wallet["queue"] += 1
+        assigned.append({**withdrawal,
+                         "admin_addr_id": wallet["admin_addr_id"],
+                         "admin_public": wallet["admin_public"],
+                         "admin_private": wallet["admin_private"],
+                         "balance": available[wallet["admin_addr_id"]][coin]})
+    return assigned
+
+
+async def save_allowances(allowance_updates: List[tuple], logger: logging.Logger):
+    """
+    This function records allowances after the results of the transfers are committed, the cache is only
+    an optimization, so a failure here must not roll back tx hashes of sent transfers.
+    :param allowance_updates: [(address_id, contract_address, spender, allowance or None), ...]
+    """
+    if not allowance_updates:
+        return
+    try:
+        async with write_async_session() as session:
+            db = DB(session, logger)
+            for allowance_update in allowance_updates:
+                await db.save_allowance(*allowance_update)
+            await session.commit()
+    except Exception as exc:
+        logger.error(f"saving allowances failed, cached allowances may be stale: {exc}")
+
+
+async def with_conn_creds(func, *args, **kwargs):
+    conn_creds: List[Tuple[str, str]] = await variables.api_keys_pool.get()
+    try:
+        return await func(conn_creds, *args, **kwargs)
+    finally:
+        await variables.api_keys_pool.put(conn_creds)
+
+
+@asynccontextmanager
+async def leases_kept(lease: Column, owner: Column, ids: List[str], logger: logging.Logger):
+    """
+    This function renews leases of ids every Cfg.lease_renew_interval seconds while the block runs,
+    so rows with requests in flight aren't released by the lease reaper.
+    :param lease: lease column of the claim, e.g. Deposits.tx_handler_lease_expires_at
+    :param owner: replica column of the same claim
+    """
+
+    async def renew():
+        while True:
+            await asyncio.sleep(Cfg.lease_renew_interval)
+            try:
+                async with write_async_session() as session:
+                    await DB(session, logger).renew_leases(lease, owner, ids)
+            except Exception as exc:
+                logger.error(f"lease renewal failed: {exc}")
+
+    task = asyncio.create_task(renew())
+    try:
+        yield
+    finally:
+        task.cancel()
 
 
 async def withdraw_handler(logger: logging.Logger):
     reqs = []
-    async with write_async_session() as session:
+    async with write_async_session() as session:  # claim, the connection is returned before payments start
         db = DB(session, logger)
-        withdrawals = await db.get_and_lock_pending_withdrawals(Cfg.admin_accounts)
+        withdrawals = await db.get_and_lock_unassigned_withdrawals(Cfg.admin_accounts * Cfg.wallet_lane_depth)
+        if not withdrawals:
+            return 0
+        withdrawals = dispatch_withdrawals(withdrawals, await db.get_hot_wallets())
+        assignments: Dict[int, List[str]] = {}
+        for withdrawal in withdrawals:
+            assignments.setdefault(withdrawal["admin_addr_id"], []).append(withdrawal["withdrawal_id"])
+        await db.assign_withdrawals(assignments)
+
+        # lanes of all hot wallets run at once, so creds are taken per task instead of before gather
+        allowance_keys = []  # (admin_addr_id, contract_address, spender) of disperseToken batches
+        batches = []
+        allowances = {}
+        if Cfg.withdrawal_batch_window:
+            groups, leftovers = group_withdrawals(withdrawals)
+            if leftovers:  # let the next run pay them
+                await db.update_withdrawals_by_ids([withdrawal["withdrawal_id"] for withdrawal in leftovers],
+                                                   {Withdrawals.admin_addr_id.key: None,
+                                                    Withdrawals.tx_handler_lease_expires_at.key: None},
+                                                   commit=True)
+            withdrawals = [group[0] for group in groups if len(group) == 1]
+            batches = [group for group in groups if len(group) > 1]
+            allowance_keys = [(group[0]["admin_addr_id"], group[0][Withdrawals.contract_address.key],
+                               Cfg.disperse_address) for group in batches]
+            allowances = await db.get_allowances([key for key in allowance_keys if key[1] != St.native.v])
+
+    for group, allowance_key in zip(batches, allowance_keys):
+        reqs.append(asyncio.create_task(with_conn_creds(withdraw_batch,
+                                                        group[0][Withdrawals.contract_address.key],
+                                                        group[0]["admin_addr_id"],
+                                                        group[0]["admin_public"],
+                                                        group[0]["admin_private"],
+                                                        group,
+                                                        allowances.get(allowance_key))))
+
+    for withdrawal in withdrawals:
+        contract_address = withdrawal[Withdrawals.contract_address.key]
+        if contract_address == St.native.v:
+            reqs.append(asyncio.create_task(with_conn_creds(withdraw_native, **withdrawal)))
+        else:
+            reqs.append(asyncio.create_task(with_conn_creds(withdraw_coin, **withdrawal)))
+
+    async with leases_kept(Withdrawals.tx_handler_lease_expires_at, Withdrawals.tx_handler_replica,
+                           [withdrawal_id for ids in assignments.values() for withdrawal_id in ids], logger):
+        results = await asyncio.gather(*reqs)
+
+    updates = []
+    allowance_updates = []
+    sent = 0  # failed withdrawals wait for time_to_tx_handler, so queue_worker only reruns on progress
+    for index, (tx_hash, err, req_ident, _) in enumerate(results):
+        if index < len(allowance_keys):
+            withdrawal_ids, tx_handler_period, adm_address_id, allowance = req_ident
+            if allowance_keys[index][1] != St.native.v:
+                allowance_updates.append((*allowance_keys[index], allowance))
+        else:
+            withdrawal_id, tx_handler_period, adm_address_id = req_ident
+            withdrawal_ids = [withdrawal_id]
+        if tx_hash:
+            sent += len(withdrawal_ids)
+        if not err:
+            data = {Withdrawals.tx_hash_out.key: tx_hash, Withdrawals.tx_handler_lease_expires_at.key: None}
+        elif tx_hash:
+            logger.critical(f"{err} withdrawal_ids: {withdrawal_ids}")
+            data = {Withdrawals.tx_hash_out.key: tx_hash, Withdrawals.tx_handler_lease_expires_at.key: None}
+        else:
+            time_to_tx_handler = datetime.now(timezone.utc) + timedelta(seconds=tx_handler_period)
+            data = {Withdrawals.admin_addr_id.key: None,
+                    Withdrawals.tx_handler_lease_expires_at.key: None,
+                    Withdrawals.time_to_tx_handler.key: time_to_tx_handler,
+                    Withdrawals.tx_handler_period.key: tx_handler_period + 15}
+            logger.error(f"{err} withdrawal_ids: {withdrawal_ids}")
+        updates += [{Withdrawals.id.key: withdrawal_id, **data} for withdrawal_id in withdrawal_ids]
 
-        if withdrawals:
-            for withdrawal in withdrawals:
-                contract_address = withdrawal[Withdrawals.contract_address.key]
-                conn_creds: List[Tuple[str, str]] = await variables.api_keys_pool.get()
-                if contract_address == St.native.v:
-                    reqs.append(asyncio.create_task(withdraw_native(conn_creds, **withdrawal)))
-                else:
-                    reqs.append(asyncio.create_task(withdraw_coin(conn_creds, **withdrawal)))
-
-            results = await asyncio.gather(*reqs)
-
-            for tx_hash, err, req_ident, conn_creds in results:
-                await variables.api_keys_pool.put(conn_creds)
-                withdrawal_id, tx_handler_period, adm_address_id = req_ident
-                if not err:
-                    await db.update_withdrawal_by_id(withdrawal_id, {Withdrawals.tx_hash_out.key: tx_hash}, commit=True)
-                elif tx_hash:
-                    logger.critical(f"{err} withdrawal_id: {withdrawal_id}")
-                    await db.update_withdrawal_by_id(withdrawal_id, {Withdrawals.tx_hash_out.key: tx_hash})
-                    await db.update_user_address_by_id(adm_address_id, {UserAddress.locked_by_tx.key: False},
-                                                       commit=True)
-                else:
-                    time_to_tx_handler = datetime.now(timezone.utc) + timedelta(tx_handler_period)
-                    tx_handler_period += 15
-                    await db.update_withdrawal_by_id(
-                        withdrawal_id, {Withdrawals.admin_addr_id.key: None,
-                                        Withdrawals.time_to_tx_handler.key: time_to_tx_handler,
-                                        Withdrawals.tx_handler_period.key: tx_handler_period}, commit=True)
-                    logger.error(f"{err} withdrawal_id: {withdrawal_id}")
+    async with write_async_session() as session:  # record
+        await DB(session, logger).bulk_update_withdrawals(updates, commit=True)
+    await save_allowances(allowance_updates, logger)
+    return sent
 
 
 async def deposit_callback_handler(logger: logging.Logger):
@@ -603,33 +1099,39 @@ async def deposit_callback_handler(logger: logging.Logger):
                                                         )
                 reqs.append(asyncio.create_task(notify_deposit(display_amount=display_amount, **data)))
 
-            results = await asyncio.gather(*reqs)
+            async with leases_kept(Deposits.callback_lease_expires_at, Deposits.callback_replica,
+                                   [data["deposit_id"] for data in deposits], logger):
+                results = await asyncio.gather(*reqs)
 
+            updates = []
             for exception, req_ident in results:
                 deposit_id, callback_period, user_id = req_ident
                 if not exception:
-                    await db.update_deposit_by_id(deposit_id, {Deposits.is_notified.key: True,
-                                                               Deposits.locked_by_callback.key: False}, commit=True)
+                    updates.append({Deposits.id.key: deposit_id,
+                                    Deposits.is_notified.key: True,
+                                    Deposits.callback_lease_expires_at.key: None})
                 else:
                     if isinstance(exception, api.proc_api_client.ClientException) and exception.http_code == 409:
                         logger.warning(f"Deposit_id {deposit_id} {user_id} already notified")
-                        await db.update_deposit_by_id(deposit_id, {Deposits.locked_by_callback.key: False,
-                                                                   Deposits.is_notified.key: True}, commit=True)
+                        updates.append({Deposits.id.key: deposit_id,
+                                        Deposits.callback_lease_expires_at.key: None,
+                                        Deposits.is_notified.key: True})
                     else:
                         time_to_callback = datetime.now(timezone.utc) + timedelta(seconds=callback_period)
-                        callback_period += 60
-                        await db.update_deposit_by_id(deposit_id, {Deposits.locked_by_callback.key: False,
-                                                                   Deposits.time_to_callback.key: time_to_callback,
-                                                                   Deposits.callback_period.key: callback_period},
-                                                      commit=True)
+                        updates.append({Deposits.id.key: deposit_id,
+                                        Deposits.callback_lease_expires_at.key: None,
+                                        Deposits.time_to_callback.key: time_to_callback,
+                                        Deposits.callback_period.key: callback_period + 60})
                         logger.error(f"Deposit_id {deposit_id} {user_id} exception: {exception}")
+            await db.bulk_update_deposits(updates, commit=True)
+        return len(deposits)
 
 
-async def withdrawal_callback_handler(logger: logging.Logger) -> None:
+async def withdrawal_callback_handler(logger: logging.Logger) -> int:
     """
     This function sends the withdrawal notifications to the users.
     :param logger:
-    :return:
+    :return: count of claimed withdrawals
     """
     reqs = []
     async with write_async_session() as session:
@@ -646,30 +1148,51 @@ async def withdrawal_callback_handler(logger: logging.Logger) -> None:
                                                         rounding
                                                         )
                 reqs.append(asyncio.create_task(notify_withdrawal(display_amount=display_amount, **data)))
-            results = await asyncio.gather(*reqs)
+            async with leases_kept(Withdrawals.callback_lease_expires_at, Withdrawals.callback_replica,
+                                   [data["withdrawal_id"] for data in withdrawals], logger):
+                results = await asyncio.gather(*reqs)
 
+            updates = []
             for data, exception, req_ident in results:
                 withdrawal_id, callback_period = req_ident
                 if not exception:
-                    await db.update_withdrawal_by_id(withdrawal_id, {Withdrawals.is_notified.key: True,
-                                                                     Withdrawals.locked_by_callback.key: False},
-                                                     commit=True)
+                    updates.append({Withdrawals.id.key: withdrawal_id,
+                                    Withdrawals.is_notified.key: True,
+                                    Withdrawals.callback_lease_expires_at.key: None})
 
                 else:
                     if isinstance(exception, api.proc_api_client.ClientException) and exception.http_code == 409:
                         logger.warning(f"withdrawal {withdrawal_id} already notified")
-                        await db.update_withdrawal_by_id(withdrawal_id,
-                                                         {Withdrawals.locked_by_callback.key: False,
-                                                          Withdrawals.is_notified.key: True}, commit=True)
+                        updates.append({Withdrawals.id.key: withdrawal_id,
+                                        Withdrawals.callback_lease_expires_at.key: None,
+                                        Withdrawals.is_notified.key: True})
                     else:
                         time_to_callback = datetime.now(timezone.utc) + timedelta(seconds=callback_period)
-                        callback_period += 60
-                        await db.update_withdrawal_by_id(withdrawal_id,
-                                                         {Withdrawals.locked_by_callback.key: False,
-                                                          Withdrawals.time_to_callback.key: time_to_callback,
-                                                          Withdrawals.callback_period.key: callback_period},
-                                                         commit=True)
+                        updates.append({Withdrawals.id.key: withdrawal_id,
+                                        Withdrawals.callback_lease_expires_at.key: None,
+                                        Withdrawals.time_to_callback.key: time_to_callback,
+                                        Withdrawals.callback_period.key: callback_period + 60})
                         logger.error(f"withdrawal {withdrawal_id} {exception}")
+            await db.bulk_update_withdrawals(updates, commit=True)
+        return len(withdrawals)
+
+
+async def report_pool_stats(logger: logging.Logger):
+    logger.info(f"write pool: {write_pool_stats.report(engine.sync_engine.pool)}")
+    logger.info(f"read pool: {read_pool_stats.report(read_engine.sync_engine.pool)}")
+
+
+async def reap_expired_leases(logger: logging.Logger):
+    async with write_async_session() as session:
+        released = await DB(session, logger).release_expired_leases()
+    for name, ids in released.items():
+        if not ids:
+            continue
+        if name == "withdrawal_payments":
+            # the transaction may be sent already, requeue by clearing admin_addr_id only after checking the chain
+            logger.critical(f"{len(ids)} withdrawal payments lost their lease and stay assigned to hot wallet: {ids}")
+        else:
+            logger.warning(f"{len(ids)} {name} recovered from expired leases: {ids}")
 
 
 async def main():
@@ -677,40 +1200,74 @@ async def main():
     scheduler = AsyncIOScheduler()
     scheduler._logger.setLevel(logging.ERROR)  # to avoid apscheduler noise warning logs
 
+    providers.AsyncHTTPProvider.configure_pool(Cfg.http_pool_max_connections,
+                                               Cfg.http_pool_max_keepalive_connections,
+                                               Cfg.http_pool_keepalive_expiry,
+                                               Cfg.http2)
+
     reserved_conn_creds1 = await variables.api_keys_pool.get()
     reserved_conn_creds2 = await variables.api_keys_pool.get()
+    reserved_conn_creds3 = await variables.api_keys_pool.get()
     try:
         await update_in_memory_last_handled_block(startup_logger)
-        await update_in_memory_accounts(startup_logger)
+        await update_in_memory_accounts(startup_logger, True)
+        await load_coin_registry(startup_logger)
         await update_coin_rates(startup_logger)
-        await update_gas_price(startup_logger)
+        await update_fees(startup_logger)
     except Exception as exc:
         startup_logger.error(f"launch failed {exc}")
         raise Exception(f"launch failed {exc}")
     else:
         startup_logger.info("launch success")
-        scheduler.add_job(update_gas_price, "interval", seconds=60,
-                          args=(get_logger("update_gas_price"),))
+        confirmation_tracker.active = True
+        scheduler.add_job(track_confirmations, "interval", seconds=Cfg.confirmation_poll_interval, max_instances=1,
+                          args=(reserved_conn_creds3, get_logger("track_confirmations")))
+        scheduler.add_job(update_fees, "interval", seconds=Cfg.block_poll_interval, max_instances=1,
+                          args=(get_logger("update_fees"),))
         scheduler.add_job(update_coin_rates, "interval", seconds=10,
                           args=(get_logger("update_coin_rates"),))
-        scheduler.add_job(update_in_memory_accounts, "interval", seconds=10,
-                          args=(get_logger("update_in_memory_accounts"),))
+        accounts_logger = get_logger("update_in_memory_accounts")
+        scheduler.add_job(update_in_memory_accounts, "interval", seconds=Cfg.accounts_refresh_interval,
+                          max_instances=1, args=(accounts_logger,))
+        scheduler.add_job(update_in_memory_accounts, "interval", seconds=Cfg.accounts_resync_interval,
+                          max_instances=1, args=(accounts_logger, True))
+        # kill -HUP forces a full resync, e.g. after addresses were edited by hand
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGHUP, lambda: scheduler.add_job(update_in_memory_accounts, args=(accounts_logger, True)))
         scheduler.add_job(admin_coins_bal, "interval", seconds=30,
                           args=(get_logger("admin_coins_bal"),))
         scheduler.add_job(admin_approve_native_bal, "interval", seconds=30,
                           args=(get_logger("admin_approve_native_bal"),))
-        scheduler.add_job(block_parser, "interval", seconds=3, max_instances=1,
-                          args=(reserved_conn_creds1, reserved_conn_creds2, get_logger("block_parser")))
-        scheduler.add_job(tx_conductor_coin, "interval", seconds=1, max_instances=1,
-                          args=(get_logger("tx_conductor_coin"),))
-        scheduler.add_job(tx_conductor_native, "interval", seconds=1, max_instances=1,
-                          args=(get_logger("tx_conductor_native"),))
-        scheduler.add_job(withdraw_handler, "interval", seconds=1, max_instances=1,
-                          args=(get_logger("withdraw_handler"),))
-        scheduler.add_job(deposit_callback_handler, "interval", seconds=1, max_instances=1,
-                          args=(get_logger("deposit_callback_handler"),))
-        scheduler.add_job(withdrawal_callback_handler, "interval", seconds=1, max_instances=1,
-                          args=(get_logger("withdrawal_callback_handler"),))
+        scheduler.add_job(reap_expired_leases, "interval", seconds=Cfg.lease_reaper_interval, max_instances=1,
+                          args=(get_logger("lease_reaper"),))
+        scheduler.add_job(report_pool_stats, "interval", seconds=Cfg.pool_stats_interval,
+                          args=(get_logger("pool_stats"),))
+        background_tasks = []  # referenced here so the event loop doesn't garbage collect them
+        if Cfg.replica_index != 0:
+            startup_logger.info(f"replica {Cfg.replica_index} of {Cfg.replicas}, blocks are parsed by replica 0")
+        elif Cfg.ws_server:
+            block_parser_logger = get_logger("block_parser")
+            background_tasks += [
+                asyncio.create_task(new_heads_listener(block_parser_logger)),
+                asyncio.create_task(block_parser_loop(reserved_conn_creds1, reserved_conn_creds2,
+                                                      block_parser_logger))]
+        else:
+            scheduler.add_job(block_parser, "interval", seconds=Cfg.block_poll_interval, max_instances=1,
+                              args=(reserved_conn_creds1, reserved_conn_creds2, get_logger("block_parser")))
+        # queue workers are woken by NOTIFY of deposits and withdrawals triggers, polling is the fallback
+        queue_listener = QueueListener(Cfg.WRITE_DSN, Cfg.listen_reconnect_interval)
+        queue_workers = [
+            (tx_conductor_coin, DEPOSITS_CHANNEL, 0),
+            (tx_conductor_native, DEPOSITS_CHANNEL, 0),
+            # in batching mode withdrawals are collected for withdrawal_batch_window and paid by disperse
+            (withdraw_handler, WITHDRAWALS_CHANNEL, Cfg.withdrawal_batch_window),
+            (deposit_callback_handler, DEPOSITS_CHANNEL, 0),
+            (withdrawal_callback_handler, WITHDRAWALS_CHANNEL, 0),
+        ]
+        for func, channel, min_interval in queue_workers:
+            background_tasks.append(asyncio.create_task(
+                queue_worker(func, queue_listener.subscribe(channel), get_logger(func.__name__), min_interval)))
+        background_tasks.append(asyncio.create_task(queue_listener.run(get_logger("queue_listener"))))
 
         scheduler.start()
         while True:
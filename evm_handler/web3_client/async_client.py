@@ -1,17 +1,18 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import functools
 import eth_utils
 import eth_abi
 import httpx
 import time
-from typing import Union, List, Tuple, Dict
+from typing import Union, List, Tuple, Dict, Any, Callable
 from web3.eth import Eth
 from web3.auto import w3
 
 import eth_account
 from eth_typing import ChecksumAddress
 
-from web3_client.providers import AsyncHTTPProvider
+from web3_client.providers import AsyncHTTPProvider, DEFAULT_BATCH_SIZE, is_method_not_supported
 from web3_client.exceptions import Web3Exception, \
     StuckTransaction, \
     TransactionNotFound, \
@@ -20,6 +21,10 @@ from web3_client.exceptions import Web3Exception, \
     InsufficientFundsForTx, \
     TransactionFailed
 from web3_client.utils import generate_mnemonic, keys_from_mnemonic, erc20_abi
+from web3_client.nonce_manager import nonce_manager
+from web3_client.confirmation_tracker import confirmation_tracker
+from web3_client.fees import FeeQuote
+from web3_client import erc20_codec, multicall, disperse
 
 
 def hex_to_int(hex_str):
@@ -27,52 +32,98 @@ def hex_to_int(hex_str):
 
 
 class AsyncEth():
-    def __init__(self, server, network_id):
+    block_receipts_support: Dict[str, bool] = {}  # {server: is eth_getBlockReceipts available}
+    multicall_support: Dict[str, bool] = {}  # {server: is Multicall3 deployed}
+
+    def __init__(self, server, network_id, batch_size=DEFAULT_BATCH_SIZE):
         self.server = server
         self.client = None
         self.network_id = network_id
         self.provider = None
+        self.batch_size = batch_size
 
     async def __aenter__(self):
         self.provider = AsyncHTTPProvider(self.server)
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.provider.client.aclose()
+        await self.provider.aclose()
 
     async def result(self, tx_hash):
-        await self.wait_for_mempool(tx_hash)
-        await self.wait_for_mined(tx_hash)
-        receipt = await self.wait_for_receipt(tx_hash)
+        if confirmation_tracker.active:
+            receipt = await confirmation_tracker.wait(tx_hash)
+        else:
+            await self.wait_for_mempool(tx_hash)
+            await self.wait_for_mined(tx_hash)
+            receipt = await self.wait_for_receipt(tx_hash)
         if receipt.get("status") == '0x1':
             return tx_hash
         else:
             raise TransactionFailed(tx_hash=tx_hash)
 
-    async def broadcast_and_wait_result(self, txn):
+    async def broadcast(self, txn) -> str:
         try:
             await self.send_raw_transaction(txn.rawTransaction.hex())
-        except httpx.HTTPError:
-            return await self.result(txn.hash.hex())
-        else:
-            return await self.result(txn.hash.hex())
+        except (httpx.HTTPError, AlreadyKnown):  # the transaction may have reached the mempool anyway
+            pass
+        return txn.hash.hex()
 
-    async def send_ether(self, to_: ChecksumAddress, amount: int, signer_key: str, gas_price: int, gas: int,
+    async def broadcast_and_wait_result(self, txn):
+        return await self.result(await self.broadcast(txn))
+
+    async def sign_and_send(self, account: eth_account.account.LocalAccount, build_tx: Callable[[int], dict],
+                            nonce: int = None):
+        """
+        Sign the transaction built by build_tx(nonce), broadcast it and wait for the result.
+        If nonce is not set it's taken from the local nonce manager of the signer and stays in flight until
+        the result, a transaction which isn't found is broadcast once more and then the nonce manager is resynced.
+        """
+        if nonce is not None:
+            return await self.broadcast_and_wait_result(account.sign_transaction(build_tx(nonce)))
+
+        nonce = await nonce_manager.acquire(self, account.address)
+        try:
+            txn = account.sign_transaction(build_tx(nonce))
+            tx_hash = await self.broadcast(txn)
+        except Exception as exc:
+            nonce_manager.release(account.address, nonce, sent=False, resync=self.nonce_rejected(exc))
+            raise
+
+        resync = False
+        try:
+            try:
+                return await self.result(tx_hash)
+            except TransactionNotFound:
+                # the broadcast didn't reach the node or the transaction was dropped, later nonces of the wallet
+                # wait behind it, so the same signed transaction is sent once more
+                return await self.broadcast_and_wait_result(txn)
+        except (TransactionNotFound, StuckTransaction):
+            resync = True  # the gap nonce is taken again from the node count
+            raise
+        except Exception as exc:
+            resync = self.nonce_rejected(exc)
+            raise
+        finally:
+            nonce_manager.release(account.address, nonce, sent=True, resync=resync)
+
+    @staticmethod
+    def nonce_rejected(exc: Exception) -> bool:
+        return isinstance(exc, UnderpricedTransaction) or "nonce too low" in str(exc)
+
+    async def send_ether(self, to_: ChecksumAddress, amount: int, signer_key: str, fee: FeeQuote, gas: int,
                          nonce: int = None):
         account = eth_account.Account.from_key(signer_key)
 
-        if not nonce:
-            nonce = await self.get_transaction_count(account.address)
+        def build_tx(tx_nonce: int) -> dict:
+            return {'value': eth_utils.to_hex(amount),
+                    'chainId': int(self.network_id),
+                    'gas': gas,
+                    **fee.tx_fields(),
+                    'from': account.address,
+                    'nonce': eth_utils.to_hex(tx_nonce),
+                    'to': to_}
 
-        transaction = {'value': eth_utils.to_hex(amount),
-                       'chainId': int(self.network_id),
-                       'gas': gas,
-                       'gasPrice': gas_price,
-                       'from': account.address,
-                       'nonce': eth_utils.to_hex(nonce),
-                       'to': to_}
-        txn = account.sign_transaction(transaction)
-        return await self.broadcast_and_wait_result(txn)
+        return await self.sign_and_send(account, build_tx, nonce)
 
     async def wait_for_mempool(self, tx_hash, timeout=120, interval=3):
         end_time = time.time() + timeout
@@ -140,6 +191,12 @@ class AsyncEth():
         res = await self.provider.make_request("", {"jsonrpc": "2.0", "method": "eth_gasPrice", "params": [], "id": 1})
         return hex_to_int(res["result"])
 
+    async def fee_history(self, block_count: int, newest_block: str, reward_percentiles: List[float]) -> dict:
+        res = await self.provider.make_request("", {"jsonrpc": "2.0", "method": "eth_feeHistory",
+                                                    "params": [hex(block_count), newest_block, reward_percentiles],
+                                                    "id": 1})
+        return res["result"]
+
     async def get_account_balance(self, addr) -> int:
         res = await self.provider.make_request("", {"jsonrpc": "2.0", "method": "eth_getBalance",
                                                     "params": [addr, "latest"], "id": 1})
@@ -164,68 +221,223 @@ class AsyncEth():
                                                {"jsonrpc": "2.0", "method": "eth_getLogs", "params": [data], "id": 1})
         return res["result"]
 
+    async def get_logs_batch(self, filters: List[Dict]) -> List[Dict]:
+        results = await self.batch_request([("eth_getLogs", [data]) for data in filters])
+        logs = []
+        for res in results:
+            if isinstance(res, Exception):
+                raise res
+            logs += res
+        return logs
+
     async def get_block_by_number(self, block_number) -> Dict:
         res = await self.provider.make_request("", {"jsonrpc": "2.0", "method": "eth_getBlockByNumber",
                                                     "params": [block_number, True], "id": 1})
         return res["result"]
 
+    async def get_block_receipts(self, block_number) -> List[Dict]:
+        res = await self.provider.make_request("", {"jsonrpc": "2.0", "method": "eth_getBlockReceipts",
+                                                    "params": [block_number], "id": 1})
+        if res["result"] is None:
+            raise Web3Exception(f"No receipts for block {block_number}")
+        return res["result"]
+
+    async def get_receipts_map(self, block_number, tx_hashes: List[str]) -> Dict[str, Dict]:
+        """
+        Receipts of tx_hashes from block_number, fetched with one eth_getBlockReceipts call
+        or with one batch of eth_getTransactionReceipt if the node does not support it.
+        :return: {tx_hash: receipt}
+        """
+        if self.block_receipts_support.get(self.server, True):
+            try:
+                receipts = await self.get_block_receipts(block_number)
+            except Web3Exception as exc:
+                if not is_method_not_supported(exc):
+                    raise
+                self.block_receipts_support[self.server] = False
+            else:
+                return {receipt["transactionHash"]: receipt for receipt in receipts}
+
+        receipts = await self.get_transaction_receipts(tx_hashes)
+        for tx_hash, receipt in zip(tx_hashes, receipts):
+            if isinstance(receipt, Exception):
+                raise receipt
+            elif receipt is None:
+                raise TransactionNotFound(tx_hash)
+        return dict(zip(tx_hashes, receipts))
+
+    async def batch_request(self, calls: List[Tuple[str, list]]) -> List[Union[Any, Exception]]:
+        """
+        Send calls as JSON-RPC batches of self.batch_size calls each.
+        :param calls: [(rpc_method, params), ...]
+        :return: result of every call in the same order, failed calls are returned as exceptions
+        """
+        payloads = [{"jsonrpc": "2.0", "method": method, "params": params, "id": index}
+                    for index, (method, params) in enumerate(calls)]
+        chunks = [payloads[i:i + self.batch_size] for i in range(0, len(payloads), self.batch_size)]
+        responses = await asyncio.gather(*[self.provider.make_batch_request("", chunk) for chunk in chunks])
+        return [res if isinstance(res, Exception) else res["result"] for chunk in responses for res in chunk]
+
+    async def get_transaction_receipts(self, tx_hashes: List[str]) -> List[Union[dict, Exception]]:
+        return await self.batch_request([("eth_getTransactionReceipt", [tx_hash]) for tx_hash in tx_hashes])
+
+    async def get_account_balances(self, addresses: List[str]) -> List[Union[int, Exception]]:
+        results = await self.batch_request([("eth_getBalance", [addr, "latest"]) for addr in addresses])
+        return [res if isinstance(res, Exception) else hex_to_int(res) for res in results]
+
+    async def call_contracts(self, calls: List[Tuple["AsyncContract", str, tuple]]) -> List[Union[tuple, Exception]]:
+        """
+        :param calls: [(contract, method_name, args), ...]
+        :return: decoded outputs in the same order, failed calls are returned as exceptions
+        """
+        built = [contract.build_call(method_name, args) for contract, method_name, args in calls]
+        results = await self.batch_request([("eth_call", [txb, "latest"]) for txb, _ in built])
+        return [res if isinstance(res, Exception) else contract.decode_call(output_types, res)
+                for (contract, _, _), (_, output_types), res in zip(calls, built, results)]
+
+    async def get_code(self, address: str) -> str:
+        res = await self.provider.make_request("", {"jsonrpc": "2.0", "method": "eth_getCode",
+                                                    "params": [address, "latest"], "id": 1})
+        return res["result"]
+
+    async def has_multicall(self, multicall_address: str) -> bool:
+        if self.server not in self.multicall_support:
+            self.multicall_support[self.server] = (await self.get_code(multicall_address)) not in (None, "0x")
+        return self.multicall_support[self.server]
+
+    @staticmethod
+    def _decode_balance(res: Union[str, Exception]) -> Union[int, Exception]:
+        if isinstance(res, Exception):
+            return res
+        try:
+            return erc20_codec.decode_uint256(res)
+        except Web3Exception as exc:
+            return exc
+
+    async def get_balances(self, requests: List[Tuple[str, Union[str, None]]],
+                           multicall_address: str = multicall.MULTICALL3_ADDRESS,
+                           chunk_size: int = 500) -> List[Union[int, Exception]]:
+        """
+        Read native and ERC20 balances with Multicall3 aggregate3, chunk_size reads per eth_call,
+        or with one JSON-RPC batch of eth_getBalance/balanceOf if Multicall3 isn't deployed.
+        :param requests: [(owner, contract_address or None for the native coin), ...]
+        :return: balances in the same order, failed reads are returned as exceptions
+        """
+        if await self.has_multicall(multicall_address):
+            calls = [(multicall_address, multicall.encode_get_eth_balance(owner)) if contract is None else
+                     (eth_utils.to_checksum_address(contract), erc20_codec.encode_balance_of(owner))
+                     for owner, contract in requests]
+            chunks = [calls[i:i + chunk_size] for i in range(0, len(calls), chunk_size)]
+            results = await self.batch_request([("eth_call", [{"to": multicall_address,
+                                                               "data": multicall.encode_aggregate3(chunk)}, "latest"])
+                                                for chunk in chunks])
+            balances = []
+            for chunk, res in zip(chunks, results):
+                if isinstance(res, Exception):
+                    balances.extend([res] * len(chunk))
+                else:
+                    balances.extend(self._decode_balance(item) for item in multicall.decode_aggregate3(res))
+            return balances
+
+        results = await self.batch_request([("eth_getBalance", [owner, "latest"]) if contract is None else
+                                            ("eth_call", [{"to": contract,
+                                                           "data": erc20_codec.encode_balance_of(owner)}, "latest"])
+                                            for owner, contract in requests])
+        return [hex_to_int(res) if contract is None and not isinstance(res, Exception) else self._decode_balance(res)
+                for (_, contract), res in zip(requests, results)]
+
+    async def get_blocks_by_range(self, from_block: int, to_block: int) -> List[Dict]:
+        results = await self.batch_request([("eth_getBlockByNumber", [eth_utils.to_hex(number), True])
+                                            for number in range(from_block, to_block + 1)])
+        for res in results:
+            if isinstance(res, Exception):
+                raise res
+        return results
+
 
 class AsyncContract():
     def __init__(self, client: AsyncEth, contract_address: str, abi_info):
         self.client = client
         self.contract_address = eth_utils.to_checksum_address(contract_address)
         self.abi_info = abi_info
-        self.contract_obj = Eth(w3).contract(self.contract_address, abi=abi_info, decode_tuples=True)
+
+    @functools.cached_property
+    def contract_obj(self):
+        return Eth(w3).contract(self.contract_address, abi=self.abi_info, decode_tuples=True)
+
+    def encode_input(self, method_name: str, args: tuple) -> str:
+        return self.contract_obj.encodeABI(fn_name=method_name, args=args)
+
+    def output_types(self, method_name: str) -> List[str]:
+        method = self.contract_obj.get_function_by_name(method_name)
+        return [x.get('type') for x in method.abi.get("outputs")]
 
     async def send_transaction(self, method_name: str,
                                args: tuple,
                                signer_key: str,
-                               gas_price: int,
+                               fee: FeeQuote,
                                gas: int,
-                               nonce: int = None):
+                               nonce: int = None,
+                               value: int = 0):
         account = eth_account.Account.from_key(signer_key)
-
-        if not nonce:
-            nonce = await self.client.get_transaction_count(account.address)
-
-        tx_data = {'value': eth_utils.to_hex(0),
-                   'chainId': int(self.client.network_id),
-                   'gas': gas,
-                   'gasPrice': gas_price,
-                   'from': account.address,
-                   'nonce': eth_utils.to_hex(nonce)}
-
-        method = getattr(self.contract_obj.functions, method_name)
-        txb = method(*args)
-        txb = txb.build_transaction(tx_data)
-
-        txn = account.sign_transaction(txb)
-        return await self.client.broadcast_and_wait_result(txn)
+        data = self.encode_input(method_name, args)
+
+        def build_tx(tx_nonce: int) -> dict:
+            return {'value': eth_utils.to_hex(value),
+                    'chainId': int(self.client.network_id),
+                    'gas': gas,
+                    **fee.tx_fields(),
+                    'from': account.address,
+                    'nonce': eth_utils.to_hex(tx_nonce),
+                    'to': self.contract_address,
+                    'data': data}
+
+        return await self.client.sign_and_send(account, build_tx, nonce)
+
+    def build_call(self, method_name: str, args: tuple) -> Tuple[dict, List[str]]:
+        txb = {"to": self.contract_address, "data": self.encode_input(method_name, args)}
+        return txb, self.output_types(method_name)
+
+    @staticmethod
+    def decode_call(output_types: List[str], resp: str) -> tuple:
+        if output_types == ["uint256"]:
+            return erc20_codec.decode_uint256(resp),
+        return eth_abi.decode(output_types, bytes.fromhex(resp[2:]))
 
     async def call_contract(self, method_name: str, args: tuple):
-        tx_data = {"value": eth_utils.to_hex(0),
-                   'gasPrice': None,
-                   'gas': eth_utils.to_hex(100000),
-                   "chainId": eth_utils.to_hex(self.client.network_id)}
+        txb, output_types = self.build_call(method_name, args)
+        resp = await self.client.call(txb)
+        return self.decode_call(output_types, resp)
 
-        method = self.contract_obj.get_function_by_name(method_name)
 
-        txb = method(*args)
+class ERC20(AsyncContract):
+    """
+    Encodes transfer/approve/transferFrom/balanceOf/allowance with erc20_codec,
+    the web3 contract object is built only for other methods of abi_info.
+    """
 
-        txb = txb.build_transaction(tx_data)
-        resp = await self.client.call(txb)
-        return eth_abi.decode([x.get('type') for x in method.abi.get("outputs")], bytes.fromhex(resp[2:]))
+    def __init__(self, client: AsyncEth, contract_address: str, abi_info=erc20_abi):
+        super().__init__(client, contract_address, abi_info)
 
+    def encode_input(self, method_name: str, args: tuple) -> str:
+        encoder = erc20_codec.encoders.get(method_name)
+        if encoder is None:
+            return super().encode_input(method_name, args)
+        return encoder(*args)
 
-class ERC20(AsyncContract):
-    async def transfer(self, to_, amount, signer_key, gas_price, gas=100000, nonce=None):
-        return await self.send_transaction("transfer", (to_, amount), signer_key, gas_price, gas, nonce)
+    def output_types(self, method_name: str) -> List[str]:
+        if method_name in erc20_codec.uint256_outputs:
+            return ["uint256"]
+        return super().output_types(method_name)
 
-    async def approve(self, to_, amount, signer_key, gas_price, gas=100000, nonce=None):
-        return await self.send_transaction("approve", (to_, amount), signer_key, gas_price, gas, nonce)
+    async def transfer(self, to_, amount, signer_key, fee, gas=100000, nonce=None):
+        return await self.send_transaction("transfer", (to_, amount), signer_key, fee, gas, nonce)
 
-    async def transfer_from(self, from_, to_, amount, signer_key, gas_price, gas=100000, nonce=None):
-        return await self.send_transaction("transferFrom", (from_, to_, amount), signer_key, gas_price, gas, nonce)
+    async def approve(self, to_, amount, signer_key, fee, gas=100000, nonce=None):
+        return await self.send_transaction("approve", (to_, amount), signer_key, fee, gas, nonce)
+
+    async def transfer_from(self, from_, to_, amount, signer_key, fee, gas=100000, nonce=None):
+        return await self.send_transaction("transferFrom", (from_, to_, amount), signer_key, fee, gas, nonce)
 
     async def allowance(self, owner, spender) -> int:
         resp = await self.call_contract("allowance", (owner, spender))
@@ -236,11 +448,35 @@ class ERC20(AsyncContract):
         return resp[0]
 
 
+class Disperse(AsyncContract):
+    """
+    Disperse contract (disperse.app): pays many recipients from the signer in one transaction.
+    """
+
+    def __init__(self, client: AsyncEth, contract_address: str):
+        super().__init__(client, contract_address, abi_info=None)
+
+    def encode_input(self, method_name: str, args: tuple) -> str:
+        return disperse.encoders[method_name](*args)
+
+    async def disperse_ether(self, recipients: List[str], values: List[int], signer_key, fee, gas, nonce=None):
+        recipients = [eth_utils.to_checksum_address(x) for x in recipients]
+        return await self.send_transaction("disperseEther", (recipients, values), signer_key, fee, gas, nonce,
+                                           value=sum(values))
+
+    async def disperse_token(self, token: str, recipients: List[str], values: List[int], signer_key, fee, gas,
+                             nonce=None):
+        recipients = [eth_utils.to_checksum_address(x) for x in recipients]
+        return await self.send_transaction("disperseToken",
+                                           (eth_utils.to_checksum_address(token), recipients, values),
+                                           signer_key, fee, gas, nonce)
+
+
 async def distribute_eth(client: AsyncEth, accounts: List[eth_account.account.LocalAccount], amount: int,
                          priv_key: str):
-    gas_price = int((await client.gas_price()) * 1.5)
+    fee = FeeQuote.legacy(int((await client.gas_price()) * 1.5))
     for acc in accounts:
-        resp = await client.send_ether(acc.address, amount, priv_key, gas_price=gas_price, gas=21000)
+        resp = await client.send_ether(acc.address, amount, priv_key, fee=fee, gas=21000)
         print(resp)
 
 
@@ -250,9 +486,9 @@ async def distribute_erc20(client: AsyncEth,
                            priv_key: str,
                            contract_address: str):
     contract = ERC20(client, contract_address, erc20_abi)
-    gas_price = int((await client.gas_price()) * 1.5)
+    fee = FeeQuote.legacy(int((await client.gas_price()) * 1.5))
     for account in accounts:
-        resp = await contract.transfer(account.address, amount, priv_key, gas_price)
+        resp = await contract.transfer(account.address, amount, priv_key, fee)
         print(resp)
 
 
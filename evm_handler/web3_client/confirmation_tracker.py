@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from typing import Dict, Tuple
+
+from web3_client.exceptions import TransactionNotFound, StuckTransaction
+
+DEFAULT_CONFIRMATION_TIMEOUT = 210  # same as wait_for_mempool + wait_for_mined + wait_for_receipt
+
+
+class ConfirmationTracker:
+    """
+    Waits for receipts of every broadcast transaction of the process at once:
+    poll() asks for all pending receipts in one JSON-RPC batch, at most once per new block,
+    and resolves the futures returned by track().
+    """
+
+    def __init__(self, timeout=DEFAULT_CONFIRMATION_TIMEOUT):
+        self.timeout = timeout
+        self.active = False  # set by the process that calls poll() periodically
+        self._pending: Dict[str, Tuple[asyncio.Future, float]] = {}  # {tx_hash: (future, deadline)}
+        self._last_block: int = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def track(self, tx_hash: str) -> asyncio.Future:
+        if tx_hash not in self._pending:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[tx_hash] = (future, time.monotonic() + self.timeout)
+        return self._pending[tx_hash][0]
+
+    async def wait(self, tx_hash: str) -> dict:
+        """
+        :return: receipt of tx_hash
+        """
+        future = self.track(tx_hash)
+        try:
+            # the margin covers a poller that stopped calling poll()
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout + 30)
+        except asyncio.TimeoutError:
+            self._pending.pop(tx_hash, None)
+            raise TransactionNotFound(tx_hash)
+
+    async def poll(self, client) -> None:
+        if not self._pending:
+            return
+
+        block = await client.latest_block_number()
+        if block != self._last_block:
+            self._last_block = block
+            tx_hashes = list(self._pending)
+            receipts = await client.get_transaction_receipts(tx_hashes)
+            for tx_hash, receipt in zip(tx_hashes, receipts):
+                if receipt is not None and not isinstance(receipt, Exception):
+                    self._resolve(tx_hash, receipt)
+
+        await self._expire(client)
+
+    async def _expire(self, client) -> None:
+        now = time.monotonic()
+        expired = [tx_hash for tx_hash, (_, deadline) in self._pending.items() if deadline < now]
+        if not expired:
+            return
+
+        txs = await client.batch_request([("eth_getTransactionByHash", [tx_hash]) for tx_hash in expired])
+        for tx_hash, tx in zip(expired, txs):
+            if isinstance(tx, Exception):
+                continue
+            elif tx is None:
+                self._resolve(tx_hash, exc=TransactionNotFound(tx_hash))
+            else:
+                self._resolve(tx_hash, exc=StuckTransaction(tx_hash, tx.get("nonce")))
+
+    def _resolve(self, tx_hash: str, receipt: dict = None, exc: Exception = None) -> None:
+        future, _ = self._pending.pop(tx_hash)
+        if not future.done():
+            if exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(receipt)
+
+
+confirmation_tracker = ConfirmationTracker()
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Description: calldata of Disperse contract (disperse.app), many transfers from one wallet in one transaction.
+from typing import List
+
+import eth_abi
+
+DISPERSE_ETHER_SELECTOR = "0xe63d38ed"  # disperseEther(address[],uint256[]), payable, value = sum(values)
+DISPERSE_TOKEN_SELECTOR = "0xc73a2d60"  # disperseToken(address,address[],uint256[]), needs approve to disperse
+
+
+def encode_disperse_ether(recipients: List[str], values: List[int]) -> str:
+    return DISPERSE_ETHER_SELECTOR + eth_abi.encode(["address[]", "uint256[]"], [recipients, values]).hex()
+
+
+def encode_disperse_token(token: str, recipients: List[str], values: List[int]) -> str:
+    return DISPERSE_TOKEN_SELECTOR + eth_abi.encode(["address", "address[]", "uint256[]"],
+                                                    [token, recipients, values]).hex()
+
+
+encoders = {"disperseEther": encode_disperse_ether,
+            "disperseToken": encode_disperse_token}
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Description: ERC20 calldata with precomputed selectors and fixed-layout results, no web3 contract objects.
+from typing import Callable, Dict
+
+from web3_client.exceptions import Web3Exception, InvalidAddress
+
+# first 4 bytes of keccak256 of the function signature
+TRANSFER_SELECTOR = "0xa9059cbb"  # transfer(address,uint256)
+APPROVE_SELECTOR = "0x095ea7b3"  # approve(address,uint256)
+TRANSFER_FROM_SELECTOR = "0x23b872dd"  # transferFrom(address,address,uint256)
+BALANCE_OF_SELECTOR = "0x70a08231"  # balanceOf(address)
+ALLOWANCE_SELECTOR = "0xdd62ed3e"  # allowance(address,address)
+
+UINT256_MAX = 2 ** 256 - 1
+
+
+def encode_address(address: str) -> str:
+    if len(address) != 42 or not address.startswith("0x"):
+        raise InvalidAddress(address)
+    return address[2:].lower().rjust(64, "0")
+
+
+def encode_uint256(value: int) -> str:
+    if not 0 <= value <= UINT256_MAX:
+        raise ValueError(f"{value} is out of uint256 range")
+    return format(value, "064x")
+
+
+def encode_transfer(to_: str, amount: int) -> str:
+    return TRANSFER_SELECTOR + encode_address(to_) + encode_uint256(amount)
+
+
+def encode_approve(spender: str, amount: int) -> str:
+    return APPROVE_SELECTOR + encode_address(spender) + encode_uint256(amount)
+
+
+def encode_transfer_from(from_: str, to_: str, amount: int) -> str:
+    return TRANSFER_FROM_SELECTOR + encode_address(from_) + encode_address(to_) + encode_uint256(amount)
+
+
+def encode_balance_of(owner: str) -> str:
+    return BALANCE_OF_SELECTOR + encode_address(owner)
+
+
+def encode_allowance(owner: str, spender: str) -> str:
+    return ALLOWANCE_SELECTOR + encode_address(owner) + encode_address(spender)
+
+
+def decode_uint256(resp: str) -> int:
+    """
+    Decode eth_call result of balanceOf/allowance, a single 32 bytes word.
+    """
+    if len(resp) < 66:  # "0x" when the address has no code
+        raise Web3Exception(f"Unexpected eth_call result {resp}")
+    return int(resp[2:66], 16)
+
+
+encoders: Dict[str, Callable[..., str]] = {"transfer": encode_transfer,
+                                           "approve": encode_approve,
+                                           "transferFrom": encode_transfer_from,
+                                           "balanceOf": encode_balance_of,
+                                           "allowance": encode_allowance}
+
+uint256_outputs = {"balanceOf", "allowance"}
+
+
+def benchmark(number=200):
+    """
+    Compare calldata of the codec with web3 contract construction + build_transaction, as the ERC20 class did before.
+    """
+    import timeit
+    import eth_utils
+    from web3.eth import Eth
+    from web3.auto import w3
+    from web3_client.utils import erc20_abi
+
+    contract_address = eth_utils.to_checksum_address("0xdac17f958d2ee523a2206206994597c13d831ec7")
+    owner = eth_utils.to_checksum_address("0x28c6c06298d514db089934071355e5743bf21d60")
+
+    def web3_balance_of():
+        contract_obj = Eth(w3).contract(contract_address, abi=erc20_abi, decode_tuples=True)
+        return contract_obj.get_function_by_name("balanceOf")(owner).build_transaction(
+            {"value": eth_utils.to_hex(0), 'gasPrice': None, 'gas': eth_utils.to_hex(100000),
+             "chainId": eth_utils.to_hex(1)})["data"]
+
+    def codec_balance_of():
+        return encode_balance_of(owner)
+
+    assert web3_balance_of() == codec_balance_of()
+
+    for name, func in (("web3", web3_balance_of), ("codec", codec_balance_of)):
+        seconds = timeit.timeit(func, number=number)
+        print(f"{name:>6} balanceOf calldata: {seconds / number * 10 ** 6:10.2f} us per call")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from typing import Dict, List
+
+from web3_client.providers import is_method_not_supported
+from web3_client.exceptions import Web3Exception
+
+
+class FeeQuote:
+    """
+    Fee fields for one transaction: type-2 (EIP-1559) when the chain has a base fee, legacy gasPrice otherwise.
+    """
+
+    def __init__(self, max_fee_per_gas: int, max_priority_fee_per_gas: int = None):
+        self.max_fee_per_gas = max_fee_per_gas
+        self.max_priority_fee_per_gas = max_priority_fee_per_gas
+
+    @classmethod
+    def legacy(cls, gas_price: int) -> "FeeQuote":
+        return cls(gas_price)
+
+    @property
+    def is_legacy(self) -> bool:
+        return self.max_priority_fee_per_gas is None
+
+    def max_cost(self, gas: int) -> int:
+        """Upper bound of the fee paid for gas units, use it to reserve balance for the transaction."""
+        return self.max_fee_per_gas * gas
+
+    def tx_fields(self) -> dict:
+        if self.is_legacy:
+            return {'gasPrice': self.max_fee_per_gas}
+        return {'type': 2,
+                'maxFeePerGas': self.max_fee_per_gas,
+                'maxPriorityFeePerGas': self.max_priority_fee_per_gas}
+
+    def __repr__(self):
+        return f"FeeQuote(max_fee_per_gas={self.max_fee_per_gas}, " \
+               f"max_priority_fee_per_gas={self.max_priority_fee_per_gas})"
+
+
+class FeeEngine:
+    """
+    Keeps eth_feeHistory of the last history_blocks blocks in memory and quotes fees from it.
+    update() is called once per block and asks only for the blocks it hasn't seen yet,
+    quote() doesn't touch the node, so senders get fees without extra round trips.
+    """
+
+    def __init__(self,
+                 tip_percentile: float,
+                 history_blocks: int,
+                 base_fee_multiplier: float,
+                 min_priority_fee: int,
+                 legacy_gas_price_multiplier: float = 1.5,
+                 update_window: int = 4):
+        """
+        :param tip_percentile: percentile of priority fees paid inside each block
+        :param history_blocks: blocks taken into account for the tip estimation
+        :param base_fee_multiplier: headroom for base fee growth until the transaction is mined,
+         base fee grows by 12.5% per full block at most
+        :param min_priority_fee: tip floor, also used when recent blocks were empty
+        :param legacy_gas_price_multiplier: used on chains without eth_feeHistory or base fee
+        :param update_window: blocks asked for on each update, missed blocks beyond it are skipped
+        """
+        self.tip_percentile = tip_percentile
+        self.history_blocks = history_blocks
+        self.base_fee_multiplier = base_fee_multiplier
+        self.min_priority_fee = min_priority_fee
+        self.legacy_gas_price_multiplier = legacy_gas_price_multiplier
+        self.update_window = update_window
+
+        self.ready = asyncio.Event()
+        self.legacy = False
+        self.last_block: int = None
+        self.next_base_fee: int = 0
+        self.rewards: Dict[int, int] = {}  # {block_number: tip at tip_percentile}, only non-empty blocks
+        self.gas_price: int = 0  # legacy mode only
+
+        self._quote: FeeQuote = None
+
+    async def update(self, client) -> None:
+        if self.legacy:
+            self.gas_price = int(await client.gas_price() * self.legacy_gas_price_multiplier)
+        else:
+            block_count = self.history_blocks if self.last_block is None else self.update_window
+            try:
+                history = await client.fee_history(block_count, "latest", [self.tip_percentile])
+            except Web3Exception as exc:
+                if not is_method_not_supported(exc):
+                    raise
+                self.legacy = True
+                return await self.update(client)
+
+            if not any(int(fee, 16) for fee in history.get("baseFeePerGas", [])):  # pre-London chain
+                self.legacy = True
+                return await self.update(client)
+
+            self._merge(history)
+
+        self._quote = self._make_quote()
+        self.ready.set()
+
+    def _merge(self, history: dict) -> None:
+        oldest_block = int(history["oldestBlock"], 16)
+        base_fees: List[str] = history["baseFeePerGas"]
+        gas_used_ratio: List[float] = history["gasUsedRatio"]
+        rewards: List[List[str]] = history.get("reward") or [[] for _ in gas_used_ratio]
+
+        for offset, (ratio, reward) in enumerate(zip(gas_used_ratio, rewards)):
+            if ratio and reward:
+                self.rewards[oldest_block + offset] = int(reward[0], 16)
+
+        newest_block = oldest_block + len(gas_used_ratio) - 1
+        if self.last_block is None or newest_block >= self.last_block:
+            self.last_block = newest_block
+            self.next_base_fee = int(base_fees[-1], 16)  # the last item is the base fee of the next block
+
+        for block_number in [x for x in self.rewards if x <= self.last_block - self.history_blocks]:
+            del self.rewards[block_number]
+
+    def _make_quote(self) -> FeeQuote:
+        if self.legacy:
+            return FeeQuote.legacy(self.gas_price)
+
+        tips = sorted(self.rewards.values())
+        tip = tips[len(tips) // 2] if tips else 0
+        tip = max(tip, self.min_priority_fee)
+        return FeeQuote(int(self.next_base_fee * self.base_fee_multiplier) + tip, tip)
+
+    async def quote(self) -> FeeQuote:
+        """
+        :return: fees for a transaction sent now, waits only until the first update
+        """
+        await self.ready.wait()
+        return self._quote
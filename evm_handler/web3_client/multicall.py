@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Description: Multicall3 aggregate3 calldata, many eth_call reads in one call.
+from typing import List, Tuple, Union
+
+import eth_abi
+
+from web3_client import erc20_codec
+from web3_client.exceptions import Web3Exception
+
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"  # same address on most EVM chains
+
+AGGREGATE3_SELECTOR = "0x82ad56cb"  # aggregate3((address,bool,bytes)[])
+GET_ETH_BALANCE_SELECTOR = "0x4d2301cc"  # getEthBalance(address)
+
+
+def encode_get_eth_balance(address: str) -> str:
+    return GET_ETH_BALANCE_SELECTOR + erc20_codec.encode_address(address)
+
+
+def encode_aggregate3(calls: List[Tuple[str, str]]) -> str:
+    """
+    :param calls: [(target, calldata), ...], every call is allowed to fail on its own
+    """
+    encoded = eth_abi.encode(["(address,bool,bytes)[]"],
+                             [[(target, True, bytes.fromhex(data[2:])) for target, data in calls]])
+    return AGGREGATE3_SELECTOR + encoded.hex()
+
+
+def decode_aggregate3(resp: str) -> List[Union[str, Exception]]:
+    """
+    :return: return data of every call as hex string, failed calls as exceptions
+    """
+    (results,) = eth_abi.decode(["(bool,bytes)[]"], bytes.fromhex(resp[2:]))
+    return ["0x" + data.hex() if success else Web3Exception(f"Call reverted 0x{data.hex()}")
+            for success, data in results]
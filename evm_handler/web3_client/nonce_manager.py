@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from typing import Dict, List, Set
+
+
+class NonceManager:
+    """
+    Hands out nonces per signer address from local state, so several transactions of the same wallet
+    can be signed and broadcast concurrently without eth_getTransactionCount before each of them.
+    A nonce is in flight from acquire() until release() after the transaction result is known.
+    The node is asked at first use, after an explicit resync and when the wallet is idle, its count only moves
+    the local nonce forward, so a lagging or load balanced node can't move it backwards.
+    """
+
+    def __init__(self):
+        self._nonces: Dict[str, int] = {}  # {address: next nonce}
+        self._gaps: Dict[str, List[int]] = {}  # {address: nonces below next nonce released without broadcast}
+        self._in_flight: Dict[str, Set[int]] = {}  # {address: nonces acquired and not released yet}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _lock(self, address: str) -> asyncio.Lock:
+        if address not in self._locks:
+            self._locks[address] = asyncio.Lock()
+        return self._locks[address]
+
+    async def _node_nonce(self, client, address: str) -> int:
+        pending, latest = await client.batch_request([("eth_getTransactionCount", [address, "pending"]),
+                                                      ("eth_getTransactionCount", [address, "latest"])])
+        for res in (pending, latest):
+            if isinstance(res, Exception):
+                raise res
+        # load balanced nodes may return pending count from a node that is behind
+        return max(int(pending, 16), int(latest, 16))
+
+    async def acquire(self, client, address: str) -> int:
+        async with self._lock(address):
+            in_flight = self._in_flight.setdefault(address, set())
+            if address not in self._nonces:
+                self._nonces[address] = await self._node_nonce(client, address)
+            elif not in_flight:
+                # idle wallet, transactions sent by someone else moved the node ahead
+                node_nonce = await self._node_nonce(client, address)
+                if node_nonce > self._nonces[address]:
+                    self._nonces[address] = node_nonce
+                    self._gaps.pop(address, None)
+            gaps = self._gaps.get(address)
+            if gaps:  # fill gaps first, later nonces are stuck on the node until they are used
+                nonce = gaps.pop(0)
+            else:
+                nonce = self._nonces[address]
+                self._nonces[address] = nonce + 1
+            in_flight.add(nonce)
+            return nonce
+
+    def release(self, address: str, nonce: int, sent: bool, resync: bool = False) -> None:
+        """
+        :param sent: the transaction with this nonce has been broadcast
+        :param resync: the node rejected the nonce, e.g. "nonce too low", or the transaction was dropped,
+         drop the local state so the next acquire() reads the node count and reuses a gap nonce
+        """
+        self._in_flight.get(address, set()).discard(nonce)
+        if resync:
+            self._nonces.pop(address, None)
+            self._gaps.pop(address, None)
+        elif not sent and address in self._nonces:
+            gaps = self._gaps.setdefault(address, [])
+            gaps.append(nonce)
+            gaps.sort()
+            while gaps and gaps[-1] == self._nonces[address] - 1:  # unused nonces at the top are handed out again
+                self._nonces[address] = gaps.pop()
+
+
+nonce_manager = NonceManager()
@@ -1,7 +1,10 @@
-from typing import Any, Union
+from typing import Any, Union, List, Dict, AsyncIterator
 from urllib.parse import urljoin
+import asyncio
+import json
 import httpx
 from httpx import Timeout
+import websockets
 
 from web3_client.exceptions import Web3Exception, \
     TransactionNotFound, \
@@ -11,19 +14,80 @@ from web3_client.exceptions import Web3Exception, \
     InsufficientFundsForTx
 
 DEFAULT_TIMEOUT = 10.0
+DEFAULT_BATCH_SIZE = 100  # most providers reject JSON-RPC batches bigger than 100-1000 calls
+
+
+def raise_for_rpc_error(res: dict, params: Any) -> None:
+    if res.get("error"):
+        if res["error"].get("code") == -32000:
+            if res["error"].get("message", "").startswith("insufficient funds for gas"):
+                raise InsufficientFundsForTx(params)
+            elif res["error"].get("message", "").startswith("replacement transaction underpriced"):
+                raise UnderpricedTransaction(params)
+            elif res["error"].get("message", "").startswith("already known"):
+                raise AlreadyKnown(params)
+            else:
+                raise Web3Exception(res["error"])
+        else:
+            raise Web3Exception(res["error"])
+
+
+def is_method_not_supported(exc: Exception) -> bool:
+    error = exc.args[0] if exc.args else None
+    if isinstance(error, dict):
+        message = error.get("message", "").lower()
+        return error.get("code") == -32601 or "not supported" in message or "does not exist" in message
+    return False
 
 
 class AsyncHTTPProvider:
-    def __init__(self, endpoint_uri: str = None, jw_token: str = None, timeout=DEFAULT_TIMEOUT):
-        self.endpoint_uri = endpoint_uri
+    shared_clients: Dict[str, httpx.AsyncClient] = {}  # {endpoint_uri: client}, one keep-alive pool per endpoint
+    pool_limits = httpx.Limits(max_connections=20, max_keepalive_connections=20, keepalive_expiry=60)
+    http2 = False
 
-        headers = {"Content-Type": "application/json"}
+    def __init__(self, endpoint_uri: str = None, jw_token: str = None, timeout=DEFAULT_TIMEOUT, shared=True):
+        self.endpoint_uri = endpoint_uri
 
-        self.client = httpx.AsyncClient(headers=headers, timeout=Timeout(timeout))
+        self.shared = shared
+        if shared:
+            self.client = self.get_shared_client(endpoint_uri, timeout)
+        else:
+            self.client = httpx.AsyncClient(headers={"Content-Type": "application/json"}, timeout=Timeout(timeout))
 
         self.timeout = timeout
         """Request timeout in second."""
 
+    @classmethod
+    def configure_pool(cls, max_connections: int, max_keepalive_connections: int, keepalive_expiry: float,
+                       http2: bool) -> None:
+        """Set limits for shared clients, must be called before the first request."""
+        cls.pool_limits = httpx.Limits(max_connections=max_connections,
+                                       max_keepalive_connections=max_keepalive_connections,
+                                       keepalive_expiry=keepalive_expiry)
+        cls.http2 = http2
+
+    @classmethod
+    def get_shared_client(cls, endpoint_uri: str, timeout=DEFAULT_TIMEOUT) -> httpx.AsyncClient:
+        client = cls.shared_clients.get(endpoint_uri)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(headers={"Content-Type": "application/json"},
+                                       timeout=Timeout(timeout),
+                                       limits=cls.pool_limits,
+                                       http2=cls.http2)
+            cls.shared_clients[endpoint_uri] = client
+        return client
+
+    @classmethod
+    async def close_shared_clients(cls) -> None:
+        for client in cls.shared_clients.values():
+            await client.aclose()
+        cls.shared_clients.clear()
+
+    async def aclose(self) -> None:
+        """Close the client unless it is shared with other providers."""
+        if not self.shared:
+            await self.client.aclose()
+
     async def make_request(self, method: str, params: Any = None) -> dict:
         if params is None:
             params = {}
@@ -33,17 +97,62 @@ class AsyncHTTPProvider:
         resp.raise_for_status()
 
         res = resp.json()
-        if res.get("error"):
-            if res["error"].get("code") == -32000:
-                if res["error"].get("message", "").startswith("insufficient funds for gas"):
-                    raise InsufficientFundsForTx(params)
-                elif res["error"].get("message", "").startswith("replacement transaction underpriced"):
-                    raise UnderpricedTransaction(params)
-                elif res["error"].get("message", "").startswith("already known"):
-                    raise AlreadyKnown(params)
-                else:
-                    raise Web3Exception(res["error"])
+        raise_for_rpc_error(res, params)
+        return res
+
+    async def make_batch_request(self, method: str, batch: List[dict]) -> List[Union[dict, Exception]]:
+        """
+        Send several JSON-RPC calls in one HTTP request.
+        :param method: url path
+        :param batch: list of JSON-RPC request objects with unique ids
+        :return: responses in the order of batch, failed calls are returned as exceptions instead of being raised
+        """
+        url = urljoin(self.endpoint_uri, method)
+
+        resp = await self.client.post(url, json=batch)
+        resp.raise_for_status()
+
+        res = resp.json()
+        if isinstance(res, dict):  # the whole batch has been rejected
+            raise_for_rpc_error(res, batch)
+            raise Web3Exception(res)
+
+        responses = {item.get("id"): item for item in res}
+        results = []
+        for params in batch:
+            item = responses.get(params["id"])
+            if item is None:
+                results.append(Web3Exception(f"No response for request {params}"))
             else:
-                raise Web3Exception(res["error"])
-        else:
-            return res
+                try:
+                    raise_for_rpc_error(item, params)
+                except Web3Exception as exc:
+                    results.append(exc)
+                else:
+                    results.append(item)
+        return results
+
+
+class AsyncWebSocketProvider:
+    def __init__(self, endpoint_uri: str = None, timeout=DEFAULT_TIMEOUT):
+        self.endpoint_uri = endpoint_uri
+
+        self.timeout = timeout
+        """Connect and subscribe timeout in second."""
+
+    async def subscribe(self, params: list) -> AsyncIterator[dict]:
+        """
+        Open a connection, call eth_subscribe and yield notifications until the connection is closed.
+        :param params: eth_subscribe params, e.g. ["newHeads"]
+        """
+        async with websockets.connect(self.endpoint_uri, open_timeout=self.timeout) as ws:
+            await ws.send(json.dumps({"jsonrpc": "2.0", "method": "eth_subscribe", "params": params, "id": 1}))
+            res = json.loads(await asyncio.wait_for(ws.recv(), self.timeout))
+            raise_for_rpc_error(res, params)
+            subscription_id = res["result"]
+
+            async for message in ws:
+                data = json.loads(message)
+                if data.get("method") == "eth_subscription" and \
+                        data.get("params", {}).get("subscription") == subscription_id:
+                    yield data["params"]["result"]
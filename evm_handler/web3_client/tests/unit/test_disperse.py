@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# run from evm_handler: python -m pytest web3_client/tests
+import asyncio
+import os
+from decimal import Decimal
+
+import eth_abi
+import eth_account
+import eth_utils
+
+from web3_client import disperse
+from web3_client.async_client import AsyncEth
+from web3_client.fees import FeeQuote
+
+# tx_handler reads its config at import, the node and DB are never reached by these tests
+for name, value in {"PROC_HANDLER_DB_SECRET_KEY": "0123456789abcdef",
+                    "PROC_HANDLER_NETWORK_NAME": "test",
+                    "PROC_HANDLER_NETWORK_ID": "1",
+                    "PROC_HANDLER_PROVIDER_URL": "https://node.example.com",
+                    "PROC_HANDLER_SCANNER_URL": "https://scanner.example.com/tx/",
+                    "PROC_HANDLER_WRITE_DSN": "user=u password=p host=localhost port=5432 dbname=d",
+                    "PROC_HANDLER_READ_DSN": "user=u password=p host=localhost port=5432 dbname=d",
+                    "PROC_URL": "http://proc-api.example.com",
+                    "PROC_API_KEY": "test"}.items():
+    os.environ.setdefault(name, value)
+
+import tx_handler  # noqa: E402
+from config import Config as Cfg, StatCode as St  # noqa: E402
+
+DISPERSE_ADDRESS = "0xD152f549545093347A162Dce210e7293f1452150"
+TOKEN = "0xdAC17F958D2ee523a2206206994597C13D831ec7"
+RECIPIENTS = ["0x28C6c06298d514Db089934071355E5743bf21d60",
+              "0x21a31Ee1afC51d94C2eFcCAa2092aD1028285549",
+              "0xDFd5293D8e347dFe59E90eFd55b2956a1343963d"]
+FEE = FeeQuote(30 * 10 ** 9, 10 ** 9)
+SIGNER = eth_account.Account.create()
+
+
+class FakeFees:
+    async def quote(self) -> FeeQuote:
+        return FEE
+
+
+class FakeEth(AsyncEth):
+    """
+    AsyncEth which records built transactions instead of signing and broadcasting them.
+    """
+
+    def __init__(self, allowance: int = 0, failing: tuple = ()):
+        super().__init__("http://node", 1)
+        self.allowance = allowance
+        self.failing = failing
+        self.txs = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def sign_and_send(self, account, build_tx, nonce=None):
+        tx = build_tx(len(self.txs))
+        self.txs.append(tx)
+        if tx["to"] in self.failing:
+            raise ValueError(f"insufficient funds for {tx['to']}")
+        return "0x%064x" % len(self.txs)
+
+    async def call(self, data):
+        return "0x%064x" % self.allowance
+
+
+def use_fake_client(monkeypatch, client: FakeEth, disperse_address=DISPERSE_ADDRESS):
+    monkeypatch.setattr(tx_handler.async_client, "AsyncEth", lambda *_: client)
+    monkeypatch.setattr(tx_handler, "variables", type("Variables", (), {"fees": FakeFees()}), raising=False)
+    monkeypatch.setattr(Cfg, "disperse_address", disperse_address)
+
+
+def decode_call(data: str, types: list) -> tuple:
+    return eth_abi.decode(types, eth_utils.decode_hex("0x" + data[10:]))
+
+
+def withdrawal(withdrawal_id: int, admin_addr_id: int, contract_address: str, amount: int, balance: int) -> dict:
+    return {"withdrawal_id": withdrawal_id, "admin_addr_id": admin_addr_id, "tx_handler_period": withdrawal_id,
+            "withdrawal_address": RECIPIENTS[withdrawal_id % len(RECIPIENTS)],
+            "contract_address": contract_address, "amount": Decimal(amount), "balance": Decimal(balance)}
+
+
+def test_calldata_round_trip():
+    assert disperse.DISPERSE_ETHER_SELECTOR == eth_utils.to_hex(
+        eth_utils.function_signature_to_4byte_selector("disperseEther(address[],uint256[])"))
+    assert disperse.DISPERSE_TOKEN_SELECTOR == eth_utils.to_hex(
+        eth_utils.function_signature_to_4byte_selector("disperseToken(address,address[],uint256[])"))
+
+    data = disperse.encode_disperse_ether(RECIPIENTS, [1, 2, 3])
+    assert data.startswith(disperse.DISPERSE_ETHER_SELECTOR)
+    assert decode_call(data, ["address[]", "uint256[]"]) == (tuple(x.lower() for x in RECIPIENTS), (1, 2, 3))
+
+    data = disperse.encode_disperse_token(TOKEN, RECIPIENTS, [4, 5, 6])
+    assert data.startswith(disperse.DISPERSE_TOKEN_SELECTOR)
+    assert decode_call(data, ["address", "address[]", "uint256[]"]) == \
+        (TOKEN.lower(), tuple(x.lower() for x in RECIPIENTS), (4, 5, 6))
+
+
+def test_fund_gas_sends_one_disperse_for_all_recipients(monkeypatch):
+    client = FakeEth()
+    use_fake_client(monkeypatch, client)
+    res, err, _ = asyncio.run(tx_handler.fund_gas(("http://node", 1), SIGNER.key.hex(), RECIPIENTS, 1000))
+    assert err is None and res == [None] * 3
+    assert len(client.txs) == 1
+    tx = client.txs[0]
+    assert tx["to"] == DISPERSE_ADDRESS
+    assert int(tx["value"], 16) == 3 * 1000
+    assert tx["gas"] == Cfg.disperse_gas + 3 * Cfg.disperse_ether_gas
+    assert tx["maxFeePerGas"] == FEE.max_fee_per_gas
+    assert decode_call(tx["data"], ["address[]", "uint256[]"])[1] == (1000, 1000, 1000)
+
+
+def test_fund_gas_falls_back_to_transfer_per_wallet(monkeypatch):
+    client = FakeEth(failing=(RECIPIENTS[1],))
+    use_fake_client(monkeypatch, client, disperse_address=None)
+    res, err, _ = asyncio.run(tx_handler.fund_gas(("http://node", 1), SIGNER.key.hex(), RECIPIENTS, 1000))
+    assert err is None
+    assert res[0] is None and isinstance(res[1], ValueError) and res[2] is None  # only the failed wallet gets it
+    assert sorted(tx["to"] for tx in client.txs) == sorted(RECIPIENTS)
+    assert all(int(tx["value"], 16) == 1000 and tx["gas"] == 21000 and "data" not in tx for tx in client.txs)
+
+
+def test_withdraw_batch_of_native_coin(monkeypatch):
+    client = FakeEth()
+    use_fake_client(monkeypatch, client)
+    withdrawals = [withdrawal(index, 1, St.native.v, 10 * (index + 1), 100) for index in range(3)]
+    res, err, req_ident, _ = asyncio.run(tx_handler.withdraw_batch(("http://node", 1), St.native.v, 1, SIGNER.address,
+                                                                  SIGNER.key.hex(), withdrawals))
+    assert err is None and res
+    assert req_ident == ([0, 1, 2], 2, 1, None)
+    tx, = client.txs
+    assert int(tx["value"], 16) == 60
+    assert tx["gas"] == Cfg.disperse_gas + 3 * Cfg.disperse_ether_gas
+    recipients, amounts = decode_call(tx["data"], ["address[]", "uint256[]"])
+    assert list(recipients) == [x["withdrawal_address"].lower() for x in withdrawals]
+    assert amounts == (10, 20, 30)
+
+
+def test_withdraw_batch_of_token_approves_disperse_when_allowance_is_short(monkeypatch):
+    client = FakeEth(allowance=50)
+    use_fake_client(monkeypatch, client)
+    withdrawals = [withdrawal(index, 1, TOKEN, 10 * (index + 1), 100) for index in range(3)]
+    res, err, req_ident, _ = asyncio.run(tx_handler.withdraw_batch(("http://node", 1), TOKEN, 1, SIGNER.address,
+                                                                  SIGNER.key.hex(), withdrawals, allowance=20))
+    assert err is None and res
+    assert req_ident[3] == Cfg.approve_amount - 60  # allowance left for the next batch
+    approve, batch = client.txs
+    assert approve["to"] == TOKEN and approve["data"].startswith("0x095ea7b3")
+    assert decode_call(approve["data"], ["address", "uint256"]) == (DISPERSE_ADDRESS.lower(), Cfg.approve_amount)
+    assert batch["to"] == DISPERSE_ADDRESS and int(batch["value"], 16) == 0
+    assert batch["gas"] == Cfg.disperse_gas + 3 * Cfg.disperse_token_gas
+    assert decode_call(batch["data"], ["address", "address[]", "uint256[]"])[::2] == (TOKEN.lower(), (10, 20, 30))
+
+
+def test_withdraw_batch_of_token_uses_recorded_allowance(monkeypatch):
+    client = FakeEth(allowance=0)
+    use_fake_client(monkeypatch, client)
+    withdrawals = [withdrawal(index, 1, TOKEN, 10, 100) for index in range(2)]
+    res, err, req_ident, _ = asyncio.run(tx_handler.withdraw_batch(("http://node", 1), TOKEN, 1, SIGNER.address,
+                                                                  SIGNER.key.hex(), withdrawals, allowance=500))
+    assert err is None
+    assert req_ident[3] == 480
+    assert len(client.txs) == 1 and client.txs[0]["to"] == DISPERSE_ADDRESS  # no allowance call and no approve
+
+
+def test_group_withdrawals_by_admin_and_coin_within_balance():
+    withdrawals = [withdrawal(0, 1, TOKEN, 40, 100),
+                   withdrawal(1, 1, St.native.v, 40, 50),
+                   withdrawal(2, 1, TOKEN, 50, 100),
+                   withdrawal(3, 2, TOKEN, 70, 100),
+                   withdrawal(4, 1, TOKEN, 20, 100),  # 40 + 50 + 20 is above the balance of admin address 1
+                   withdrawal(5, 1, St.native.v, 10, 50)]
+    groups, leftovers = tx_handler.group_withdrawals(withdrawals)
+    assert [[x["withdrawal_id"] for x in group] for group in groups] == [[0, 2], [1, 5], [3]]
+    assert [x["withdrawal_id"] for x in leftovers] == [4]
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# run from evm_handler: python -m pytest web3_client/tests
+import eth_abi
+import eth_utils
+import pytest
+
+from web3_client import erc20_codec
+from web3_client.exceptions import Web3Exception, InvalidAddress
+from web3_client.utils import transfer_topic, address_to_topic
+
+OWNER = "0x28C6c06298d514Db089934071355E5743bf21d60"
+SPENDER = "0xdAC17F958D2ee523a2206206994597C13D831ec7"
+
+# calldata of a USDT transfer of 1 USDT, approve of max allowance and balanceOf as sent by wallets
+TRANSFER_CALLDATA = ("0xa9059cbb"
+                     "00000000000000000000000028c6c06298d514db089934071355e5743bf21d60"
+                     "00000000000000000000000000000000000000000000000000000000000f4240")
+APPROVE_CALLDATA = ("0x095ea7b3"
+                    "00000000000000000000000028c6c06298d514db089934071355e5743bf21d60"
+                    "ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff")
+BALANCE_OF_CALLDATA = "0x70a08231" "00000000000000000000000028c6c06298d514db089934071355e5743bf21d60"
+
+
+@pytest.mark.parametrize("selector, signature", [
+    (erc20_codec.TRANSFER_SELECTOR, "transfer(address,uint256)"),
+    (erc20_codec.APPROVE_SELECTOR, "approve(address,uint256)"),
+    (erc20_codec.TRANSFER_FROM_SELECTOR, "transferFrom(address,address,uint256)"),
+    (erc20_codec.BALANCE_OF_SELECTOR, "balanceOf(address)"),
+    (erc20_codec.ALLOWANCE_SELECTOR, "allowance(address,address)"),
+])
+def test_selectors_are_keccak_of_signatures(selector, signature):
+    assert selector == eth_utils.to_hex(eth_utils.function_signature_to_4byte_selector(signature))
+
+
+def test_known_calldata():
+    assert erc20_codec.encode_transfer(OWNER, 10 ** 6) == TRANSFER_CALLDATA
+    assert erc20_codec.encode_approve(OWNER, erc20_codec.UINT256_MAX) == APPROVE_CALLDATA
+    assert erc20_codec.encode_balance_of(OWNER) == BALANCE_OF_CALLDATA
+
+
+def test_calldata_matches_eth_abi():
+    assert erc20_codec.encode_transfer_from(OWNER, SPENDER, 5) == \
+        erc20_codec.TRANSFER_FROM_SELECTOR + eth_abi.encode(["address", "address", "uint256"],
+                                                            [OWNER, SPENDER, 5]).hex()
+    assert erc20_codec.encode_allowance(OWNER, SPENDER) == \
+        erc20_codec.ALLOWANCE_SELECTOR + eth_abi.encode(["address", "address"], [OWNER, SPENDER]).hex()
+
+
+def test_padding():
+    assert erc20_codec.encode_address(OWNER) == "0" * 24 + OWNER[2:].lower()
+    assert erc20_codec.encode_uint256(0) == "0" * 64
+    assert erc20_codec.encode_uint256(1) == "0" * 63 + "1"
+    assert len(erc20_codec.encode_uint256(erc20_codec.UINT256_MAX)) == 64
+
+
+@pytest.mark.parametrize("value", [-1, erc20_codec.UINT256_MAX + 1])
+def test_uint256_out_of_range(value):
+    with pytest.raises(ValueError):
+        erc20_codec.encode_uint256(value)
+
+
+@pytest.mark.parametrize("address", [OWNER[2:], OWNER[:-1], OWNER + "0"])
+def test_invalid_address(address):
+    with pytest.raises(InvalidAddress):
+        erc20_codec.encode_address(address)
+
+
+def test_decode_uint256():
+    assert erc20_codec.decode_uint256("0x" + erc20_codec.encode_uint256(123456789)) == 123456789
+    assert erc20_codec.decode_uint256(APPROVE_CALLDATA[:2] + APPROVE_CALLDATA[-64:]) == erc20_codec.UINT256_MAX
+    with pytest.raises(Web3Exception):
+        erc20_codec.decode_uint256("0x")  # eth_call of an address without code
+
+
+def test_transfer_log_round_trip():
+    # Transfer(from, to, value) log of the calldata above, decoded the way coins_txs_parser does
+    log = {"address": SPENDER.lower(),
+           "topics": [transfer_topic, address_to_topic(SPENDER), address_to_topic(OWNER)],
+           "data": "0x" + erc20_codec.encode_uint256(10 ** 6)}
+    assert log["topics"][2] == "0x" + TRANSFER_CALLDATA[10:74]
+    assert log["data"] == "0x" + TRANSFER_CALLDATA[74:]
+    assert eth_abi.decode(["address"], eth_utils.decode_hex(log["topics"][2]))[0] == OWNER.lower()
+    assert eth_abi.decode(["uint256"], eth_utils.decode_hex(log["data"]))[0] == 10 ** 6
+    assert transfer_topic == eth_utils.to_hex(eth_utils.keccak(text="Transfer(address,address,uint256)"))
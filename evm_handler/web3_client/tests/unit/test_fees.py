@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# run from evm_handler: python -m pytest web3_client/tests
+import asyncio
+
+import pytest
+
+from web3_client.exceptions import Web3Exception
+from web3_client.fees import FeeEngine, FeeQuote
+
+GWEI = 10 ** 9
+
+
+def fee_history(oldest_block: int, base_fees: list, gas_used_ratio: list, tips: list) -> dict:
+    """
+    eth_feeHistory result for one reward percentile, base_fees has one more item, the base fee of the next block.
+    """
+    return {"oldestBlock": hex(oldest_block),
+            "baseFeePerGas": [hex(fee) for fee in base_fees],
+            "gasUsedRatio": gas_used_ratio,
+            "reward": [[hex(tip)] for tip in tips]}
+
+
+class FakeClient:
+    def __init__(self, histories=(), gas_price: int = 0, error: Exception = None):
+        self.histories = list(histories)
+        self.gas_price_value = gas_price
+        self.error = error
+        self.requests = []
+
+    async def fee_history(self, block_count, newest_block, reward_percentiles):
+        self.requests.append((block_count, newest_block, reward_percentiles))
+        if self.error:
+            raise self.error
+        return self.histories.pop(0)
+
+    async def gas_price(self):
+        return self.gas_price_value
+
+
+def engine(**kwargs) -> FeeEngine:
+    params = {"tip_percentile": 60, "history_blocks": 4, "base_fee_multiplier": 2, "min_priority_fee": GWEI}
+    return FeeEngine(**{**params, **kwargs})
+
+
+def update_and_quote(fees: FeeEngine, client: FakeClient) -> FeeQuote:
+    async def run():
+        await fees.update(client)
+        return await fees.quote()
+
+    return asyncio.run(run())
+
+
+def test_median_tip_at_percentile_and_base_fee_headroom():
+    fees = engine()
+    client = FakeClient([fee_history(100, [10 * GWEI] * 4 + [12 * GWEI], [0.5, 0.9, 0.3, 0.7],
+                                     [2 * GWEI, 5 * GWEI, 3 * GWEI, 4 * GWEI])])
+    quote = update_and_quote(fees, client)
+    assert client.requests == [(4, "latest", [60])]
+    assert fees.last_block == 103
+    assert quote.max_priority_fee_per_gas == 4 * GWEI  # upper median of 2, 3, 4, 5
+    assert quote.max_fee_per_gas == 2 * 12 * GWEI + 4 * GWEI  # next block base fee * multiplier + tip
+    assert quote.tx_fields() == {"type": 2, "maxFeePerGas": 28 * GWEI, "maxPriorityFeePerGas": 4 * GWEI}
+    assert quote.max_cost(21000) == 21000 * 28 * GWEI
+
+
+def test_empty_blocks_are_skipped_and_tip_has_floor():
+    fees = engine(min_priority_fee=3 * GWEI)
+    client = FakeClient([fee_history(100, [GWEI] * 5, [0, 0.5, 0, 0.5], [0, GWEI, 0, 2 * GWEI])])
+    quote = update_and_quote(fees, client)
+    assert fees.rewards == {101: GWEI, 103: 2 * GWEI}
+    assert quote.max_priority_fee_per_gas == 3 * GWEI
+    assert quote.max_fee_per_gas == 2 * GWEI + 3 * GWEI
+
+
+def test_updates_ask_for_new_blocks_and_prune_old_ones():
+    fees = engine(update_window=2)
+    client = FakeClient([fee_history(100, [GWEI] * 5, [0.5] * 4, [GWEI, 2 * GWEI, 3 * GWEI, 4 * GWEI]),
+                         fee_history(103, [GWEI, GWEI, 5 * GWEI], [0.5, 0.5], [4 * GWEI, 9 * GWEI])])
+    update_and_quote(fees, client)
+    quote = update_and_quote(fees, client)
+    assert [request[0] for request in client.requests] == [4, 2]
+    assert fees.last_block == 104
+    assert sorted(fees.rewards) == [101, 102, 103, 104]
+    assert quote.max_priority_fee_per_gas == 4 * GWEI  # upper median of 2, 3, 4, 9
+    assert quote.max_fee_per_gas == 2 * 5 * GWEI + 4 * GWEI
+
+
+def test_legacy_fallback_when_fee_history_is_not_supported():
+    fees = engine()
+    client = FakeClient(gas_price=10 * GWEI,
+                        error=Web3Exception({"code": -32601, "message": "the method eth_feeHistory does not exist"}))
+    quote = update_and_quote(fees, client)
+    assert fees.legacy and quote.is_legacy
+    assert quote.tx_fields() == {"gasPrice": 15 * GWEI}  # gas price * legacy_gas_price_multiplier
+
+    update_and_quote(fees, client)
+    assert len(client.requests) == 1  # eth_feeHistory isn't asked again
+
+
+def test_legacy_fallback_on_chain_without_base_fee():
+    fees = engine()
+    client = FakeClient([fee_history(100, [0] * 5, [0.5] * 4, [GWEI] * 4)], gas_price=4 * GWEI)
+    quote = update_and_quote(fees, client)
+    assert quote.is_legacy
+    assert quote.max_fee_per_gas == 6 * GWEI
+
+
+def test_other_errors_are_raised():
+    fees = engine()
+    client = FakeClient(error=Web3Exception({"code": -32000, "message": "header not found"}))
+    with pytest.raises(Web3Exception):
+        asyncio.run(fees.update(client))
+    assert not fees.legacy and not fees.ready.is_set()
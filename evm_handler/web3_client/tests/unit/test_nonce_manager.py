@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# run from evm_handler: python -m pytest web3_client/tests
+import asyncio
+
+import eth_account
+import pytest
+
+from web3_client import async_client
+from web3_client.async_client import AsyncEth
+from web3_client.exceptions import TransactionNotFound
+from web3_client.nonce_manager import NonceManager
+
+ADDRESS = "0x28C6c06298d514Db089934071355E5743bf21d60"
+
+
+class FakeClient:
+    def __init__(self, pending: int, latest: int = None):
+        self.pending = pending
+        self.latest = pending if latest is None else latest
+        self.calls = 0
+
+    async def batch_request(self, requests):
+        self.calls += 1
+        await asyncio.sleep(0)  # let other senders run while the node answers
+        return [hex(self.pending), hex(self.latest)]
+
+
+def test_concurrent_acquire_gives_unique_nonces():
+    async def run():
+        manager, client = NonceManager(), FakeClient(7)
+        nonces = await asyncio.gather(*[manager.acquire(client, ADDRESS) for _ in range(20)])
+        assert sorted(nonces) == list(range(7, 27))
+        assert client.calls == 1
+
+    asyncio.run(run())
+
+
+def test_lagging_node_doesnt_move_nonce_backwards():
+    async def run():
+        manager, client = NonceManager(), FakeClient(5)
+        for expected in (5, 6, 7):
+            nonce = await manager.acquire(client, ADDRESS)
+            assert nonce == expected
+            manager.release(ADDRESS, nonce, sent=True)
+        client.pending = client.latest = 5  # the node hasn't seen the broadcast transactions yet
+        assert await manager.acquire(client, ADDRESS) == 8
+
+    asyncio.run(run())
+
+
+def test_node_behind_on_pending_uses_latest():
+    async def run():
+        manager = NonceManager()
+        assert await manager.acquire(FakeClient(pending=3, latest=9), ADDRESS) == 9
+
+    asyncio.run(run())
+
+
+def test_unsent_nonce_is_reused():
+    async def run():
+        manager, client = NonceManager(), FakeClient(0)
+        first, second, third = [await manager.acquire(client, ADDRESS) for _ in range(3)]
+        manager.release(ADDRESS, third, sent=False)  # the top nonce goes back
+        assert await manager.acquire(client, ADDRESS) == third
+
+        manager.release(ADDRESS, first, sent=False)  # a gap below in-flight nonces is filled first
+        assert await manager.acquire(client, ADDRESS) == first
+        assert await manager.acquire(client, ADDRESS) == 3
+        assert client.calls == 1  # the wallet had nonces in flight all the time
+
+    asyncio.run(run())
+
+
+def test_concurrent_release_and_acquire():
+    async def run():
+        manager, client = NonceManager(), FakeClient(100)
+
+        async def send(fail: bool):
+            nonce = await manager.acquire(client, ADDRESS)
+            await asyncio.sleep(0)
+            manager.release(ADDRESS, nonce, sent=not fail)
+            return None if fail else nonce
+
+        results = await asyncio.gather(*[send(fail=i % 3 == 0) for i in range(30)])
+        sent = [nonce for nonce in results if nonce is not None]
+        assert len(sent) == len(set(sent))
+        # unsent nonces are handed out again, so the next ones continue without holes
+        following = [await manager.acquire(client, ADDRESS) for _ in range(30 - len(sent))]
+        assert sorted(sent + following) == list(range(100, 130))
+
+    asyncio.run(run())
+
+
+def test_resync_reads_node_again():
+    async def run():
+        manager, client = NonceManager(), FakeClient(0)
+        nonce = await manager.acquire(client, ADDRESS)
+        client.pending = client.latest = 4  # transactions sent by someone else
+        manager.release(ADDRESS, nonce, sent=False, resync=True)  # "nonce too low"
+        assert await manager.acquire(client, ADDRESS) == 4
+        assert client.calls == 2
+
+    asyncio.run(run())
+
+
+def test_idle_wallet_is_reconciled_with_node():
+    async def run():
+        manager, client = NonceManager(), FakeClient(0)
+        nonce = await manager.acquire(client, ADDRESS)
+        assert await manager.acquire(client, ADDRESS) == 1  # busy wallet, the node isn't asked
+        assert client.calls == 1
+        manager.release(ADDRESS, nonce, sent=True)
+        manager.release(ADDRESS, 1, sent=False)
+        client.pending = client.latest = 6  # transactions sent by someone else
+        assert await manager.acquire(client, ADDRESS) == 6
+        assert client.calls == 2
+
+    asyncio.run(run())
+
+
+def test_dropped_transaction_nonce_is_reused():
+    async def run():
+        manager, client = NonceManager(), FakeClient(0)
+        dropped, later = [await manager.acquire(client, ADDRESS) for _ in range(2)]
+        # the first transaction never reached the node, the second one waits behind it in the mempool
+        manager.release(ADDRESS, dropped, sent=True, resync=True)
+        manager.release(ADDRESS, later, sent=True)
+        assert await manager.acquire(client, ADDRESS) == dropped
+
+    asyncio.run(run())
+
+
+class FakeEth(AsyncEth):
+    """
+    AsyncEth which transactions never show up on the node.
+    """
+
+    def __init__(self, node: FakeClient):
+        super().__init__("http://node", 1)
+        self.node = node
+        self.broadcasts = []
+
+    async def batch_request(self, requests):
+        return await self.node.batch_request(requests)
+
+    async def broadcast(self, txn) -> str:
+        self.broadcasts.append(txn.hash.hex())
+        return txn.hash.hex()
+
+    async def result(self, tx_hash):
+        raise TransactionNotFound(tx_hash)
+
+
+def test_sign_and_send_rebroadcasts_and_resyncs_lost_transaction(monkeypatch):
+    async def run():
+        manager, node = NonceManager(), FakeClient(3)
+        monkeypatch.setattr(async_client, "nonce_manager", manager)
+        client = FakeEth(node)
+        account = eth_account.Account.create()
+
+        def build_tx(nonce: int) -> dict:
+            return {"to": ADDRESS, "value": 1, "gas": 21000, "gasPrice": 1, "nonce": nonce, "chainId": 1}
+
+        with pytest.raises(TransactionNotFound):
+            await client.sign_and_send(account, build_tx)
+        assert len(client.broadcasts) == 2 and len(set(client.broadcasts)) == 1  # the same signed transaction
+        assert await manager.acquire(node, account.address) == 3  # the lost nonce is taken again
+        assert node.calls == 2
+
+    asyncio.run(run())
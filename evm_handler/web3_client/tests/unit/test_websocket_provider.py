@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# run from evm_handler: python -m pytest web3_client/tests
+import asyncio
+import json
+
+import pytest
+import websockets
+
+from web3_client.exceptions import Web3Exception
+from web3_client.providers import AsyncWebSocketProvider
+
+SUBSCRIPTION_ID = "0x9cef478923ff08bf67fde6c64013158d"
+
+
+def notification(subscription: str, number: int) -> str:
+    return json.dumps({"jsonrpc": "2.0", "method": "eth_subscription",
+                       "params": {"subscription": subscription, "result": {"number": hex(number)}}})
+
+
+async def new_heads_node(ws):
+    """
+    Stub node answering eth_subscribe newHeads and pushing three heads, one of them for another subscription.
+    """
+    request = json.loads(await ws.recv())
+    assert request["method"] == "eth_subscribe" and request["params"] == ["newHeads"]
+    await ws.send(json.dumps({"jsonrpc": "2.0", "id": request["id"], "result": SUBSCRIPTION_ID}))
+    await ws.send(notification(SUBSCRIPTION_ID, 100))
+    await ws.send(notification("0xother", 500))
+    await ws.send(notification(SUBSCRIPTION_ID, 101))
+
+
+async def rejecting_node(ws):
+    request = json.loads(await ws.recv())
+    await ws.send(json.dumps({"jsonrpc": "2.0", "id": request["id"],
+                              "error": {"code": -32601, "message": "the method eth_subscribe does not exist"}}))
+
+
+async def heads_from(handler) -> list:
+    async with websockets.serve(handler, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        provider = AsyncWebSocketProvider(f"ws://127.0.0.1:{port}", timeout=5)
+        return [int(head["number"], 16) async for head in provider.subscribe(["newHeads"])]
+
+
+def test_subscribe_yields_heads_of_own_subscription_until_closed():
+    assert asyncio.run(heads_from(new_heads_node)) == [100, 101]
+
+
+def test_subscribe_raises_rpc_error():
+    with pytest.raises(Web3Exception):
+        asyncio.run(heads_from(rejecting_node))
+
+
+def test_subscribe_reconnects_after_close():
+    async def run():
+        connections = []
+
+        async def handler(ws):
+            connections.append(ws)
+            await new_heads_node(ws)
+
+        async with websockets.serve(handler, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            provider = AsyncWebSocketProvider(f"ws://127.0.0.1:{port}", timeout=5)
+            heads = []
+            for _ in range(2):  # what new_heads_listener does after the node closes the connection
+                heads += [int(head["number"], 16) async for head in provider.subscribe(["newHeads"])]
+        assert heads == [100, 101, 100, 101]
+        assert len(connections) == 2
+
+    asyncio.run(run())
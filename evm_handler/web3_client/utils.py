@@ -227,6 +227,12 @@ erc20_abi = [
     }
 ]
 
+transfer_topic = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"  # Transfer(address,address,uint256)
+
+
+def address_to_topic(address: str) -> str:
+    return "0x" + address[2:].lower().rjust(64, "0")
+
 
 def generate_mnemonic():
     return mnemonic.Mnemonic("english").generate(strength=128)
@@ -3,7 +3,7 @@
 import asyncio
 
 from db.database import DB, write_async_session, engine
-from db.models import Base
+from db.models import Base, queue_notify_ddl
 from config import Config as Cfg
 from api.handler_api_client import Client
 from misc import get_logger
@@ -17,6 +17,9 @@ async def create_models():
     async with engine.begin() as conn:
         await conn.execute(text("CREATE EXTENSION IF NOT EXISTS \"uuid-ossp\";"))
         await conn.run_sync(Base.metadata.create_all)
+        # wake callback_handler on new callbacks, idempotent for existing databases
+        for ddl in queue_notify_ddl:
+            await conn.execute(ddl)
 
 
 def get_handlers_creds():
@@ -2,13 +2,13 @@
 # Description: This module is responsible for handling the callback.
 
 from misc import get_logger
-from db.database import DB, write_async_session
-from db.models import Callbacks
+from db.database import DB, write_async_session, QueueListener
+from db.models import Callbacks, CALLBACKS_CHANNEL
+from config import Config as Cfg
 import api
 
 import asyncio
 import logging
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from datetime import datetime, timedelta, timezone
 
 
@@ -34,11 +34,11 @@ async def execute_callback(
         return resp, None, (callback_id, callback_period)
 
 
-async def callback_handler(logger: logging.Logger) -> None:
+async def callback_handler(logger: logging.Logger) -> int:
     """
     This function is responsible for handling the callback.
     :param logger:
-    :return:
+    :return: count of claimed callbacks
     """
     reqs = []
     async with write_async_session() as session:
@@ -73,17 +73,41 @@ async def callback_handler(logger: logging.Logger) -> None:
                                                         Callbacks.callback_period.key: callback_period},
                                                        commit=True)
                         logger.error(f"callback {callback_id} {exception}")
+        return len(callbacks)
 
 
-async def main():
-    scheduler = AsyncIOScheduler()
-    scheduler._logger.setLevel(logging.ERROR)  # to avoid apscheduler noise warning logs
-    scheduler.add_job(callback_handler, "interval", seconds=1, max_instances=1,
-                      args=(get_logger("callback_handler"),))
-
-    scheduler.start()
+async def queue_worker(event: asyncio.Event, logger: logging.Logger) -> None:
+    """
+    This function runs callback_handler as soon as a callback is inserted and right away again
+    while callbacks keep coming, otherwise every Cfg.queue_poll_interval seconds to pick up postponed retries.
+    :param event: set by QueueListener on NOTIFY
+    :param logger:
+    :return:
+    """
     while True:
-        await asyncio.sleep(1000)
+        event.clear()
+        try:
+            claimed = await callback_handler(logger)
+        except Exception as exc:
+            logger.error(exc)
+            claimed = 0
+        if claimed:
+            continue
+        try:
+            await asyncio.wait_for(event.wait(), Cfg.queue_poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def main():
+    # callback_handler is woken by NOTIFY of callbacks trigger, polling is the fallback
+    queue_listener = QueueListener(Cfg.WRITE_DSN, Cfg.listen_reconnect_interval)
+    background_tasks = [
+        asyncio.create_task(queue_worker(queue_listener.subscribe(CALLBACKS_CHANNEL), get_logger("callback_handler"))),
+        asyncio.create_task(queue_listener.run(get_logger("queue_listener")))]
+
+    # both loops run forever, an exception escaping any of them stops the process instead of leaving it idle
+    await asyncio.gather(*background_tasks)
 
 
 if __name__ == '__main__':
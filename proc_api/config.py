@@ -33,5 +33,8 @@ class Config(object):
     WRITE_POOL_SIZE = 5
     READ_POOL_SIZE = 5
 
+    queue_poll_interval = 10  # seconds, callback_handler polls this often when no NOTIFY arrives
+    listen_reconnect_interval = 5  # seconds between LISTEN reconnect attempts
+
     LOG_PATH = PATH + "/logs"
     LOGGING_FORMATTER, TIME_FORMAT = '%(module)s#[LINE:%(lineno)d]# %(levelname)-3s [%(asctime)s] %(message)s', '%Y-%m-%d %H:%M:%S'
@@ -2,6 +2,8 @@
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy import and_, func, select, update, Column, Row, literal_column
+import asyncio
+import asyncpg
 
 from db.models import User, NetworkHandlers, Customer, Callbacks
 from config import Config as Cfg
@@ -21,6 +23,55 @@ write_async_session = async_sessionmaker(engine, expire_on_commit=False, autoflu
 read_async_session = async_sessionmaker(read_engine, expire_on_commit=False, autoflush=False)
 
 
+class QueueListener:
+    """
+    LISTENs queue channels on a dedicated connection, a LISTEN connection can't be shared through the pool.
+    Every NOTIFY sets the events subscribed to its channel, all of them are set after each (re)connect
+    because notifications sent while the connection was down are lost.
+    """
+
+    def __init__(self, dsn: str, reconnect_interval: float):
+        self.dsn = dsn
+        self.reconnect_interval = reconnect_interval
+        self.events: dict[str, list[asyncio.Event]] = {}
+
+    def subscribe(self, channel: str) -> asyncio.Event:
+        waiter = asyncio.Event()
+        self.events.setdefault(channel, []).append(waiter)
+        return waiter
+
+    def _wake(self, channel: str) -> None:
+        for waiter in self.events.get(channel, []):
+            waiter.set()
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        self._wake(channel)
+
+    async def run(self, logger) -> None:
+        r = dict(s.split("=") for s in self.dsn.split())
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(user=r['user'], password=r['password'], host=r['host'],
+                                             port=int(r['port']), database=r['dbname'])
+                closed = asyncio.Event()
+                conn.add_termination_listener(lambda _: closed.set())
+                for channel in self.events:
+                    await conn.add_listener(channel, self._on_notify)
+                for channel in self.events:
+                    self._wake(channel)
+                await closed.wait()
+                logger.warning("queue listener connection closed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.error(f"queue listener failed: {exc}")
+            finally:
+                if conn is not None and not conn.is_closed():
+                    conn.terminate()
+            await asyncio.sleep(self.reconnect_interval)
+
+
 def array_to_dict(columns: list[Column], values: Row[tuple[type]]):
     resp = {}
     if values:
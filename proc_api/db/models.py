@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from config import Config as Cfg
 
-from sqlalchemy import Column, Integer, String, true, Boolean, ForeignKey, text, false, JSON, DateTime
+from sqlalchemy import Column, Integer, String, true, Boolean, ForeignKey, text, false, JSON, DateTime, DDL
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.types import TypeDecorator, LargeBinary
 from sqlalchemy.orm import relationship
@@ -92,3 +92,25 @@ class NetworkHandlers(Base):
     api_key = Column(EncryptedData(255), nullable=False)
 
     is_active = Column(Boolean, nullable=False, server_default=true())
+
+
+CALLBACKS_CHANNEL = "callbacks_queue"
+
+# callback_handler LISTENs this channel instead of polling, duplicate notifications of one transaction are merged
+queue_notify_ddl = [
+    DDL("""
+CREATE OR REPLACE function notify_queue() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify(TG_ARGV[0], TG_OP);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""),
+    DDL(f"""
+CREATE OR REPLACE TRIGGER notify_callbacks_insert
+  AFTER INSERT
+  ON callbacks
+  FOR EACH ROW
+  EXECUTE PROCEDURE notify_queue('{CALLBACKS_CHANNEL}');
+"""),
+]
@@ -7,7 +7,7 @@ from sqlalchemy import text, exc as sqlalchemy_exc
 from misc import SharedVariables, get_logger
 from config import Config as Cfg, StatCode as St
 from db.database import DB, write_async_session, engine
-from db.models import Base, Coins
+from db.models import Base, Coins, queue_notify_ddl, coins_notify_ddl, lease_migration_ddl
 from web3_client import utils
 
 startup_logger = get_logger("startup_logger")
@@ -19,6 +19,18 @@ async def create_models():
         # await conn.run_sync(Base.metadata.drop_all)
         await conn.execute(text("CREATE EXTENSION IF NOT EXISTS \"uuid-ossp\";"))
         await conn.run_sync(Base.metadata.create_all)
+        # claims are leases which expire if the handler dies
+        for table, lease in (("deposits", "tx_handler_lease_expires_at"), ("deposits", "callback_lease_expires_at"),
+                             ("withdrawals", "tx_handler_lease_expires_at"),
+                             ("withdrawals", "callback_lease_expires_at"), ("user_address", "tx_lease_expires_at")):
+            await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {lease} TIMESTAMPTZ;"))
+            await conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_{lease} ON {table} ({lease});"))
+        await conn.execute(lease_migration_ddl)
+        # wake queue workers on new deposits and withdrawals, idempotent for existing databases
+        for ddl in queue_notify_ddl:
+            await conn.execute(ddl)
+        for ddl in coins_notify_ddl:
+            await conn.execute(ddl)
 
 
 async def insert_users(mnemonic, count_users, role, offset):
@@ -94,6 +94,20 @@ class Config(object):
     admin_accounts = 1
     approve_accounts = 4
 
+    prefetch_window = 3  # blocks downloaded ahead of the one being stored
+
+    queue_poll_interval = 10  # seconds, queue workers poll this often when no NOTIFY arrives
+    listen_reconnect_interval = 5  # seconds between LISTEN reconnect attempts
+    pool_stats_interval = 60  # seconds between reports of DB pool waits and hold times
+
+    lease_seconds = 300  # claimed rows and addresses return to the queue after this unless the job renews them
+    lease_renew_interval = 60  # seconds between renewals of leases held by running jobs
+    lease_reaper_interval = 60  # seconds between releases of expired leases
+
+    accounts_refresh_interval = 10  # seconds, addresses inserted after the user_address.id watermark are loaded
+    accounts_refresh_overlap = 1000  # ids reread below the watermark, concurrent inserts may commit out of id order
+    accounts_resync_interval = 6 * 3600  # seconds between full reloads of addresses, SIGHUP forces one
+
     allowed_slippage = 2
     block_offset = 18
     min_admin_address_native_balance = 50 * (10 ** 6)
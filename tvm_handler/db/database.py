@@ -1,12 +1,17 @@
 #! /bin/usr/python3
 # -*- coding: utf-8 -*-
-from sqlalchemy import Column, and_, func, select, update
+from sqlalchemy import Column, and_, func, select, update, values, column
 from sqlalchemy.dialects import postgresql
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy import event, exc as sa_exc
 from decimal import Decimal
-from typing import List, Tuple, Any, Union
+from typing import List, Tuple, Any, Union, Dict
 from sqlalchemy.orm import aliased
+import asyncio
+import asyncpg
+import time
 
 from .models import Users, UserAddress, Deposits, Withdrawals, Blocks, Coins, Balances
 from config import Config as Cfg, StatCode as St
@@ -17,17 +22,137 @@ def dsn2alchemy_conn_string(dsn_string):
     return f'postgresql+asyncpg://' + f"{r['user']}:{r['password']}@{r['host']}:{r['port']}/{r['dbname']}"
 
 
+
+class PoolStats:
+    """
+    Time spent waiting for a pool connection and holding it from checkout to checkin, since the last report.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_max = 0.0
+
+    def add_wait(self, seconds: float):
+        self.checkouts += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def add_hold(self, seconds: float):
+        self.hold_max = max(self.hold_max, seconds)
+
+    def report(self, pool) -> str:
+        wait_avg = self.wait_total / self.checkouts if self.checkouts else 0.0
+        report = (f"checkouts {self.checkouts}, wait avg {wait_avg:.3f}s max {self.wait_max:.3f}s, "
+                  f"timeouts {self.timeouts}, hold max {self.hold_max:.3f}s, {pool.status()}")
+        self.reset()
+        return report
+
+
+def timed_pool(stats: PoolStats):
+    """
+    This function returns a pool class which records waits for connections into stats,
+    hold times are recorded by pool events of the engine, see track_hold_time.
+    """
+
+    class TimedQueuePool(AsyncAdaptedQueuePool):
+        def connect(self):
+            started = time.monotonic()
+            try:
+                return super().connect()
+            except sa_exc.TimeoutError:
+                stats.timeouts += 1
+                raise
+            finally:
+                stats.add_wait(time.monotonic() - started)
+
+    return TimedQueuePool
+
+
+def track_hold_time(async_engine, stats: PoolStats):
+    @event.listens_for(async_engine.sync_engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.monotonic()
+
+    @event.listens_for(async_engine.sync_engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop("checked_out_at", None)
+        if checked_out_at is not None:
+            stats.add_hold(time.monotonic() - checked_out_at)
+
+
+write_pool_stats = PoolStats()
+read_pool_stats = PoolStats()
+
 engine = create_async_engine(dsn2alchemy_conn_string(Cfg.WRITE_DSN), pool_timeout=10, pool_recycle=3600,
-                             pool_size=Cfg.WRITE_POOL_SIZE, max_overflow=0, future=True, query_cache_size=0)
+                             pool_size=Cfg.WRITE_POOL_SIZE, max_overflow=0, future=True,
+                             poolclass=timed_pool(write_pool_stats), query_cache_size=0)
 engine.execution_options(compiled_cache=None)
 read_engine = create_async_engine(dsn2alchemy_conn_string(Cfg.READ_DSN), pool_timeout=10, pool_recycle=3600,
-                                  pool_size=Cfg.WRITE_POOL_SIZE, max_overflow=0, future=True, query_cache_size=0)
+                                  pool_size=Cfg.WRITE_POOL_SIZE, max_overflow=0, future=True,
+                                  poolclass=timed_pool(read_pool_stats), query_cache_size=0)
 engine.execution_options(compiled_cache=None)
+track_hold_time(engine, write_pool_stats)
+track_hold_time(read_engine, read_pool_stats)
 
 write_async_session = async_sessionmaker(engine, expire_on_commit=False, autoflush=False)
 read_async_session = async_sessionmaker(read_engine, expire_on_commit=False, autoflush=False)
 
 
+class QueueListener:
+    """
+    LISTENs queue channels on a dedicated connection, a LISTEN connection can't be shared through the pool.
+    Every NOTIFY sets the events subscribed to its channel, all of them are set after each (re)connect
+    because notifications sent while the connection was down are lost.
+    """
+
+    def __init__(self, dsn: str, reconnect_interval: float):
+        self.dsn = dsn
+        self.reconnect_interval = reconnect_interval
+        self.events: Dict[str, List[asyncio.Event]] = {}
+
+    def subscribe(self, channel: str) -> asyncio.Event:
+        waiter = asyncio.Event()
+        self.events.setdefault(channel, []).append(waiter)
+        return waiter
+
+    def _wake(self, channel: str) -> None:
+        for waiter in self.events.get(channel, []):
+            waiter.set()
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        self._wake(channel)
+
+    async def run(self, logger) -> None:
+        r = dict(s.split("=") for s in self.dsn.split())
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(user=r['user'], password=r['password'], host=r['host'],
+                                             port=int(r['port']), database=r['dbname'])
+                closed = asyncio.Event()
+                conn.add_termination_listener(lambda _: closed.set())
+                for channel in self.events:
+                    await conn.add_listener(channel, self._on_notify)
+                for channel in self.events:
+                    self._wake(channel)
+                await closed.wait()
+                logger.warning("queue listener connection closed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.error(f"queue listener failed: {exc}")
+            finally:
+                if conn is not None and not conn.is_closed():
+                    conn.terminate()
+            await asyncio.sleep(self.reconnect_interval)
+
+
 def array_prepare_to_json(columns, values):
     resp = {}
     for index, col in enumerate(columns):
@@ -54,6 +179,14 @@ def unpack_column_to_array(values):
     return [x[0] for x in values]
 
 
+def lease_until():
+    return func.now() + timedelta(seconds=Cfg.lease_seconds)
+
+
+# lease of rows and addresses which outcome is unknown, the reaper never releases it, it's cleared by hand
+HELD_FOR_REVIEW = datetime(9999, 12, 31, tzinfo=timezone.utc)
+
+
 class DB(object):
     def __init__(self, session, logger=None):
         self.session = session
@@ -103,9 +236,16 @@ class DB(object):
         resp = await self.session.execute(stmt)
         return resp.fetchall()
 
-    async def all_accounts(self) -> List[Tuple[str, str]]:
+    async def all_accounts(self, after_id: Union[int, None] = None) -> List[Tuple[int, str, int]]:
+        """
+        :param after_id: only addresses with greater user_address.id, all of them if None
+        :return: [(address_id, public, role), ...] ordered by address_id
+        """
         stmt = select(UserAddress.id, UserAddress.public, Users.role)
         stmt = stmt.join(Users, Users.id == UserAddress.user_id)
+        if after_id is not None:
+            stmt = stmt.where(UserAddress.id > after_id)
+        stmt = stmt.order_by(UserAddress.id)
         resp = await self.session.execute(stmt)
         return resp.fetchall()
 
@@ -203,6 +343,49 @@ class DB(object):
             await self.session.commit()
         return resp
 
+    async def _bulk_update(self, model, rows: List[dict], commit: bool = False):
+        """
+        This function applies per-row updates of a whole batch with one UPDATE ... FROM (VALUES ...)
+        per set of updated columns, so a batch costs a few statements and one commit instead of one per row.
+        :param rows: [{"id": row_id, column_key: value, ...}, ...]
+        """
+        shapes: Dict[Tuple[str, ...], List[dict]] = {}
+        for row in rows:
+            shapes.setdefault(tuple(sorted(row)), []).append(row)
+        try:
+            for keys, shape_rows in shapes.items():
+                data = values(*[column(key, model.__table__.c[key].type) for key in keys], name="data").data(
+                    [tuple(row[key] for key in keys) for row in shape_rows])
+                stmt = (update(model)
+                        .where(model.id == data.c.id)
+                        .values({key: data.c[key] for key in keys if key != "id"}))
+                await self.session.execute(stmt, execution_options={"synchronize_session": False})
+            if commit:
+                await self.session.commit()
+        except Exception as exc:
+            await self.session.rollback()
+            raise exc
+
+    async def bulk_update_deposits(self, rows: List[dict], commit: bool = False):
+        """
+        :param rows: [{"id": deposit_id, column_key: value, ...}, ...], each row may update its own columns
+        """
+        await self._bulk_update(Deposits, rows, commit)
+
+    async def bulk_update_withdrawals(self, rows: List[dict], commit: bool = False):
+        """
+        :param rows: [{"id": withdrawal_id, column_key: value, ...}, ...], each row may update its own columns
+        """
+        await self._bulk_update(Withdrawals, rows, commit)
+
+    async def update_user_addresses_by_ids(self, address_ids: List[int], data: dict, commit: bool = False):
+        stmt = update(UserAddress).where(UserAddress.id.in_(address_ids))
+        stmt = stmt.values(data)
+        resp = await self.session.execute(stmt)
+        if commit:
+            await self.session.commit()
+        return resp
+
     async def upsert_balance(self, address_id: str, coin_id: str, balance: Decimal, commit: bool = False):
         stmt = postgresql.insert(Balances).values({
             Balances.address_id.key: address_id,
@@ -225,7 +408,7 @@ class DB(object):
             select(Deposits.id, Deposits.address_id, Users.id.label("user_id"), Deposits.contract_address,
                    Coins.name.label("coin_name"), Coins.current_rate, Coins.decimal)
             .where(and_(
-                Deposits.locked_by_callback == False,  # Assuming 'locked_by_callback' is a Boolean column
+                Deposits.callback_lease_expires_at.is_(None),
                 Deposits.is_notified == False,
                 Deposits.time_to_callback < func.NOW()
             ))
@@ -251,7 +434,7 @@ class DB(object):
         # Define the main query
         stmt = (
             update(Deposits)
-            .values(locked_by_callback=True)
+            .values(callback_lease_expires_at=lease_until())
             .where(Deposits.id == subquery.c.id)
             .returning(*columns)
         )
@@ -274,7 +457,7 @@ class DB(object):
             .join(Coins, Coins.contract_address == Withdrawals.contract_address)
             .where(and_(
                 Withdrawals.tx_hash_out != None,  # Assuming 'tx_hash_out' is not nullable
-                Withdrawals.locked_by_callback == False,  # Assuming 'locked_by_callback' is a Boolean column
+                Withdrawals.callback_lease_expires_at.is_(None),
                 Withdrawals.is_notified == False,
                 Withdrawals.time_to_callback < func.NOW()
             ))
@@ -297,7 +480,7 @@ class DB(object):
 
         stmt = (
             update(Withdrawals)
-            .values(locked_by_callback=True)
+            .values(callback_lease_expires_at=lease_until())
             .where(Withdrawals.id == subquery.c.id)
             .returning(*columns)
         )
@@ -324,9 +507,9 @@ class DB(object):
                     .where(and_(
             Deposits.contract_address == St.native.v,
             Deposits.tx_hash_out.is_(None),
-            Deposits.locked_by_tx_handler == False,
+            Deposits.tx_handler_lease_expires_at.is_(None),
             Deposits.time_to_tx_handler < func.NOW(),
-            user.locked_by_tx == False
+            user.tx_lease_expires_at.is_(None)
         )
         )
                     .join(user, user.id == Deposits.address_id)
@@ -344,7 +527,7 @@ class DB(object):
         ]
         stmt = (
             update(Deposits)
-            .values(locked_by_tx_handler=True)
+            .values(tx_handler_lease_expires_at=lease_until())
             .where(and_(
                 Deposits.id == subquery.c.id
             ))
@@ -358,7 +541,7 @@ class DB(object):
             data = [array_to_dict(columns, row) for row in resp.fetchall()]
 
             user_addresses = [row['address_id'] for row in data]
-            user_addresses_to_lock_stmt = update(UserAddress).values(locked_by_tx=True).where(
+            user_addresses_to_lock_stmt = update(UserAddress).values(tx_lease_expires_at=lease_until()).where(
                 UserAddress.id.in_(user_addresses))
 
             await self.session.execute(user_addresses_to_lock_stmt)
@@ -391,9 +574,9 @@ class DB(object):
                     .where(and_(
             Deposits.contract_address != St.native.v,
             Deposits.tx_hash_out.is_(None),
-            Deposits.locked_by_tx_handler == False,
+            Deposits.tx_handler_lease_expires_at.is_(None),
             Deposits.time_to_tx_handler < func.NOW(),
-            approve.locked_by_tx == False
+            approve.tx_lease_expires_at.is_(None)
         )
         )
                     .join(user, user.id == Deposits.address_id)
@@ -418,7 +601,7 @@ class DB(object):
 
         stmt = (
             update(Deposits)
-            .values(locked_by_tx_handler=True)
+            .values(tx_handler_lease_expires_at=lease_until())
             .where(Deposits.id == subquery.c.id)
             .returning(
                 *columns
@@ -430,11 +613,11 @@ class DB(object):
             data = [array_to_dict(columns, row) for row in resp.fetchall()]
 
             approve_addresses = [row['approve_id'] for row in data]
-            approve_addr_to_lock_stmt = update(UserAddress).values(locked_by_tx=True).where(
+            approve_addr_to_lock_stmt = update(UserAddress).values(tx_lease_expires_at=lease_until()).where(
                 UserAddress.id.in_(approve_addresses))
 
             user_addresses = [row['address_id'] for row in data]
-            user_addresses_to_lock_stmt = update(UserAddress).values(locked_by_tx=True).where(
+            user_addresses_to_lock_stmt = update(UserAddress).values(tx_lease_expires_at=lease_until()).where(
                 UserAddress.id.in_(user_addresses))
 
             await self.session.execute(approve_addr_to_lock_stmt)
@@ -454,7 +637,7 @@ class DB(object):
             select(func.count())
             .select_from(Users)
             .join(UserAddress, UserAddress.user_id == Users.id)
-            .where(and_(Users.role == St.SADMIN.v, UserAddress.locked_by_tx == False))
+            .where(and_(Users.role == St.SADMIN.v, UserAddress.tx_lease_expires_at.is_(None)))
         )
 
         resp = await self.session.execute(stmt)
@@ -470,10 +653,11 @@ class DB(object):
             .join(Users, Users.id == UserAddress.user_id)
             .where(and_(Withdrawals.tx_hash_out.is_(None),
                         Withdrawals.admin_addr_id.is_(None),
+                        Withdrawals.time_to_tx_handler < func.NOW(),
                         Withdrawals.contract_address == Balances.coin_id,
                         Withdrawals.amount < Balances.balance,
                         Users.role == St.SADMIN.v,
-                        UserAddress.locked_by_tx.is_(False)
+                        UserAddress.tx_lease_expires_at.is_(None)
                         )
                    ).limit(count_admins).with_for_update()
         )
@@ -489,26 +673,69 @@ class DB(object):
 
         stmt = (
             update(Withdrawals)
-            .values(admin_addr_id=subquery.c.admin_addr_id)
+            .values(admin_addr_id=subquery.c.admin_addr_id, tx_handler_lease_expires_at=lease_until())
             .where(Withdrawals.id == subquery.c.id)
             .returning(*columns)
         )
 
         try:
             resp = await self.session.execute(stmt)
-            data = resp.fetchall()
+            data = [array_to_dict(columns, row) for row in resp.fetchall()]
+
+            admin_addresses = [row['admin_addr_id'] for row in data]
+            admin_addr_to_lock_stmt = update(UserAddress).values(tx_lease_expires_at=lease_until()).where(
+                UserAddress.id.in_(admin_addresses))
+            await self.session.execute(admin_addr_to_lock_stmt)
+
             await self.session.commit()
-            return [array_to_dict(columns, row) for row in data]
+            return data
         except Exception as exc:
             await self.session.rollback()
             raise exc
 
-    async def get_free_admin_acc(self):
-        stmt = select(UserAddress.id, UserAddress.public, UserAddress.private)
-        stmt = stmt.join(Users, Users.id == UserAddress.user_id)
-        stmt = stmt.where(and_(Users.role == St.SADMIN.v, UserAddress.locked_by_tx == False))
-        resp = await self.session.execute(stmt)
-        return resp.scalar_one_or_none()
+    async def renew_leases(self, lease: Column, ids: List[Union[str, int]]):
+        """
+        This function extends leases of ids which are still held, released rows are skipped.
+        :param lease: tx_handler_lease_expires_at or callback_lease_expires_at of Deposits or Withdrawals,
+        or UserAddress.tx_lease_expires_at
+        """
+        model = lease.class_
+        stmt = (update(model)
+                .where(and_(model.id.in_(ids), lease.is_not(None)))
+                .values({lease.key: lease_until()}))
+        try:
+            await self.session.execute(stmt, execution_options={"synchronize_session": False})
+            await self.session.commit()
+        except Exception as exc:
+            await self.session.rollback()
+            raise exc
+
+    async def release_expired_leases(self) -> Dict[str, List[Union[str, int]]]:
+        """
+        This function returns rows of crashed jobs to their queues. Expired payments of withdrawals keep
+        their admin address, the transaction may be sent already, they only lose the lease and are reported once.
+        :return: {claim name: [row id, ...]}
+        """
+        claims = {"sweeps": Deposits.tx_handler_lease_expires_at,
+                  "deposit_callbacks": Deposits.callback_lease_expires_at,
+                  "withdrawal_callbacks": Withdrawals.callback_lease_expires_at,
+                  "withdrawal_payments": Withdrawals.tx_handler_lease_expires_at,
+                  "addresses": UserAddress.tx_lease_expires_at}
+        released = {}
+        try:
+            for name, lease in claims.items():
+                model = lease.class_
+                stmt = (update(model)
+                        .where(lease < func.now())
+                        .values({lease.key: None})
+                        .returning(model.id))
+                resp = await self.session.execute(stmt, execution_options={"synchronize_session": False})
+                released[name] = resp.scalars().all()
+            await self.session.commit()
+        except Exception as exc:
+            await self.session.rollback()
+            raise exc
+        return released
 
     async def upsert_coins(self, coins: List[dict]) -> None:
         """
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Identity, NUMERIC, BOOLEAN, func, event, DDL, \
+from sqlalchemy import Column, Integer, String, ForeignKey, Identity, NUMERIC, BOOLEAN, func, DDL, \
     text, LargeBinary, UniqueConstraint, BIGINT, DateTime
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
@@ -77,7 +77,8 @@ class UserAddress(Base):
     public = Column(String(42), nullable=False, unique=True)
     private = Column(EncryptedData(128), nullable=False, unique=True)
 
-    locked_by_tx = Column(BOOLEAN, default=False)
+    # user, approve or admin address is busy with a transaction until tx_lease_expires_at, free when it's null
+    tx_lease_expires_at = Column(DateTime(timezone=True), nullable=True, index=True)
 
     user = relationship("Users", backref='_user_address', foreign_keys=[user_id])
     admin = relationship("Users", backref='_admin_address', foreign_keys=[admin_id])
@@ -116,13 +117,14 @@ class Deposits(Base):
 
     time_to_callback = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.fromtimestamp(0))
     callback_period = Column(Integer, nullable=False, default=60)
-    locked_by_callback = Column(BOOLEAN, default=False)
+    # claimed by the callback handler until callback_lease_expires_at, free when it's null
+    callback_lease_expires_at = Column(DateTime(timezone=True), nullable=True, index=True)
     is_notified = Column(BOOLEAN, default=False)
 
     time_to_tx_handler = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.fromtimestamp(0))
     tx_handler_period = Column(Integer, nullable=False, default=60)
-    locked_by_tx_handler = Column(BOOLEAN,
-                                  default=False)  # показывает что этот депозит выполняется обработчиком транзакций
+    # claimed by the transaction handler until tx_handler_lease_expires_at, free when it's null
+    tx_handler_lease_expires_at = Column(DateTime(timezone=True), nullable=True, index=True)
     tx_hash_out = Column(String(66), nullable=True, unique=True)
 
     created_at = Column(DateTime(timezone=True), nullable=False, default=func.now())
@@ -144,11 +146,14 @@ class Withdrawals(Base):
 
     time_to_callback = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.fromtimestamp(0))
     callback_period = Column(Integer, nullable=False, default=60)
-    locked_by_callback = Column(BOOLEAN, default=False)
+    # claimed by the callback handler until callback_lease_expires_at, free when it's null
+    callback_lease_expires_at = Column(DateTime(timezone=True), nullable=True, index=True)
     is_notified = Column(BOOLEAN, default=False)
 
     time_to_tx_handler = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.fromtimestamp(0))
     tx_handler_period = Column(Integer, nullable=False, default=60)
+    # payment by admin_addr_id is leased until tx_handler_lease_expires_at
+    tx_handler_lease_expires_at = Column(DateTime(timezone=True), nullable=True, index=True)
 
     admin_addr_id = Column(Integer, ForeignKey('user_address.id', ondelete='CASCADE'), nullable=True,
                            unique=False)  # админский адрес на время обработки
@@ -163,26 +168,81 @@ class Withdrawals(Base):
     user_currency = Column(String(16), nullable=False)
 
 
-ddl_stmt3 = DDL("""
-CREATE OR REPLACE function update_address_lock_withdrawal() RETURNS trigger AS $$
+# boolean locks stayed set forever after a crash, their state is moved to leases which the reaper releases
+lease_migration_ddl = DDL("""
+DO $$
 BEGIN
-  UPDATE user_address AS adm SET locked_by_tx = CASE WHEN NEW.admin_addr_id IS null THEN false ELSE true END WHERE adm.id = COALESCE(NEW.admin_addr_id, OLD.admin_addr_id);
-  RETURN NEW;
-END;
-$$ LANGUAGE plpgsql; 
+  DROP TRIGGER IF EXISTS on_update_withdrawals ON withdrawals;
+  DROP FUNCTION IF EXISTS update_address_lock_withdrawal();
+  IF EXISTS (SELECT 1 FROM information_schema.columns
+             WHERE table_name = 'deposits' AND column_name = 'locked_by_tx_handler') THEN
+    UPDATE deposits SET tx_handler_lease_expires_at = now() WHERE locked_by_tx_handler AND tx_hash_out IS NULL;
+    UPDATE deposits SET callback_lease_expires_at = now() WHERE locked_by_callback;
+    UPDATE withdrawals SET callback_lease_expires_at = now() WHERE locked_by_callback;
+    UPDATE withdrawals SET tx_handler_lease_expires_at = now()
+      WHERE admin_addr_id IS NOT NULL AND tx_hash_out IS NULL;
+    UPDATE user_address SET tx_lease_expires_at = now() WHERE locked_by_tx;
+    ALTER TABLE deposits DROP COLUMN locked_by_tx_handler, DROP COLUMN locked_by_callback;
+    ALTER TABLE withdrawals DROP COLUMN locked_by_callback;
+    ALTER TABLE user_address DROP COLUMN locked_by_tx;
+  END IF;
+END $$;
 """)
 
-ddl_stmt4 = DDL("""     
-CREATE OR REPLACE TRIGGER on_update_withdrawals
-  AFTER UPDATE of admin_addr_id
-  ON withdrawals
-  FOR EACH ROW
-  EXECUTE PROCEDURE update_address_lock_withdrawal();
-""")
 
+DEPOSITS_CHANNEL = "deposits_queue"
+WITHDRAWALS_CHANNEL = "withdrawals_queue"
+COINS_CHANNEL = "coins_changed"
 
-
-@event.listens_for(Withdrawals.__table__, "after_create")
-def my_func2(target, connection, **kw):
-    connection.execute(ddl_stmt3)
-    connection.execute(ddl_stmt4)
+# queue workers LISTEN these channels instead of polling, duplicate notifications of one transaction are merged
+queue_notify_ddl = [
+    DDL("""
+CREATE OR REPLACE function notify_queue() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify(TG_ARGV[0], TG_OP);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""),
+    DDL(f"""
+CREATE OR REPLACE TRIGGER notify_deposits_insert
+  AFTER INSERT
+  ON deposits
+  FOR EACH ROW
+  EXECUTE PROCEDURE notify_queue('{DEPOSITS_CHANNEL}');
+"""),
+    DDL(f"""
+CREATE OR REPLACE TRIGGER notify_withdrawals_insert
+  AFTER INSERT
+  ON withdrawals
+  FOR EACH ROW
+  EXECUTE PROCEDURE notify_queue('{WITHDRAWALS_CHANNEL}');
+"""),
+    DDL(f"""
+CREATE OR REPLACE TRIGGER notify_withdrawals_sent
+  AFTER UPDATE of tx_hash_out
+  ON withdrawals
+  FOR EACH ROW
+  WHEN (OLD.tx_hash_out IS NULL AND NEW.tx_hash_out IS NOT NULL)
+  EXECUTE PROCEDURE notify_queue('{WITHDRAWALS_CHANNEL}');
+"""),
+]
+
+# processes holding CoinRegistry LISTEN it and reload coins, updates which change nothing don't notify
+coins_notify_ddl = [
+    DDL(f"""
+CREATE OR REPLACE TRIGGER notify_coins_insert
+  AFTER INSERT
+  ON coins
+  FOR EACH ROW
+  EXECUTE PROCEDURE notify_queue('{COINS_CHANNEL}');
+"""),
+    DDL(f"""
+CREATE OR REPLACE TRIGGER notify_coins_update
+  AFTER UPDATE
+  ON coins
+  FOR EACH ROW
+  WHEN (OLD.* IS DISTINCT FROM NEW.*)
+  EXECUTE PROCEDURE notify_queue('{COINS_CHANNEL}');
+"""),
+]
@@ -5,9 +5,10 @@ from logging.handlers import RotatingFileHandler
 from pathlib import Path
 import asyncio
 from decimal import Decimal
-from typing import Dict
+from typing import Dict, List, Union
 
-from config import Config as Cfg
+from config import Config as Cfg, StatCode as St
+from db.models import Coins
 from api import proc_api_client
 from web3_client import utils as web3_utils, providers
 
@@ -77,6 +78,45 @@ class AsyncPool(asyncio.Queue):
             self.put_nowait(item)
 
 
+
+class CoinRegistry:
+    """
+    Coins table kept in memory, so block parsing and API requests don't query it.
+    It's reloaded only after coins change, by update_coin_rates in tx_handler and on NOTIFY of the coins triggers
+    in the API workers.
+    """
+    columns = [Coins.contract_address, Coins.name, Coins.decimal, Coins.min_amount, Coins.fee_amount,
+               Coins.current_rate, Coins.is_active]
+
+    def __init__(self):
+        self.coins: Dict[str, dict] = {}  # {contract_address: coin}
+        self.tokens_hex: Dict[str, dict] = {}  # {hex contract_address: coin}, native coin excluded
+        self.native: Union[dict, None] = None
+
+    def load(self, coins: List[dict]):
+        """
+        :param coins: rows of db.get_coins(CoinRegistry.columns), each coin gets "scale" = 10 ** decimal
+        """
+        coins = {coin[Coins.contract_address.key]: {**coin, "scale": 10 ** coin[Coins.decimal.key]}
+                 for coin in coins}
+        self.tokens_hex = {web3_utils.to_hex_address(contract_address): coin
+                           for contract_address, coin in coins.items() if contract_address != St.native.v}
+        self.native = coins.get(St.native.v)
+        self.coins = coins
+
+    @staticmethod
+    def quote_amount(coin: dict, amount: int) -> Decimal:
+        return Decimal(amount / coin["scale"]) * coin[Coins.current_rate.key]
+
+    def to_json(self, columns: list) -> Dict[str, dict]:
+        """
+        :return: {contract_address: {column_key: value, ...}}, decimals as strings
+        """
+        return {contract_address: {col.key: str(coin[col.key]) if isinstance(coin[col.key], Decimal)
+                                   else coin[col.key] for col in columns}
+                for contract_address, coin in self.coins.items()}
+
+
 class SharedVariables:
     def __init__(self):
         self.last_handled_block: int = None
@@ -88,6 +128,8 @@ class SharedVariables:
         self.handler_accounts_hex: Dict[str, str] = {}  # {address: address_id}
 
         self.user_accounts_event = asyncio.Event()
+        self.accounts_lock = asyncio.Lock()  # incremental refresh and full resync don't interleave
+        self.accounts_watermark = 0  # the highest user_address.id loaded into the maps above
 
         self.api_keys_pool = AsyncPool()
         self.providers_request_explorer = web3_utils.TronRequestExplorer()
@@ -107,6 +149,7 @@ class SharedVariables:
 
         self.energy_price = 420
         self.coins_abi: Dict[str, Dict] = {}
+        self.coins = CoinRegistry()  # loaded at startup, reloaded by update_coin_rates
         self.estimated_trc20_fee = 30_000_000  # TODO parse it using blocks
         self.estimated_native_fee = 3_000_000
 
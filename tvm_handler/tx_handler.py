@@ -1,23 +1,28 @@
 # -*- coding: utf-8 -*-
 # Description: This module contains the main logic of the TRC20 parser and the native coin.
-from misc import get_logger, SharedVariables, amount_to_quote_amount, \
+from misc import get_logger, SharedVariables, CoinRegistry, \
     get_round_for_rate, amount_to_display, proc_api_client
 from web3_client import utils as web3_utils
 from web3_client.async_client import MyAsyncTron, TRC20, BuildTransactionError, TransactionNotFound, TvmError, \
     UnableToGetReceiptError, ApiError, BadSignature, TaposError, TransactionError, ValidationError
-from db.database import DB, write_async_session, read_async_session, Withdrawals
-from db.models import Deposits, Coins, UserAddress
+from db.database import DB, write_async_session, read_async_session, Withdrawals, QueueListener, \
+    engine, read_engine, write_pool_stats, read_pool_stats, HELD_FOR_REVIEW
+from db.models import Deposits, Coins, UserAddress, DEPOSITS_CHANNEL, WITHDRAWALS_CHANNEL
 from config import Config as Cfg, StatCode as St
 import api
 
 import asyncio
 import logging
+import signal
+from collections import deque
 from decimal import Decimal
 import eth_utils
 from tronpy.abi import trx_abi
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.job import Job
 from datetime import datetime, timedelta, timezone
+from contextlib import asynccontextmanager
+from sqlalchemy import Column
 import httpx
 
 
@@ -253,7 +258,7 @@ async def admin_coins_bal():
         users: list[tuple[str, str]] = await db.users_addresses([St.SADMIN.v])
 
         if users:
-            coins = await db.get_coins([Coins.contract_address, Coins.name])
+            coins = list(variables.coins.coins.values())
             for addr_id, address in users:
                 for coin in coins:
                     contract_address: str = coin[Coins.contract_address.key]
@@ -310,52 +315,79 @@ async def update_in_memory_trusted_block():
     common_logger.info(f"Trusted block: {variables.trusted_block}")
 
 
+async def load_coin_registry():
+    async with read_async_session() as session:
+        db = DB(session)
+        variables.coins.load(await db.get_coins(CoinRegistry.columns))
+
+
 async def update_coin_rates():
+    """
+    This function writes rates which differ from the coin registry and reloads it if anything was written.
+    """
     rates, exceptions = await api.coin_rate_client.get_coin_rates()
     if exceptions:
         for exc in exceptions:
             common_logger.error(exc)
 
+    changed = False
     async with write_async_session() as session:
         db = DB(session)
-        coins = await db.get_coins([Coins.contract_address, Coins.name, Coins.current_rate])
-
-        for coin in coins:
+        for contract_address, coin in variables.coins.coins.items():
             if coin[Coins.name.key] != Cfg.quote_coin:
                 symbol = f"{coin[Coins.name.key]}{Cfg.quote_coin}"
-                if rates.get(symbol):
-                    await db.update_coin(coin[Coins.contract_address.key], {Coins.current_rate.key: rates[symbol]},
-                                         commit=True)
-                else:
+                if not rates.get(symbol):
                     common_logger.error(f"No exchange rate for {symbol}")
+                    continue
+                rate = Decimal(str(rates[symbol]))
             else:
-                if coin[Coins.current_rate.key] != 1:
-                    await db.update_coin(coin[Coins.contract_address.key], {Coins.current_rate.key: 1}, commit=True)
+                rate = Decimal(1)
+            if rate != coin[Coins.current_rate.key]:
+                await db.update_coin(contract_address, {Coins.current_rate.key: rate}, commit=True)
+                changed = True
+    if changed:
+        await load_coin_registry()
 
 
-async def update_in_memory_accounts():
+async def update_in_memory_accounts(full: bool = False):
     """
-    This function updates the user_accounts dictionary in the variables module.
-    :param
+    This function adds addresses inserted after variables.accounts_watermark to the in-memory account maps,
+    so to_hex_address runs for new addresses only.
+    With full it reloads all addresses and replaces the maps, which also drops stale entries and role changes.
+    :param full: reload all addresses instead of the new ones
     :return:
     """
-    try:
-        async with write_async_session() as session:
-            db = DB(session)
-            users = await db.all_accounts()
-    except Exception as exc:
-        log_params = {"error": exc}
-        common_logger.error(f"update_in_memory_accounts {log_params}")
-        raise
-    else:
-        variables.user_accounts_event.clear()
+    async with variables.accounts_lock:
+        after_id = None if full else variables.accounts_watermark - Cfg.accounts_refresh_overlap
+        try:
+            async with write_async_session() as session:
+                db = DB(session)
+                users = await db.all_accounts(after_id)
+        except Exception as exc:
+            log_params = {"error": exc}
+            common_logger.error(f"update_in_memory_accounts {log_params}")
+            variables.user_accounts_event.set()
+            raise
+
+        if full:
+            user_accounts, user_accounts_hex, handler_accounts_hex = {}, {}, {}
+        else:
+            user_accounts, user_accounts_hex, handler_accounts_hex = \
+                variables.user_accounts, variables.user_accounts_hex, variables.handler_accounts_hex
         for address_id, user_address, role in users:
             if role == St.USER.v:
-                variables.user_accounts[user_address] = address_id
-                variables.user_accounts_hex[web3_utils.to_hex_address(user_address)] = address_id
+                user_accounts[user_address] = address_id
+                user_accounts_hex[web3_utils.to_hex_address(user_address)] = address_id
             else:
-                variables.handler_accounts_hex[web3_utils.to_hex_address(user_address)] = address_id
-    finally:
+                handler_accounts_hex[web3_utils.to_hex_address(user_address)] = address_id
+
+        if full:
+            variables.user_accounts, variables.user_accounts_hex, variables.handler_accounts_hex = \
+                user_accounts, user_accounts_hex, handler_accounts_hex
+            variables.accounts_watermark = users[-1][0] if users else 0
+            common_logger.info(f"update_in_memory_accounts full resync loaded {len(users)} addresses")
+        elif users:
+            variables.accounts_watermark = max(variables.accounts_watermark, users[-1][0])
         variables.user_accounts_event.set()
 
 
@@ -380,15 +412,12 @@ async def coins_txs_parser(transactions: list[dict], coins: dict[str, dict]):
                         amount: int = trx_abi.decode_single("uint256", eth_utils.decode_hex(unit["log"][0]["data"]))
                         coin = coins[unit["contract_address"]]
                         if amount >= coin[Coins.min_amount.key]:
-                            quote_amount: Decimal = amount_to_quote_amount(amount,
-                                                                           coin[Coins.current_rate.key],
-                                                                           coin[Coins.decimal.key])
+                            quote_amount: Decimal = CoinRegistry.quote_amount(coin, amount)
                             deposits.append({
                                 Deposits.address_id.key: address_id,
                                 Deposits.amount.key: amount,
                                 Deposits.quote_amount.key: quote_amount,
-                                Deposits.contract_address.key: web3_utils.to_base58check_address(
-                                    unit["contract_address"]),
+                                Deposits.contract_address.key: coin[Coins.contract_address.key],
                                 Deposits.tx_hash_in.key: unit['id']
                             })
                         else:
@@ -413,9 +442,7 @@ async def native_txs_parser(block: dict, native_coin: dict):
                 if recipient in variables.user_accounts_hex and sender not in variables.handler_accounts_hex:
                     if amount >= native_coin[Coins.min_amount.key]:
                         address_id = variables.user_accounts_hex[recipient]
-                        quote_amount: Decimal = amount_to_quote_amount(amount,
-                                                                       native_coin[Coins.current_rate.key],
-                                                                       native_coin[Coins.decimal.key])
+                        quote_amount: Decimal = CoinRegistry.quote_amount(native_coin, amount)
                         deposits.append({
                             Deposits.address_id.key: address_id,
                             Deposits.amount.key: amount,
@@ -431,99 +458,140 @@ async def native_txs_parser(block: dict, native_coin: dict):
     return deposits
 
 
-async def block_parser():
+async def fetch_block(block_num: int) -> tuple[list[dict], dict]:
     conn_creds_1 = await variables.api_keys_pool.get()
     conn_creds_2 = await variables.api_keys_pool.get()
     try:
         async with MyAsyncTron(*conn_creds_1) as client1, MyAsyncTron(*conn_creds_2) as client2:
-            current_block = variables.last_handled_block + 1
-
-            if variables.trusted_block - current_block < Cfg.block_offset * Cfg.allowed_slippage:
-                try:
-                    variables.trusted_block = await client1.latest_block_number() - Cfg.block_offset
-                except Exception as exc:
-                    if not isinstance(exc, httpx.HTTPStatusError):
-                        log_params = {"error": exc}
-                        common_logger.error(f"block_parser {log_params}")
-                    return
-
-            if variables.trusted_block > current_block:
-
-                tasks = [asyncio.create_task(client1.get_txs_of_block(current_block)),
-                         asyncio.create_task(client2.get_entire_block(current_block))]
-
-                try:
-                    transactions, block = await asyncio.gather(*tasks)
-                except Exception as exc:
-                    if not isinstance(exc, httpx.HTTPStatusError):
-                        log_params = {"error": exc}
-                        common_logger.error(f"block_parser {log_params}")
-                else:
-                    async with write_async_session() as session:
-                        db = DB(session)
-                        resp = await db.get_coins(
-                            [Coins.contract_address, Coins.name, Coins.current_rate, Coins.min_amount,
-                             Coins.decimal])
-
-                        coins = {web3_utils.to_hex_address(coin[Coins.contract_address.key]): coin for coin in resp
-                                 if
-                                 coin[Coins.contract_address.key] != St.native.v}
-                        coin_txs = await coins_txs_parser(transactions, coins)
-
-                        native_coin = [coin for coin in resp if coin[Coins.contract_address.key] == St.native.v][0]
-                        native_txs = await native_txs_parser(block, native_coin)
-
-                        deposits = coin_txs + native_txs
-
-                        if deposits:
-                            await db.add_deposits(deposits)
-                        await db.insert_last_handled_block(current_block, commit=True)
-                        variables.last_handled_block = current_block
+            tasks = [asyncio.create_task(client1.get_txs_of_block(block_num)),
+                     asyncio.create_task(client2.get_entire_block(block_num))]
+            transactions, block = await asyncio.gather(*tasks)
     finally:
         await variables.api_keys_pool.put(conn_creds_1)
         await variables.api_keys_pool.put(conn_creds_2)
+    return transactions, block
+
+
+async def store_block(block_num: int, transactions: list[dict], block: dict):
+    async with write_async_session() as session:
+        db = DB(session)
+        coin_txs = await coins_txs_parser(transactions, variables.coins.tokens_hex)
+        native_txs = await native_txs_parser(block, variables.coins.native)
+
+        deposits = coin_txs + native_txs
+
+        if deposits:
+            await db.add_deposits(deposits)
+        await db.insert_last_handled_block(block_num, commit=True)
+        variables.last_handled_block = block_num
+
+
+async def block_parser():
+    next_block = variables.last_handled_block + 1
+
+    if variables.trusted_block - next_block < Cfg.block_offset * Cfg.allowed_slippage:
+        try:
+            variables.trusted_block = await get_trusted_block()
+        except Exception as exc:
+            if not isinstance(exc, httpx.HTTPStatusError):
+                log_params = {"error": exc}
+                common_logger.error(f"block_parser {log_params}")
+            return
+
+    # up to Cfg.prefetch_window blocks are downloaded ahead while the oldest one is being stored,
+    # blocks are stored strictly in order
+    pending = deque()
+    try:
+        while pending or variables.trusted_block > next_block:
+            while len(pending) < Cfg.prefetch_window and variables.trusted_block > next_block:
+                pending.append((next_block, asyncio.create_task(fetch_block(next_block))))
+                next_block += 1
+
+            block_num, task = pending.popleft()
+            try:
+                transactions, block = await task
+            except Exception as exc:
+                if not isinstance(exc, httpx.HTTPStatusError):
+                    log_params = {"error": exc}
+                    common_logger.error(f"block_parser {log_params}")
+                break
+            else:
+                await store_block(block_num, transactions, block)
+    finally:
+        for _, task in pending:
+            task.cancel()
+        await asyncio.gather(*[task for _, task in pending], return_exceptions=True)
 
 
-async def postpone_deposit_handling(db, deposit_id, tx_handler_period, address_id):
+def postpone_deposit_handling(deposit_id, tx_handler_period) -> dict:
+    """
+    :return: row of bulk_update_deposits releasing the deposit until the next attempt
+    """
     time_to_tx_handler = datetime.now(timezone.utc) + timedelta(seconds=tx_handler_period)
-    tx_handler_period += 30
-    await db.update_user_address_by_id(address_id, {UserAddress.locked_by_tx.key: False}, commit=False)
-    await db.update_deposit_by_id(deposit_id, {Deposits.locked_by_tx_handler.key: False,
-                                               Deposits.time_to_tx_handler.key: time_to_tx_handler,
-                                               Deposits.tx_handler_period.key: tx_handler_period},
-                                  commit=True)
+    return {Deposits.id.key: deposit_id,
+            Deposits.tx_handler_lease_expires_at.key: None,
+            Deposits.time_to_tx_handler.key: time_to_tx_handler,
+            Deposits.tx_handler_period.key: tx_handler_period + 30}
 
 
 async def tx_conductor_native():
     reqs = []
-    async with write_async_session() as session:
+    async with write_async_session() as session:  # claim, the connection is returned before requests start
         db = DB(session)
         deposits = await db.get_and_lock_pending_deposits_native()
-        if deposits:
-            for deposit in deposits:
-                conn_creds: list[tuple[str, str]] = await variables.api_keys_pool.get()
-                reqs.append(asyncio.create_task(native_transfer_to_admin(conn_creds=conn_creds, **deposit)))
-
-            results = await asyncio.gather(*reqs)
+    if not deposits:
+        return 0
+
+    for deposit in deposits:
+        conn_creds: list[tuple[str, str]] = await variables.api_keys_pool.get()
+        reqs.append(asyncio.create_task(native_transfer_to_admin(conn_creds=conn_creds, **deposit)))
+
+    async with leases_kept((Deposits.tx_handler_lease_expires_at, [row["deposit_id"] for row in deposits]),
+                           (UserAddress.tx_lease_expires_at, [row["address_id"] for row in deposits])):
+        results = await asyncio.gather(*reqs)
+
+    updates = []
+    unlock_address_ids = []
+    review_address_ids = []
+    for tx_hash, err, req_ident in results:
+        conn_creds, deposit_id, tx_handler_period, address_id = req_ident
+        await variables.api_keys_pool.put(conn_creds)
+        if not err:
+            unlock_address_ids.append(address_id)
+            updates.append({Deposits.id.key: deposit_id,
+                            Deposits.tx_hash_out.key: tx_hash,
+                            Deposits.tx_handler_lease_expires_at.key: None})
+        else:  # exception handling
+            log_params = {"deposit_id": deposit_id, "tx_handler_period": tx_handler_period, "error": err}
+            if isinstance(err, (BuildTransactionError, TransactionNotFound, TvmError, ApiError,
+                                BadSignature, TaposError, TransactionError, ValidationError)):
+                common_logger.error(f"tx_conductor_native error {log_params}")
+                unlock_address_ids.append(address_id)
+                updates.append(postpone_deposit_handling(deposit_id, tx_handler_period))
+            elif isinstance(err, UnableToGetReceiptError):  # sent, the hash keeps the deposit out of the queue
+                common_logger.critical(f"tx_conductor_native error {log_params}")
+                unlock_address_ids.append(address_id)
+                updates.append({Deposits.id.key: deposit_id,
+                                Deposits.tx_hash_out.key: err.tx_hash,
+                                Deposits.tx_handler_lease_expires_at.key: None})
+            else:  # the transfer may be sent already, the deposit and its address wait for manual review
+                if isinstance(err, httpx.HTTPStatusError):
+                    common_logger.error(f"tx_conductor_native error, held for review {log_params}")
+                else:
+                    common_logger.critical(f"tx_conductor_native unexpected error, held for review {log_params}")
+                review_address_ids.append(address_id)
+                updates.append({Deposits.id.key: deposit_id,
+                                Deposits.tx_handler_lease_expires_at.key: HELD_FOR_REVIEW})
 
-            for tx_hash, err, req_ident in results:
-                conn_creds, deposit_id, tx_handler_period, address_id = req_ident
-                await variables.api_keys_pool.put(conn_creds)
-                if not err:
-                    await db.update_user_address_by_id(address_id, {UserAddress.locked_by_tx.key: False}, commit=False)
-                    await db.update_deposit_by_id(deposit_id, {Deposits.tx_hash_out.key: tx_hash,
-                                                               Deposits.locked_by_tx_handler.key: False}, commit=True)
-                else:  # exception handling
-                    log_params = {"deposit_id": deposit_id, "tx_handler_period": tx_handler_period, "error": err}
-                    if isinstance(err, (BuildTransactionError, TransactionNotFound, TvmError, ApiError,
-                                        BadSignature, TaposError, TransactionError, ValidationError)):
-                        common_logger.error(f"tx_conductor_native error {log_params}")
-                        await postpone_deposit_handling(db, deposit_id, tx_handler_period, address_id)
-                    else:
-                        if isinstance(err, UnableToGetReceiptError):
-                            common_logger.critical(f"tx_conductor_native error {log_params}")
-                        elif not isinstance(err, httpx.HTTPStatusError):
-                            common_logger.critical(f"tx_conductor_native unexpected error {log_params}")
+    async with write_async_session() as session:  # record
+        db = DB(session)
+        if unlock_address_ids:
+            await db.update_user_addresses_by_ids(unlock_address_ids, {UserAddress.tx_lease_expires_at.key: None})
+        if review_address_ids:
+            await db.update_user_addresses_by_ids(review_address_ids,
+                                                  {UserAddress.tx_lease_expires_at.key: HELD_FOR_REVIEW})
+        await db.bulk_update_deposits(updates, commit=True)
+    return len(deposits)
 
 
 async def native_transfer_to_admin(conn_creds,
@@ -547,82 +615,125 @@ async def native_transfer_to_admin(conn_creds,
 
 async def tx_conductor_coin():
     reqs = []
-    async with write_async_session() as session:
+    async with write_async_session() as session:  # claim, the connection is returned before requests start
         db = DB(session)
         deposits = await db.get_and_lock_pending_deposits_coin()
+    if not deposits:
+        return 0
+
+    for deposit in deposits:
+        conn_creds: list[tuple[str, str]] = await variables.api_keys_pool.get()
+        reqs.append(asyncio.create_task(coin_transfer_to_admin(conn_creds=conn_creds, **deposit)))
+
+    async with leases_kept((Deposits.tx_handler_lease_expires_at, [row["deposit_id"] for row in deposits]),
+                           (UserAddress.tx_lease_expires_at,
+                            [row[key] for row in deposits for key in ("address_id", "approve_id")])):
+        results = await asyncio.gather(*reqs)
+
+    updates = []
+    unlock_address_ids = []
+    review_address_ids = []
+    for tx_hash, err, req_ident in results:
+        conn_creds, deposit_id, tx_handler_period, approve_id, address_id = req_ident
+        await variables.api_keys_pool.put(conn_creds)
 
-        if deposits:
-            for deposit in deposits:
-                conn_creds: list[tuple[str, str]] = await variables.api_keys_pool.get()
-                reqs.append(asyncio.create_task(coin_transfer_to_admin(conn_creds=conn_creds, **deposit)))
-
-            results = await asyncio.gather(*reqs)
-
-            for tx_hash, err, req_ident in results:
-                conn_creds, deposit_id, tx_handler_period, approve_id, address_id = req_ident
-                await variables.api_keys_pool.put(conn_creds)
-
-                await db.update_user_address_by_id(approve_id, {UserAddress.locked_by_tx.key: False}, commit=False)
+        unlock_address_ids.append(approve_id)
+
+        if not err:
+            unlock_address_ids.append(address_id)
+            updates.append({Deposits.id.key: deposit_id,
+                            Deposits.tx_hash_out.key: tx_hash,
+                            Deposits.tx_handler_lease_expires_at.key: None})
+        else:  # exception handling
+            log_params = {"deposit_id": deposit_id, "tx_handler_period": tx_handler_period, "error": err}
+            if isinstance(err, (PreparingTransactionError, BuildTransactionError,
+                                TransactionNotFound, TvmError, ApiError,
+                                BadSignature, TaposError, TransactionError, ValidationError)):
+                common_logger.error(f"tx_conductor_coin error {log_params}")
+                unlock_address_ids.append(address_id)
+                updates.append(postpone_deposit_handling(deposit_id, tx_handler_period))
+            elif isinstance(err, UnableToGetReceiptError):  # sent, the hash keeps the deposit out of the queue
+                common_logger.critical(f"tx_conductor_coin error {log_params}")
+                unlock_address_ids.append(address_id)
+                updates.append({Deposits.id.key: deposit_id,
+                                Deposits.tx_hash_out.key: err.tx_hash,
+                                Deposits.tx_handler_lease_expires_at.key: None})
+            else:  # the transfer may be sent already, the deposit and its address wait for manual review
+                if isinstance(err, httpx.HTTPStatusError):
+                    common_logger.error(f"tx_conductor_coin error, held for review {log_params}")
+                else:
+                    common_logger.critical(f"tx_conductor_coin unexpected error, held for review {log_params}")
+                review_address_ids.append(address_id)
+                updates.append({Deposits.id.key: deposit_id,
+                                Deposits.tx_handler_lease_expires_at.key: HELD_FOR_REVIEW})
 
-                if not err:
-                    await db.update_user_address_by_id(address_id, {UserAddress.locked_by_tx.key: False}, commit=False)
-                    await db.update_deposit_by_id(deposit_id, {Deposits.tx_hash_out.key: tx_hash,
-                                                               Deposits.locked_by_tx_handler.key: False}, commit=True)
-                else:  # exception handling
-                    log_params = {"deposit_id": deposit_id, "tx_handler_period": tx_handler_period, "error": err}
-                    if isinstance(err, (PreparingTransactionError, BuildTransactionError,
-                                        TransactionNotFound, TvmError, ApiError,
-                                        BadSignature, TaposError, TransactionError, ValidationError)):
-                        common_logger.error(f"tx_conductor_coin error {log_params}")
-                        await postpone_deposit_handling(db, deposit_id, tx_handler_period, address_id)
-                    else:
-                        if isinstance(err, UnableToGetReceiptError):
-                            common_logger.critical(f"tx_conductor_coin error {log_params}")
-                        elif not isinstance(err, httpx.HTTPStatusError):
-                            common_logger.critical(f"tx_conductor_coin unexpected error {log_params}")
+    async with write_async_session() as session:  # record
+        db = DB(session)
+        await db.update_user_addresses_by_ids(unlock_address_ids, {UserAddress.tx_lease_expires_at.key: None})
+        if review_address_ids:
+            await db.update_user_addresses_by_ids(review_address_ids,
+                                                  {UserAddress.tx_lease_expires_at.key: HELD_FOR_REVIEW})
+        await db.bulk_update_deposits(updates, commit=True)
+    return len(deposits)
 
 
 async def withdraw_handler():
     reqs = []
-    async with write_async_session() as session:
+    async with write_async_session() as session:  # claim, the connection is returned before requests start
         db = DB(session)
         withdrawals = await db.get_and_lock_pending_withdrawals()
-        if withdrawals:
-            for withdrawal in withdrawals:
-                contract_address = withdrawal[Withdrawals.contract_address.key]
-                conn_creds: list[tuple[str, str]] = await variables.api_keys_pool.get()
-                if contract_address == St.native.v:
-                    reqs.append(asyncio.create_task(withdraw_native(conn_creds, **withdrawal)))
-                else:
-                    reqs.append(asyncio.create_task(withdraw_coin(conn_creds, **withdrawal)))
+    if not withdrawals:
+        return 0
+
+    for withdrawal in withdrawals:
+        contract_address = withdrawal[Withdrawals.contract_address.key]
+        conn_creds: list[tuple[str, str]] = await variables.api_keys_pool.get()
+        if contract_address == St.native.v:
+            reqs.append(asyncio.create_task(withdraw_native(conn_creds, **withdrawal)))
+        else:
+            reqs.append(asyncio.create_task(withdraw_coin(conn_creds, **withdrawal)))
 
-            results = await asyncio.gather(*reqs)
+    async with leases_kept((Withdrawals.tx_handler_lease_expires_at, [row["withdrawal_id"] for row in withdrawals]),
+                           (UserAddress.tx_lease_expires_at, [row["admin_addr_id"] for row in withdrawals])):
+        results = await asyncio.gather(*reqs)
 
-            for tx_hash, err, req_ident in results:
-                conn_creds, withdrawal_id, tx_handler_period, adm_address_id = req_ident
-                await variables.api_keys_pool.put(conn_creds)
-                if not err:
-                    await db.update_user_address_by_id(adm_address_id, {UserAddress.locked_by_tx.key: False},
-                                                       commit=False)
-                    await db.update_withdrawal_by_id(withdrawal_id, {Withdrawals.tx_hash_out.key: tx_hash}, commit=True)
-                else:
-                    log_params = {"withdrawal_id": withdrawal_id, "adm_address_id": adm_address_id,
-                                  "tx_handler_period": tx_handler_period, "error": err}
-                    if isinstance(err, (BuildTransactionError, TransactionNotFound,
-                                        TvmError, ApiError, BadSignature, TaposError, TransactionError,
-                                        ValidationError)):
-                        common_logger.error(f"withdraw_handler error {log_params}")
-                        time_to_tx_handler = datetime.now(timezone.utc) + timedelta(tx_handler_period)
-                        tx_handler_period += 15
-                        await db.update_withdrawal_by_id(
-                            withdrawal_id, {Withdrawals.admin_addr_id.key: None,
-                                            Withdrawals.time_to_tx_handler.key: time_to_tx_handler,
-                                            Withdrawals.tx_handler_period.key: tx_handler_period}, commit=True)
-                    else:
-                        if isinstance(err, UnableToGetReceiptError):
-                            common_logger.critical(f"withdraw_handler error {log_params}")
-                        elif not isinstance(err, httpx.HTTPStatusError):
-                            common_logger.critical(f"withdraw_handler unexpected error {log_params}")
+    updates = []
+    unlock_address_ids = []
+    sent = 0  # failed withdrawals wait for time_to_tx_handler, so queue_worker only reruns on progress
+    for tx_hash, err, req_ident in results:
+        conn_creds, withdrawal_id, tx_handler_period, adm_address_id = req_ident
+        await variables.api_keys_pool.put(conn_creds)
+        if not err:
+            sent += 1
+            unlock_address_ids.append(adm_address_id)
+            updates.append({Withdrawals.id.key: withdrawal_id, Withdrawals.tx_hash_out.key: tx_hash,
+                            Withdrawals.tx_handler_lease_expires_at.key: None})
+        else:
+            log_params = {"withdrawal_id": withdrawal_id, "adm_address_id": adm_address_id,
+                          "tx_handler_period": tx_handler_period, "error": err}
+            if isinstance(err, (BuildTransactionError, TransactionNotFound,
+                                TvmError, ApiError, BadSignature, TaposError, TransactionError,
+                                ValidationError)):
+                common_logger.error(f"withdraw_handler error {log_params}")
+                unlock_address_ids.append(adm_address_id)
+                time_to_tx_handler = datetime.now(timezone.utc) + timedelta(seconds=tx_handler_period)
+                updates.append({Withdrawals.id.key: withdrawal_id,
+                                Withdrawals.admin_addr_id.key: None,
+                                Withdrawals.tx_handler_lease_expires_at.key: None,
+                                Withdrawals.time_to_tx_handler.key: time_to_tx_handler,
+                                Withdrawals.tx_handler_period.key: tx_handler_period + 15})
+            else:
+                if isinstance(err, UnableToGetReceiptError):
+                    common_logger.critical(f"withdraw_handler error {log_params}")
+                elif not isinstance(err, httpx.HTTPStatusError):
+                    common_logger.critical(f"withdraw_handler unexpected error {log_params}")
+
+    async with write_async_session() as session:  # record
+        db = DB(session)
+        if unlock_address_ids:
+            await db.update_user_addresses_by_ids(unlock_address_ids, {UserAddress.tx_lease_expires_at.key: None})
+        await db.bulk_update_withdrawals(updates, commit=True)
+    return sent
 
 
 async def deposit_callback_handler():
@@ -641,34 +752,39 @@ async def deposit_callback_handler():
                                                         )
                 reqs.append(asyncio.create_task(notify_deposit(display_amount=display_amount, **data)))
 
-            results = await asyncio.gather(*reqs)
+            async with leases_kept((Deposits.callback_lease_expires_at, [data["deposit_id"] for data in deposits])):
+                results = await asyncio.gather(*reqs)
 
+            updates = []
             for exception, req_ident in results:
                 deposit_id, callback_period, user_id = req_ident
                 if not exception:
-                    await db.update_deposit_by_id(deposit_id, {Deposits.is_notified.key: True,
-                                                               Deposits.locked_by_callback.key: False}, commit=True)
+                    updates.append({Deposits.id.key: deposit_id,
+                                    Deposits.is_notified.key: True,
+                                    Deposits.callback_lease_expires_at.key: None})
                 else:
                     log_params = {"deposit_id": deposit_id, "callback_period": callback_period, "user_id": user_id,
                                   "error": exception}
                     if isinstance(exception, api.proc_api_client.ClientException) and exception.http_code == 409:
                         callback_logger.warning(f"Deposit already notified {log_params}")
-                        await db.update_deposit_by_id(deposit_id, {Deposits.locked_by_callback.key: False,
-                                                                   Deposits.is_notified.key: True}, commit=True)
+                        updates.append({Deposits.id.key: deposit_id,
+                                        Deposits.callback_lease_expires_at.key: None,
+                                        Deposits.is_notified.key: True})
                     else:
                         time_to_callback = datetime.now(timezone.utc) + timedelta(seconds=callback_period)
-                        callback_period += 60
-                        await db.update_deposit_by_id(deposit_id, {Deposits.locked_by_callback.key: False,
-                                                                   Deposits.time_to_callback.key: time_to_callback,
-                                                                   Deposits.callback_period.key: callback_period},
-                                                      commit=True)
+                        updates.append({Deposits.id.key: deposit_id,
+                                        Deposits.callback_lease_expires_at.key: None,
+                                        Deposits.time_to_callback.key: time_to_callback,
+                                        Deposits.callback_period.key: callback_period + 60})
                         callback_logger.error(f"deposit_callback_handler {log_params}")
+            await db.bulk_update_deposits(updates, commit=True)
+        return len(deposits)
 
 
-async def withdrawal_callback_handler() -> None:
+async def withdrawal_callback_handler() -> int:
     """
     This function sends the withdrawal notifications to the users.
-    :return:
+    :return: count of claimed withdrawals
     """
     reqs = []
     async with write_async_session() as session:
@@ -685,32 +801,102 @@ async def withdrawal_callback_handler() -> None:
                                                         rounding
                                                         )
                 reqs.append(asyncio.create_task(notify_withdrawal(display_amount=display_amount, **data)))
-            results = await asyncio.gather(*reqs)
+            async with leases_kept((Withdrawals.callback_lease_expires_at,
+                                    [data["withdrawal_id"] for data in withdrawals])):
+                results = await asyncio.gather(*reqs)
 
+            updates = []
             for data, exception, req_ident in results:
                 withdrawal_id, callback_period = req_ident
                 if not exception:
-                    await db.update_withdrawal_by_id(withdrawal_id, {Withdrawals.is_notified.key: True,
-                                                                     Withdrawals.locked_by_callback.key: False},
-                                                     commit=True)
+                    updates.append({Withdrawals.id.key: withdrawal_id,
+                                    Withdrawals.is_notified.key: True,
+                                    Withdrawals.callback_lease_expires_at.key: None})
 
                 else:
                     log_params = {"withdrawal_id": withdrawal_id, "callback_period": callback_period,
                                   "error": exception}
                     if isinstance(exception, api.proc_api_client.ClientException) and exception.http_code == 409:
                         callback_logger.warning(f"Withdrawal already notified {log_params}")
-                        await db.update_withdrawal_by_id(withdrawal_id,
-                                                         {Withdrawals.locked_by_callback.key: False,
-                                                          Withdrawals.is_notified.key: True}, commit=True)
+                        updates.append({Withdrawals.id.key: withdrawal_id,
+                                        Withdrawals.callback_lease_expires_at.key: None,
+                                        Withdrawals.is_notified.key: True})
                     else:
                         time_to_callback = datetime.now(timezone.utc) + timedelta(seconds=callback_period)
-                        callback_period += 60
-                        await db.update_withdrawal_by_id(withdrawal_id,
-                                                         {Withdrawals.locked_by_callback.key: False,
-                                                          Withdrawals.time_to_callback.key: time_to_callback,
-                                                          Withdrawals.callback_period.key: callback_period},
-                                                         commit=True)
+                        updates.append({Withdrawals.id.key: withdrawal_id,
+                                        Withdrawals.callback_lease_expires_at.key: None,
+                                        Withdrawals.time_to_callback.key: time_to_callback,
+                                        Withdrawals.callback_period.key: callback_period + 60})
                         callback_logger.error(f"withdrawal_callback_handler {log_params}")
+            await db.bulk_update_withdrawals(updates, commit=True)
+        return len(withdrawals)
+
+
+async def queue_worker(func, event: asyncio.Event):
+    """
+    This function runs func as soon as its queue is notified and right away again while func keeps claiming rows,
+    otherwise every Cfg.queue_poll_interval seconds to pick up postponed retries and lost notifications.
+    :param func: job returning count of rows it made progress on, rows postponed for a retry don't count
+    :param event: set by QueueListener on NOTIFY
+    """
+    while True:
+        event.clear()
+        try:
+            claimed = await func()
+        except Exception as exc:
+            common_logger.error(f"{func.__name__} {exc}")
+            claimed = 0
+        if claimed:
+            continue
+        try:
+            await asyncio.wait_for(event.wait(), Cfg.queue_poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def report_pool_stats():
+    common_logger.info(f"write pool: {write_pool_stats.report(engine.sync_engine.pool)}")
+    common_logger.info(f"read pool: {read_pool_stats.report(read_engine.sync_engine.pool)}")
+
+
+@asynccontextmanager
+async def leases_kept(*claims: tuple[Column, list]):
+    """
+    This function renews leases of claimed ids every Cfg.lease_renew_interval seconds while the block runs,
+    so rows and addresses with requests in flight aren't released by the lease reaper.
+    :param claims: (lease column, ids), e.g. (Deposits.tx_handler_lease_expires_at, [deposit_id, ...])
+    """
+
+    async def renew():
+        while True:
+            await asyncio.sleep(Cfg.lease_renew_interval)
+            try:
+                async with write_async_session() as session:
+                    db = DB(session)
+                    for lease, ids in claims:
+                        await db.renew_leases(lease, ids)
+            except Exception as exc:
+                common_logger.error(f"lease renewal failed: {exc}")
+
+    task = asyncio.create_task(renew())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
+async def reap_expired_leases():
+    async with write_async_session() as session:
+        released = await DB(session).release_expired_leases()
+    for name, ids in released.items():
+        if not ids:
+            continue
+        if name == "withdrawal_payments":
+            # the transaction may be sent already, requeue by clearing admin_addr_id only after checking the chain
+            common_logger.critical(f"{len(ids)} withdrawal payments lost their lease and stay assigned "
+                                   f"to admin address: {ids}")
+        else:
+            common_logger.warning(f"{len(ids)} {name} recovered from expired leases: {ids}")
 
 
 async def main():
@@ -720,24 +906,39 @@ async def main():
     try:
         await update_in_memory_trusted_block()
         await update_in_memory_last_handled_block()
-        await update_in_memory_accounts()
+        await update_in_memory_accounts(True)
+        await load_coin_registry()
         await update_coin_rates()
     except Exception as exc:
         startup_logger.error(f"launch failed {exc}")
         raise Exception(f"launch failed {exc}")
     else:
         startup_logger.info("launch success")
-        scheduler.add_job(update_in_memory_accounts, "interval", seconds=10, max_instances=1)
+        scheduler.add_job(update_in_memory_accounts, "interval", seconds=Cfg.accounts_refresh_interval,
+                          max_instances=1)
+        scheduler.add_job(update_in_memory_accounts, "interval", seconds=Cfg.accounts_resync_interval,
+                          max_instances=1, args=(True,))
+        # kill -HUP forces a full resync, e.g. after addresses were edited by hand
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGHUP, lambda: scheduler.add_job(update_in_memory_accounts, args=(True,)))
         scheduler.add_job(update_coin_rates, "interval", seconds=10, max_instances=1)
         scheduler.add_job(admin_coins_bal, "interval", seconds=30, max_instances=1)
         scheduler.add_job(admin_approve_native_bal, "interval", seconds=30, max_instances=1)
+        scheduler.add_job(report_pool_stats, "interval", seconds=Cfg.pool_stats_interval)
+        scheduler.add_job(reap_expired_leases, "interval", seconds=Cfg.lease_reaper_interval, max_instances=1)
         block_parser_job = scheduler.add_job(block_parser, "interval", seconds=variables.block_parser_interval,
                                              max_instances=1)
-        scheduler.add_job(tx_conductor_coin, "interval", seconds=1, max_instances=1)
-        scheduler.add_job(tx_conductor_native, "interval", seconds=1, max_instances=1)
-        scheduler.add_job(withdraw_handler, "interval", seconds=1, max_instances=1)
-        scheduler.add_job(deposit_callback_handler, "interval", seconds=1, max_instances=1)
-        scheduler.add_job(withdrawal_callback_handler, "interval", seconds=1, max_instances=1)
+
+        # queue workers are woken by NOTIFY of deposits and withdrawals triggers, polling is the fallback
+        queue_listener = QueueListener(Cfg.WRITE_DSN, Cfg.listen_reconnect_interval)
+        queue_workers = [(tx_conductor_coin, DEPOSITS_CHANNEL),
+                         (tx_conductor_native, DEPOSITS_CHANNEL),
+                         (withdraw_handler, WITHDRAWALS_CHANNEL),
+                         (deposit_callback_handler, DEPOSITS_CHANNEL),
+                         (withdrawal_callback_handler, WITHDRAWALS_CHANNEL)]
+        background_tasks = [asyncio.create_task(queue_worker(func, queue_listener.subscribe(channel)))
+                            for func, channel in queue_workers]
+        background_tasks.append(asyncio.create_task(queue_listener.run(common_logger)))
 
         explorer_interval = 120
         scheduler.add_job(explorer,